@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+    Timing benchmarks for the reflection engine.
+    Run from the repository root, e.g.
+        python benchmarks/benchmark_reflection.py --points 500
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import timeit
+import numpy as np
+from licorne.layer import Layer
+from licorne import reflection
+
+
+def random_stack(n_sublayers, magnetic=True, seed=0):
+    """
+    Incoming media, n_sublayers random sublayers and a substrate
+    """
+    rng = np.random.RandomState(seed)
+    sublayers = [Layer(name='incoming media', thickness=np.inf)]
+    for _ in range(n_sublayers):
+        sublayers.append(Layer(thickness=rng.uniform(2., 20.),
+                               nsld_real=rng.uniform(1e-6, 7e-6),
+                               nsld_imaginary=-1e-8,
+                               msld_rho=rng.uniform(0., 2e-6) if magnetic else 0.,
+                               msld_theta=90.,
+                               msld_phi=rng.uniform(-180., 180.)))
+    sublayers.append(Layer(name='substrate', thickness=np.inf, nsld_real=2.07e-6))
+    return sublayers
+
+
+def best_time(function, repeat=3):
+    """
+    Best wall time of a single call, in seconds
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange() if hasattr(timer, 'autorange') else (1, None)
+    return min(timer.repeat(repeat, number)) / number
+
+
+def benchmark_product(n_points, sizes):
+    """
+    Sequential versus tree product of the sublayer matrices, both with the numpy backend
+    """
+    inc_moment = np.linspace(0.002, 0.2, n_points) / 2.
+    print('{0:>8} {1:>16} {2:>16} {3:>10}'.format('L', 'sequential (ms)', 'tree (ms)', 'speedup'))
+    for n_sublayers in sizes:
+        sublayers = random_stack(n_sublayers)
+        sequential = best_time(lambda: reflection.reflection(inc_moment, sublayers, product='sequential',
+                                                                      backend='numpy'))
+        tree = best_time(lambda: reflection.reflection(inc_moment, sublayers, product='tree'))
+        print('{0:>8} {1:>16.2f} {2:>16.2f} {3:>10.2f}'.format(n_sublayers, sequential * 1e3,
+                                                               tree * 1e3, sequential / tree))
+
+
+def benchmark_batch(n_points, n_sublayers, populations):
+    """
+    reflection_batch versus one reflection call per model
+    """
+    inc_moment = np.linspace(0.002, 0.2, n_points) / 2.
+    print('{0:>8} {1:>16} {2:>16} {3:>10}'.format('K', 'loop (ms)', 'batch (ms)', 'speedup'))
+    for population in populations:
+        stacks = [random_stack(n_sublayers, seed=k) for k in range(population)]
+        array = reflection.stack_array(stacks)
+        loop = best_time(lambda: [reflection.reflection(inc_moment, sublayers) for sublayers in stacks], 1)
+        batch = best_time(lambda: reflection.reflection_batch(inc_moment, array), 1)
+        print('{0:>8} {1:>16.2f} {2:>16.2f} {3:>10.2f}'.format(population, loop * 1e3,
+                                                               batch * 1e3, loop / batch))
+
+
+def benchmark_threads(n_sublayers, point_counts, threads):
+    """
+    Serial versus threaded evaluation over chunks of Q, both with the numpy backend
+    """
+    sublayers = random_stack(n_sublayers)
+    print('{0:>8} {1:>16} {2:>16} {3:>10}'.format('N', 'serial (ms)', 'threads (ms)', 'speedup'))
+    for n_points in point_counts:
+        inc_moment = np.linspace(0.002, 0.2, n_points) / 2.
+        serial = best_time(lambda: reflection.reflection(inc_moment, sublayers, backend='numpy'))
+        threaded = best_time(lambda: reflection.reflection(inc_moment, sublayers, threads=threads))
+        print('{0:>8} {1:>16.2f} {2:>16.2f} {3:>10.2f}'.format(n_points, serial * 1e3,
+                                                               threaded * 1e3, serial / threaded))
+
+
+def benchmark_formalism(n_points, sizes):
+    """
+    Transfer matrix versus Parratt formalism: timing and largest difference
+    relative to the largest amplitude
+    """
+    inc_moment = np.linspace(0.002, 0.2, n_points) / 2.
+    print('{0:>8} {1:>10} {2:>16} {3:>16} {4:>12}'.format('L', 'magnetic', 'transfer (ms)', 'parratt (ms)',
+                                                           'difference'))
+    for n_sublayers in sizes:
+        for magnetic in (True, False):
+            sublayers = random_stack(n_sublayers, magnetic)
+            transfer = best_time(lambda: reflection.reflection(inc_moment, sublayers))
+            parratt = best_time(lambda: reflection.reflection(inc_moment, sublayers, formalism='parratt'))
+            R = reflection.reflection(inc_moment, sublayers).data
+            difference = np.abs(reflection.reflection(inc_moment, sublayers, formalism='parratt').data - R).max()
+            print('{0:>8} {1:>10} {2:>16.2f} {3:>16.2f} {4:>12.2e}'.format(n_sublayers, str(magnetic),
+                                                                            transfer * 1e3, parratt * 1e3,
+                                                                            difference / np.abs(R).max()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--points', type=int, default=500, help='number of Q points')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 100, 500, 1000, 5000],
+                        help='numbers of sublayers')
+    parser.add_argument('--populations', type=int, nargs='+', default=[50, 500],
+                        help='numbers of models for the batch benchmark')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='number of threads for the threaded benchmark (default: one per core)')
+    args = parser.parse_args()
+    print('Product of sublayer matrices, {0} Q points'.format(args.points))
+    benchmark_product(args.points, args.sizes)
+    print('Batch of models with 30 sublayers, {0} Q points'.format(args.points))
+    benchmark_batch(args.points, 30, args.populations)
+    print('Transfer matrix and Parratt formalisms, {0} Q points'.format(args.points))
+    benchmark_formalism(args.points, [size for size in args.sizes if size <= 1000])
+    print('Threaded evaluation, 100 sublayers')
+    benchmark_threads(100, [1000, 10000, 100000], args.threads or True)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,3 +12,11 @@ def resolution(Q):
     DTheta[Q>0]=0.0007
     Sigma=Q*np.sqrt((DTheta/Theta)**2+(DLambda/Lambda)**2)
     return Sigma
+
+def wavelength(Q):
+    """
+    Wavelength of each Q point, for layers with tabulated nsld.
+    Q is the same argument as for resolution, half the momentum transfer
+    """
+    Lambda=5
+    return np.full(np.shape(Q),Lambda,dtype=float)
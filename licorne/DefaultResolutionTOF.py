@@ -11,3 +11,15 @@ def resolution(Q):
     Lambda=4*np.pi*np.sin(Theta)/Q
     Sigma=Q*np.sqrt((DTheta/Theta)**2+(DLambda/Lambda)**2)
     return Sigma
+
+def wavelength(Q):
+    """
+    Wavelength of each Q point, for layers with tabulated nsld.
+    Q is the same argument as for resolution, half the momentum transfer,
+    so the wavelength is 2 pi sin(Theta)/Q. It is infinite at Q=0
+    """
+    Q=np.array(Q,dtype=float)
+    Theta=0.01
+    Lambda=np.full(Q.shape,np.inf)
+    Lambda[Q>0]=2*np.pi*np.sin(Theta)/Q[Q>0]
+    return Lambda
@@ -1,7 +1,10 @@
 from PyQt5 import QtCore
 import licorne.layer
+from licorne.NumericParameter import NumericParameter
+from licorne.generateSublayers import expand_repeats, generateSublayerStack
 import numpy as np
 import copy
+import operator
 from six import Iterator
 
 
@@ -22,6 +25,113 @@ class SampleModelIterator(Iterator):
         return result
 
 
+class RepeatBlock(object):
+    """
+    A block of consecutive layers, from layers[first] to layers[last],
+    that occurs repetitions times in a row (a superlattice)
+    """
+    def __init__(self, first, last, repetitions):
+        self.first = int(first)
+        self.last = int(last)
+        self.repetitions = int(repetitions)
+
+    def __repr__(self):
+        return "RepeatBlock(layers {0}-{1} x {2})".format(self.first, self.last, self.repetitions)
+
+
+class Domain(object):
+    """
+    A magnetic domain state of the sample: the layers with index j in msld
+    have the magnetization msld[j] instead of their own. Domains are larger
+    than the coherence length of the neutrons, so the reflectivity of the
+    sample is the average of the reflectivities of the domain states,
+    weighted by weight (relative to the sum of the weights)
+    """
+    def __init__(self, msld=None, weight=1., name=''):
+        self.msld = {}
+        for j, m in (msld or {}).items():
+            self.msld[int(j)] = m if isinstance(m, licorne.layer.MSLD) else licorne.layer.MSLD(*m)
+        self._weight = NumericParameter('weight', weight)
+        self.name = name
+
+    def __repr__(self):
+        return "Domain({0}, layers {1}, {2})".format(self.name, sorted(self.msld), self._weight)
+
+    weight = property(operator.attrgetter('_weight'))
+
+    @weight.setter
+    def weight(self, w):
+        self._weight = NumericParameter('weight', w)
+
+
+class Fluctuations(object):
+    """
+    Random variations of layer parameters across the sample (e.g. of the
+    thickness), on a scale larger than the coherence length of the neutrons,
+    so the reflectivity is averaged over realizations of the sample.
+    widths maps (j, name) to the standard deviation of the normally distributed
+    parameter name of layers[j], one of PARAMETERS.
+    With method 'monte_carlo' the average is over n_monte_carlo random realizations
+    drawn from seed (the same ones at every call, unless seed is None).
+    With method 'gauss' it uses the n_monte_carlo point Gauss-Hermite rule for each
+    parameter, which is n_monte_carlo**len(widths) realizations.
+    """
+    PARAMETERS = ('thickness', 'roughness', 'nsld_real', 'nsld_imaginary', 'msld.rho', 'msld.theta', 'msld.phi')
+
+    def __init__(self, widths, n_monte_carlo, method='monte_carlo', seed=0):
+        self.widths = {}
+        for (j, name), w in widths.items():
+            if name not in self.PARAMETERS:
+                raise ValueError('Unknown layer parameter {0}'.format(name))
+            self.widths[(int(j), name)] = float(w)
+        if method not in ('monte_carlo', 'gauss'):
+            raise ValueError("method must be 'monte_carlo' or 'gauss'")
+        if n_monte_carlo < 1:
+            raise ValueError('n_monte_carlo must be at least 1')
+        self.n_monte_carlo = int(n_monte_carlo)
+        self.method = method
+        self.seed = seed
+
+    def __repr__(self):
+        return "Fluctuations({0}, {1} x {2})".format(self.widths, self.method, self.n_monte_carlo)
+
+    def realizations(self):
+        """
+        Weights (K,), summing to 1, and offsets from the nominal values (K, P)
+        of the parameters in sorted(self.widths), for all realizations at once
+        """
+        keys = sorted(self.widths)
+        sigma = np.array([self.widths[k] for k in keys], dtype=np.float64)
+        if not keys:
+            return np.ones(1), np.zeros((1, 0))
+        if self.method == 'gauss':
+            x, w = np.polynomial.hermite_e.hermegauss(self.n_monte_carlo)
+            z = np.array([g.ravel() for g in np.meshgrid(*([x] * len(keys)), indexing='ij')]).T
+            weights = np.prod([g.ravel() for g in np.meshgrid(*([w] * len(keys)), indexing='ij')], axis=0)
+            return weights / weights.sum(), z * sigma
+        z = np.random.RandomState(self.seed).standard_normal((self.n_monte_carlo, len(keys)))
+        return np.full(self.n_monte_carlo, 1. / self.n_monte_carlo), z * sigma
+
+    def apply(self, layers, offsets):
+        """
+        Copy of the list of layers, with the fluctuating parameters shifted by
+        offsets (one row of realizations). Only the layers that change are copied,
+        thickness and roughness are kept positive.
+        """
+        layers = list(layers)
+        for (j, name), d in zip(sorted(self.widths), offsets):
+            l = layers[j] = copy.copy(layers[j])
+            owner, attr = l, name
+            if name.startswith('msld.'):
+                l.msld = owner = copy.copy(l.msld)
+                attr = name[len('msld.'):]
+            value = getattr(owner, attr).value + d
+            if name in ('thickness', 'roughness'):
+                value = max(value, 0.)
+            setattr(owner, attr, value)
+        return layers
+
+
 class SampleModel(QtCore.QAbstractListModel):
     """
     SampleModel is a class to wrap layers, substrate, and incoming media
@@ -36,6 +146,12 @@ class SampleModel(QtCore.QAbstractListModel):
         self.incoming_media=licorne.layer.Layer(name='incoming media',thickness=np.inf)
         self.substrate=licorne.layer.Layer(name='substrate',thickness=np.inf)
         self.layers = []
+        self.repeats = []
+        self.domains = []
+        #averaging over random variations of layer parameters, see set_fluctuations
+        self.fluctuations = None
+        #describe rough interfaces with graded (linear) sublayers, see generateSublayers.rough_sublayer
+        self.graded_sublayers = False
 
     def __deepcopy__(self, memodict={}):
         cls = self.__class__
@@ -43,6 +159,10 @@ class SampleModel(QtCore.QAbstractListModel):
         result.substrate = copy.deepcopy(self.substrate)
         result.incoming_media = copy.deepcopy(self.incoming_media)
         result.layers = copy.deepcopy(self.layers)
+        result.repeats = copy.deepcopy(self.repeats)
+        result.domains = copy.deepcopy(self.domains)
+        result.fluctuations = copy.deepcopy(self.fluctuations)
+        result.graded_sublayers = self.graded_sublayers
         return result
 
     def set_model(self, other):
@@ -50,6 +170,38 @@ class SampleModel(QtCore.QAbstractListModel):
         self.layers = copy.deepcopy(other.layers)
         self.substrate = copy.deepcopy(other.substrate)
         self.incoming_media = copy.deepcopy(other.incoming_media)
+        self.repeats = copy.deepcopy(other.repeats)
+        self.domains = copy.deepcopy(other.domains)
+        self.fluctuations = copy.deepcopy(other.fluctuations)
+        self.graded_sublayers = other.graded_sublayers
+        self.endResetModel()
+
+    def state(self):
+        """
+        The model as a dict, as saved in the state files
+        (see MainWindow.save_state_yaml)
+        """
+        return dict(layers=self.layers,
+                    incoming_media=self.incoming_media,
+                    substrate=self.substrate,
+                    repeats=self.repeats,
+                    domains=self.domains,
+                    fluctuations=self.fluctuations,
+                    graded_sublayers=self.graded_sublayers)
+
+    def set_state(self, state):
+        """
+        Set the model from a dict written by state. Files saved before
+        repeats, domains, fluctuations or graded sublayers existed do not have them.
+        """
+        self.beginResetModel()
+        self.layers = state['layers']
+        self.incoming_media = state['incoming_media']
+        self.substrate = state['substrate']
+        self.repeats = state.get('repeats', [])
+        self.domains = state.get('domains', [])
+        self.fluctuations = state.get('fluctuations')
+        self.graded_sublayers = state.get('graded_sublayers', False)
         self.endResetModel()
 
     def rowCount(self, parent=None):
@@ -85,6 +237,12 @@ class SampleModel(QtCore.QAbstractListModel):
             return
         self.beginInsertRows(QtCore.QModelIndex(), position, position)
         self.layers.insert(position, item)
+        for r in self.repeats:
+            if r.first >= position:
+                r.first += 1
+            if r.last >= position:
+                r.last += 1
+        self._remap_layer_indices(lambda j: j+1 if j >= position else j)
         self.endInsertRows()
 
     def delItem(self,position):
@@ -98,6 +256,13 @@ class SampleModel(QtCore.QAbstractListModel):
             #The UI position needs to account for substrate/incoming media
             self.beginRemoveRows(QtCore.QModelIndex(), position+1, position+1)
             del self.layers[position]
+            for r in self.repeats:
+                if r.first > position:
+                    r.first -= 1
+                if r.last >= position:
+                    r.last -= 1
+            self.repeats = [r for r in self.repeats if r.first <= r.last]
+            self._remap_layer_indices(lambda j: None if j == position else j-1 if j > position else j)
             self.endRemoveRows()
 
     # iterate over the layers, no substrate
@@ -112,22 +277,152 @@ class SampleModel(QtCore.QAbstractListModel):
             indices of the layers to be moved. It won't affect substrate or incoming media
         """
         if set(selected_indices)<set(range(len(self.layers)-1)):
+            if any(self._crosses_repeat(si, si+1) for si in selected_indices):
+                return
             for si in selected_indices[::-1]:
                 if not self.beginMoveRows(QtCore.QModelIndex(), si-1, si-1, QtCore.QModelIndex(), si+1):
                     return
                 self.layers[si],self.layers[si+1]=self.layers[si+1],self.layers[si]
+                self._remap_layer_indices(lambda j: {si: si+1, si+1: si}.get(j, j))
                 self.endMoveRows()
         
     def move_up_1(self,selected_indices):
         if set(selected_indices)<set(range(1,len(self.layers))):
+            if any(self._crosses_repeat(si-1, si) for si in selected_indices):
+                return
             for si in selected_indices:
                 if not self.beginMoveRows(QtCore.QModelIndex(), si+1, si+1, QtCore.QModelIndex(), si):
                     return
                 self.layers[si-1],self.layers[si]=self.layers[si],self.layers[si-1]
+                self._remap_layer_indices(lambda j: {si-1: si, si: si-1}.get(j, j))
                 self.endMoveRows()
 
+    def _crosses_repeat(self, i, j):
+        """
+        True if swapping layers i and j would move a layer into or out of a
+        repeated block, which would change the layers that are repeated
+        """
+        return any((r.first <= i <= r.last) != (r.first <= j <= r.last) for r in self.repeats)
+
+    def _remap_layer_indices(self, new_index):
+        """
+        Keep the magnetization of the domains and the fluctuations with their
+        layers when layers move: layer j becomes layer new_index(j), or is deleted if None
+        """
+        for d in self.domains:
+            d.msld = {new_index(j): m for j, m in d.msld.items() if new_index(j) is not None}
+        if self.fluctuations is not None:
+            f = self.fluctuations
+            f.widths = {(new_index(j), name): w for (j, name), w in f.widths.items() if new_index(j) is not None}
+
     def get_names_list(self):
         names = [self.substrate.name,self.incoming_media.name]
         for l in self.layers:
             names.append(l.name)
         return names
+
+    def add_repeat(self, first, last, repetitions):
+        """
+        Repeat the layers first to last (indices in self.layers) repetitions times.
+        The layers are shared between the periods, so fitting a parameter
+        changes every period.
+        """
+        if not 0 <= first <= last < len(self.layers):
+            raise ValueError('Repeated block must be within the layer list')
+        if repetitions < 1:
+            raise ValueError('Number of repetitions must be at least 1')
+        for r in self.repeats:
+            if first <= r.last and r.first <= last:
+                raise ValueError('Repeated blocks cannot overlap')
+        self.repeats.append(RepeatBlock(first, last, repetitions))
+        self.repeats.sort(key=lambda r: r.first)
+
+    def _repeat_tuples(self):
+        """
+        Repeated blocks as (first, last, repetitions), with indices in
+        the list of incoming media, layers and substrate
+        """
+        return [(r.first+1, r.last+1, r.repetitions) for r in self.repeats]
+
+    def expanded_layers(self):
+        """
+        Incoming media, layers with all repeated blocks written out, and substrate.
+        Returns the list of layers, and for each of them the index in
+        [incoming_media]+layers+[substrate]
+        """
+        return expand_repeats([self.incoming_media]+self.layers+[self.substrate], self._repeat_tuples())
+
+    def sublayers(self):
+        """
+        Sublayers for the reflection calculation. Repeated blocks are kept
+        as a single period (see generateSublayerStack)
+        """
+        return self._stack(self.layers)
+
+    def add_domain(self, msld, weight=1., name=''):
+        """
+        Add a magnetic domain state (see Domain).
+        msld maps indices in self.layers to the (rho, theta, phi) of those
+        layers in this domain state. The weights are fit parameters.
+        """
+        for j in msld:
+            if not 0 <= j < len(self.layers):
+                raise ValueError('Domain magnetization must be for layers in the layer list')
+        self.domains.append(Domain(msld, weight, name))
+        return self.domains[-1]
+
+    def set_fluctuations(self, widths, n_monte_carlo, method='monte_carlo', seed=0):
+        """
+        Average the reflectivity over random variations of layer parameters (see Fluctuations).
+        widths maps (j, name), with j an index in self.layers, to a standard deviation.
+        n_monte_carlo of 0 (as in refl_par.dat) or no widths turn the averaging off.
+        """
+        for j, name in widths:
+            if not 0 <= j < len(self.layers):
+                raise ValueError('Fluctuations must be for layers in the layer list')
+        if n_monte_carlo == 0 or not widths:
+            self.fluctuations = None
+        else:
+            self.fluctuations = Fluctuations(widths, n_monte_carlo, method, seed)
+        return self.fluctuations
+
+    def _state_layers(self):
+        """ Weights and layer lists of the domain states """
+        if not self.domains:
+            return np.ones(1), [self.layers]
+        states = []
+        for d in self.domains:
+            layers = []
+            for j, l in enumerate(self.layers):
+                if j in d.msld:
+                    l = copy.copy(l)
+                    l.msld = d.msld[j]
+                layers.append(l)
+            states.append(layers)
+        return np.array([d.weight.value for d in self.domains]), states
+
+    def _stack(self, layers):
+        return generateSublayerStack([self.incoming_media]+layers+[self.substrate], self._repeat_tuples(),
+                                     self.graded_sublayers)
+
+    def domain_states(self):
+        """
+        Weights and sublayers (see sublayers) of the domain states.
+        Without domains, the sample is a single state of weight 1.
+        """
+        weights, states = self._state_layers()
+        return weights, [self._stack(layers) for layers in states]
+
+    def sample_states(self):
+        """
+        Weights and sublayers of all the states the reflectivity is averaged
+        over: each domain state in every realization of the fluctuations.
+        The realizations are drawn together, and evaluated together
+        by reflection.reflection_domains.
+        """
+        weights, states = self._state_layers()
+        if self.fluctuations is None:
+            return weights, [self._stack(layers) for layers in states]
+        f_weights, offsets = self.fluctuations.realizations()
+        return np.outer(weights, f_weights).ravel(), [self._stack(self.fluctuations.apply(layers, o))
+                                                      for layers in states for o in offsets]
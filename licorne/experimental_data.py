@@ -8,3 +8,4 @@ class experimental_data(object):
         self.pol_Analyzer=[0.,0.,0.]
         self.R_calc=None
         self.sigmaQ=None
+        self.wavelength=None
@@ -7,12 +7,59 @@ from PyQt5 import QtCore
 import licorne.SampleModel
 from licorne.SampleModel import SampleModel
 from licorne.model_adapter import ModelAdapter
-from licorne.reflection import reflection,resolut, spin_av
-from licorne.generateSublayers import generateSublayers
+from licorne.reflection import reflection, spin_av, spin_av_multi, ProductCache, ReflectionWorkspace, ResolutionCache, \
+    reflectivity_gradient, sublayer_potentials, flatten_sublayers, reflection_domains, spin_av_domains
 import licorne.utilities as lu
 from lmfit import minimize, report_fit, minimizer
 
 
+#smallest step for the derivatives of the sublayer profile, by parameter type
+PROFILE_STEPS = {'thickness':1e-6, 'roughness':1e-6, 'nsld_real':1e-14, 'nsld_imaginary':1e-14,
+                 'rho':1e-14, 'theta':1e-6, 'phi':1e-6}
+
+
+def sublayer_profile(sublayers):
+    """
+    Potentials of the sublayers as an (L, 6) array, in the order used by
+    reflectivity_gradient, and the substrate nsld as a (2,) array
+    """
+    A, B1, B2, B3, th = sublayer_potentials(flatten_sublayers(sublayers))
+    profile = np.array([A.real, A.imag, B1, B2, B3, th]).T
+    nsld = sublayers[-1].nsld
+    return profile, np.array([nsld.real, nsld.imag])
+
+
+def profile_derivative(sample_model, parameter, key):
+    """
+    Derivative of the sublayer profile with respect to a parameter of the
+    sample model, by central differences. generateSublayers is cheap compared
+    to the reflectivity, so this is done for every parameter.
+    Returns None if the number of sublayers changes within the step.
+    """
+    value = parameter.value
+    h = max(1e-6*abs(value), PROFILE_STEPS[key.split('___')[-1]])
+    parameter.value = value+h
+    plus = sublayer_profile(sample_model.sublayers())
+    parameter.value = value-h
+    minus = sublayer_profile(sample_model.sublayers())
+    parameter.value = value
+    if plus[0].shape != minus[0].shape:
+        return None
+    return (plus[0]-minus[0])/(2.*h), (plus[1]-minus[1])/(2.*h)
+
+
+def node_wavelength(q, wavelength, nodes):
+    """
+    Wavelength at the Gauss-Hermite nodes of the resolution, interpolated
+    from the wavelength of the data points (None if there is none).
+    q and nodes are half the momentum transfer
+    """
+    if wavelength is None:
+        return None
+    order = np.argsort(q)
+    return np.interp(nodes, q[order], wavelength[order])
+
+
 class FitWorker(QtCore.QThread):
     smChanged = QtCore.pyqtSignal(minimizer.MinimizerResult)
     chiSquaredChanged = QtCore.pyqtSignal(float)
@@ -21,6 +68,11 @@ class FitWorker(QtCore.QThread):
         super(FitWorker, self).__init__()
         self.sample_model=None
         self.data_model=None
+        self.q_groups=[]
+        self.caches=[]
+        self.workspaces=[]
+        #resolution matrices of the datasets, built once (Q and sigmaQ are fixed during the fit)
+        self.resolution_cache=ResolutionCache()
 
     def initialize(self, sm, dm):
         self.sample_model = copy.deepcopy(sm)
@@ -30,31 +82,135 @@ class FitWorker(QtCore.QThread):
             if ds.R is not None and len(ds.R)>1:
                 Q = ds.Q/2.
                 ds.sigmaQ = resolution.resolution(Q)
+                ds.wavelength = lu.get_wavelength(Q)
+        self.group_datasets()
+
+    def group_datasets(self):
+        """
+        Group the datasets with data by Q grid (see utilities.group_by_q),
+        the reflection is calculated once per group
+        """
+        datasets = self.data_model.datasets
+        self.q_groups = []
+        for Q, indices in lu.group_by_q(datasets):
+            indices = [i for i in indices if datasets[i].R is not None and len(datasets[i].R)>1]
+            if indices:
+                self.q_groups.append((Q, indices))
+        # one set of preallocated arrays per Q grid, reused for the lifetime of the fit,
+        # so the products of a single sample state do not allocate arrays
+        self.workspaces = [ReflectionWorkspace(len(Q)) for Q, indices in self.q_groups]
+        # the Gauss-Hermite nodes of the resolution are not on the Q grid: their partial
+        # products are kept between residual evaluations instead, one cache per Q grid
+        self.caches = [ProductCache() for group in self.q_groups]
+
+    def _reflectivity(self, q, channels, weights, states, cache=None, workspace=None, wavelength=None):
+        """
+        Spin averaged reflectivity of the datasets in channels at q, averaged
+        over the states of the sample (see SampleModel.sample_states).
+        A single state is evaluated with either the cache or the workspace.
+        wavelength (one value per q) is for layers with tabulated nsld.
+        """
+        pol_eff = np.ones(len(q), dtype = np.complex128)
+        an_eff = np.ones(len(q), dtype = np.complex128)
+        n1 = [ds.pol_Polarizer for ds in channels]
+        n2 = [ds.pol_Analyzer for ds in channels]
+        if len(states) > 1:
+            #all domain states and fluctuations in one pass, sharing the sublayers they have in common
+            return np.real(spin_av_domains(reflection_domains(q, states, wavelength=wavelength), weights, n1, n2,
+                                           pol_eff, an_eff))
+        r = reflection(q, states[0], cache=cache, workspace=workspace, wavelength=wavelength)
+        return np.real(spin_av_multi(r, n1, n2, pol_eff, an_eff))
 
     def calculate_residuals(self,parameters):
         ma = ModelAdapter(self.sample_model)
         ma.update_model_from_params(parameters)
-        layers = [self.sample_model.incoming_media]+self.sample_model.layers+[self.sample_model.substrate]
-        sublayers = generateSublayers(layers)[0]
-        chi_array = []
+        weights, states = self.sample_model.sample_states()
+        nodes = lu.get_resolution_nodes()
+        chi_array = {}
+        for (Q, indices),cache,workspace in zip(self.q_groups,self.caches,self.workspaces):
+            q = Q/2.
+            channels = [self.data_model.datasets[i] for i in indices]
+            wavelength = channels[0].wavelength
+            if nodes:
+                #reflectivity at the Gauss-Hermite nodes of the resolution, once for the datasets that share it
+                ops = [self.resolution_cache.gauss_hermite(q, ds.sigmaQ, nodes) for ds in channels]
+                rrr = [None]*len(channels)
+                for k, op in enumerate(ops):
+                    if rrr[k] is None:
+                        members = [m for m, o in enumerate(ops) if o is op]
+                        rr = self._reflectivity(op.q, [channels[m] for m in members], weights, states, cache,
+                                                wavelength=node_wavelength(q, wavelength, op.q))
+                        for m, rrr_m in zip(members, op(rr)):
+                            rrr[m] = rrr_m
+            else:
+                rr = self._reflectivity(q, channels, weights, states, workspace=workspace, wavelength=wavelength)
+                rrr = [self.resolution_cache(rr_ds, q, ds.sigmaQ) for ds, rr_ds in zip(channels, rr)]
+            for i,ds,rrr_ds in zip(indices,channels,rrr):
+                rrr_ds = rrr_ds*self.data_model.theory_factor+self.data_model.background
+                chi_array[i] = (rrr_ds/self.data_model.experiment_factor-ds.R)/ds.E
+        chi = np.concatenate([chi_array[i] for i in sorted(chi_array)]) if chi_array else np.array([])
+        self.chiSquaredChanged.emit((chi**2).mean())
+        return chi
+
+    def calculate_jacobian(self,parameters):
+        """
+        Jacobian of the residuals, one column per varying parameter.
+        The derivatives of the reflectivity with respect to the sublayer
+        potentials are analytic (reflectivity_gradient), and are chained with
+        the derivatives of the sublayer profile (profile_derivative).
+        The resolution is linear in the reflectivity, so it is applied
+        to each column.
+        """
+        ma = ModelAdapter(self.sample_model)
+        ma.update_model_from_params(parameters)
+        keys = [k for k in parameters if parameters[k].vary and not parameters[k].expr]
+        derivatives = [profile_derivative(self.sample_model, ma.numeric_parameter(parameters, k), k) for k in keys]
+        sublayers = self.sample_model.sublayers()
+        jacobian = []
         for ds in self.data_model.datasets:
             if ds.R is not None and len(ds.R)>1:
                 q = ds.Q/2.
-                r = reflection(q, sublayers)
                 pol_eff = np.ones(len(q), dtype = np.complex128)
                 an_eff = np.ones(len(q), dtype = np.complex128)
-                rr = np.real(spin_av(r, ds.pol_Polarizer, ds.pol_Analyzer, pol_eff,an_eff))
-                sigma = ds.sigmaQ
-                rrr = resolut(rr, q, sigma, 4)*self.data_model.theory_factor+self.data_model.background
-                chi_array.append((rrr/self.data_model.experiment_factor-ds.R)/ds.E)
-        chi = np.array(chi_array).ravel()
-        self.chiSquaredChanged.emit((chi**2).mean())
-        return chi
+                rr, gradient, sub_gradient = reflectivity_gradient(q, sublayers, ds.pol_Polarizer, ds.pol_Analyzer,
+                                                                   pol_eff, an_eff)
+                columns = []
+                for k, d in zip(keys, derivatives):
+                    if d is None:
+                        #the step changes the sublayer structure, fall back to a finite difference
+                        parameter = ma.numeric_parameter(parameters, k)
+                        value = parameter.value
+                        h = max(1e-6*abs(value), PROFILE_STEPS[k.split('___')[-1]])
+                        parameter.value = value+h
+                        r = reflection(q, self.sample_model.sublayers())
+                        parameter.value = value
+                        drr = (np.real(spin_av(r, ds.pol_Polarizer, ds.pol_Analyzer, pol_eff, an_eff))-rr)/h
+                    else:
+                        drr = np.einsum('ijn,ij->n', gradient, d[0])+d[1].dot(sub_gradient)
+                    columns.append(drr)
+                columns = self.resolution_cache(np.reshape(columns, (len(keys), len(q))), q, ds.sigmaQ)
+                scale = self.data_model.theory_factor/self.data_model.experiment_factor/ds.E
+                jacobian.append(columns.T*scale[:,np.newaxis])
+        return np.concatenate(jacobian)
+
+    def analytic_jacobian(self, parameters):
+        """
+        True if calculate_jacobian describes the residuals: it differentiates a
+        single state of the sample, made of constant sublayers with constant nsld,
+        with the resolution on the data points
+        """
+        return lu.get_minimizer() == 'leastsq' and not any(parameters[k].expr for k in parameters) \
+            and not self.sample_model.domains and self.sample_model.fluctuations is None \
+            and not self.sample_model.graded_sublayers and not lu.get_resolution_nodes() \
+            and all(l.nsld_table is None for l in flatten_sublayers(self.sample_model.sublayers()))
 
     def run(self):
         ma = ModelAdapter(self.sample_model)
         parameters=ma.params_from_model()
-        result=minimize(self.calculate_residuals, parameters,method=lu.get_minimizer())
+        fit_kws = {}
+        if self.analytic_jacobian(parameters):
+            fit_kws['Dfun'] = self.calculate_jacobian
+        result=minimize(self.calculate_residuals, parameters,method=lu.get_minimizer(),**fit_kws)
         #report_fit(result)
         #ma.update_model_from_params(result.params)
         #print(self.sample_model.substrate)
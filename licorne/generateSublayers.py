@@ -11,13 +11,37 @@ def J(model,xmin,xmax,scaling):
     if model=="ERFC":
         return quad(lambda x: sci_sp.erf(x*scaling),xmin,xmax)[0]
 
-def rough_sublayer(layer_up,layer_down):
+## Gauss-Legendre points used to fit the interface profile across a graded sublayer
+GRADED_NODES = 8
+
+
+class GradedSublayer(Layer):
+    """
+    Sublayer whose nsld and magnetization magnitude vary linearly across its
+    thickness (the direction of the magnetization is constant). The Layer
+    parameters are the values in the middle of the sublayer, nsld_step and
+    msld_rho_step the changes from its top to its bottom. Calculations that
+    do not support gradients treat it as a constant sublayer with the middle values.
+    """
+    def __init__(self, thickness=0., nsld_real=0., nsld_imaginary=0., msld_rho=0., msld_theta=0., msld_phi=0.,
+                 nsld_step=0., msld_rho_step=0., nsld_table=None):
+        super(GradedSublayer, self).__init__(thickness, nsld_real, nsld_imaginary, msld_rho, msld_theta, msld_phi,
+                                             0, RoughnessModel.NONE, 0, nsld_table=nsld_table)
+        self.nsld_step = complex(nsld_step)
+        self.msld_rho_step = float(msld_rho_step)
+
+
+def rough_sublayer(layer_up,layer_down,graded=False):
     """
     Function to calculate sublayers when there is roughness at the interface
     
     Args:
         layer_up   (Layer): The first layer (closer to surface)
         layer_down (Layer): The second layer
+        graded      (bool): describe the interface with GradedSublayer items, whose
+            values are the linear fit of the profile across each of them, instead
+            of constant sublayers with the values of the profile at their centers.
+            This converges faster with the number of sublayers.
         
     Returns:
         tuple: list of sublayers, and a list of of ints (0 and 1), both the same length.
@@ -44,6 +68,15 @@ def rough_sublayer(layer_up,layer_down):
     #first/last sublayer values. Only nsld_real,nsld_imaginary, and msld_rho are affected by rougness
     values_up=np.array([layer_up.nsld_real.value, layer_up.nsld_imaginary.value,layer_up.msld.rho.value])
     values_down=np.array([layer_down.nsld_real.value, layer_down.nsld_imaginary.value,layer_down.msld.rho.value])    
+    #tabulated nsld (see Layer.nsld_at) on the wavelengths of both tables, appended
+    #to the values: the calculation below is linear in them, like for the nsld
+    tables=[l.nsld_table[0] for l in (layer_up,layer_down) if l.nsld_table is not None]
+    if tables:
+        grid=np.unique(np.concatenate(tables))
+        table_up=np.broadcast_to(layer_up.nsld_at(grid),grid.shape)
+        table_down=np.broadcast_to(layer_down.nsld_at(grid),grid.shape)
+        values_up=np.concatenate((values_up,table_up.real,table_up.imag))
+        values_down=np.concatenate((values_down,table_down.real,table_down.imag))
 
     #extracting layer thicknesses and calculate interface extent
     L_up=gamma
@@ -71,35 +104,128 @@ def rough_sublayer(layer_up,layer_down):
     #create sublayers
     sublayer_thickness=(L_up+L_down)/N
     sublayer_centers=np.linspace(-L_up+sublayer_thickness/2, L_down-sublayer_thickness/2,N)
-    if model=="TANH":
-        new_values=((values_down-values_up)[:,np.newaxis] * (np.tanh(scale*sublayer_centers)+1.)/2.).transpose()+values_up
+    shape=np.tanh if model=="TANH" else sci_sp.erf
+    profile=lambda x: ((values_down-values_up)[:,np.newaxis] * (shape(scale*x)+1.)/2.).transpose()+values_up
+    if graded:
+        #least squares line through the profile across each sublayer: a + b t for t in [-1, 1]
+        t,w=np.polynomial.legendre.leggauss(GRADED_NODES)
+        nodes=profile((sublayer_centers[:,np.newaxis]+t*sublayer_thickness/2.).ravel()).reshape(N,len(t),-1)
+        new_values=np.einsum('k,nkv->nv',w,nodes)/2.
+        steps=3.*np.einsum('k,nkv->nv',w*t,nodes)
     else:
-        new_values=((values_down-values_up)[:,np.newaxis] * (sci_sp.erf(scale*sublayer_centers)+1.)/2.).transpose()+values_up
-    sublayers_nsld_re,sublayers_nsld_im,sublayers_msld_rho=new_values.transpose()
+        new_values=profile(sublayer_centers)
+    sublayers_nsld_re,sublayers_nsld_im,sublayers_msld_rho=new_values.transpose()[:3]
     sublayers_msld_theta=[layer_up.msld.theta.value if x < 0 else layer_down.msld.theta.value for x in sublayer_centers]
     sublayers_msld_phi=[layer_up.msld.phi.value if x < 0 else layer_down.msld.phi.value for x in sublayer_centers]
-    sublayer_list=[Layer(sublayer_thickness,nr,ni,mr,mt,mp,0,RoughnessModel.NONE,0) for nr,ni,mr,mt,mp in
-                        zip(sublayers_nsld_re,sublayers_nsld_im,sublayers_msld_rho,sublayers_msld_theta,sublayers_msld_phi)]
+    if graded:
+        sublayer_list=[GradedSublayer(sublayer_thickness,nr,ni,mr,mt,mp,complex(sr,si),sm) for nr,ni,mr,mt,mp,(sr,si,sm) in
+                            zip(sublayers_nsld_re,sublayers_nsld_im,sublayers_msld_rho,sublayers_msld_theta,sublayers_msld_phi,steps[:,:3])]
+    else:
+        sublayer_list=[Layer(sublayer_thickness,nr,ni,mr,mt,mp,0,RoughnessModel.NONE,0) for nr,ni,mr,mt,mp in
+                            zip(sublayers_nsld_re,sublayers_nsld_im,sublayers_msld_rho,sublayers_msld_theta,sublayers_msld_phi)]
+    if tables:
+        for sublayer,values in zip(sublayer_list,new_values[:,3:]):
+            sublayer.nsld_table=(grid,values[:len(grid)]+1j*values[len(grid):])
     corresponding_layer=list(np.piecewise(sublayer_centers,[sublayer_centers<0,sublayer_centers>=0],[0,1]))
     
     #deal with rest of the half layers, outside of the rough region
     if up_bound is not None:
         sublayer_list.insert(0,Layer(up_bound,layer_up.nsld_real.value, layer_up.nsld_imaginary.value,layer_up.msld.rho.value,
-                                     layer_up.msld.theta.value,layer_up.msld.phi.value,0,RoughnessModel.NONE,0))
+                                     layer_up.msld.theta.value,layer_up.msld.phi.value,0,RoughnessModel.NONE,0,
+                                     nsld_table=layer_up.nsld_table))
         corresponding_layer.insert(0,0)
     if down_bound is not None:
         sublayer_list.append(Layer(down_bound,layer_down.nsld_real.value, layer_down.nsld_imaginary.value,layer_down.msld.rho.value,
-                                   layer_down.msld.theta.value,layer_down.msld.phi.value,0,RoughnessModel.NONE,0))
+                                   layer_down.msld.theta.value,layer_down.msld.phi.value,0,RoughnessModel.NONE,0,
+                                   nsld_table=layer_down.nsld_table))
         corresponding_layer.append(1)
     return (sublayer_list,corresponding_layer)
 
-def generateSublayers(layerlist):
+def generateSublayers(layerlist,graded=False):
     sublayers=[]
     corresponding=[]
     for i in range(len(layerlist)-1):
-        s,c=rough_sublayer(layerlist[i],layerlist[i+1])
+        s,c=rough_sublayer(layerlist[i],layerlist[i+1],graded)
         sublayers+=s
         corresponding+=[int(j)+i for j in c]
     return (sublayers,corresponding)
 
 
+
+
+class SublayerRepeat(object):
+    """
+    Sublayers of one period of a repeated block of layers,
+    and the number of times that period occurs in the stack
+    """
+    def __init__(self, sublayers, repetitions):
+        self.sublayers = sublayers
+        self.repetitions = repetitions
+
+    def __repr__(self):
+        return "SublayerRepeat({0} sublayers x {1})".format(len(self.sublayers), self.repetitions)
+
+
+def expand_repeats(layerlist, repeats):
+    """
+    Function to write out repeated blocks of layers
+
+    Args:
+        layerlist (list): incoming media, layers, and substrate
+        repeats (list): (first, last, repetitions) tuples. The layers
+            layerlist[first:last+1] occur repetitions times in a row
+
+    Returns:
+        tuple: list of layers with the blocks repeated, and for each of them
+            the index of the corresponding layer in layerlist
+    """
+    layers=[]
+    index=[]
+    position=0
+    for first,last,repetitions in sorted(repeats):
+        layers+=layerlist[position:first]
+        index+=list(range(position,first))
+        for _ in range(repetitions):
+            layers+=layerlist[first:last+1]
+            index+=list(range(first,last+1))
+        position=last+1
+    layers+=layerlist[position:]
+    index+=list(range(position,len(layerlist)))
+    return (layers,index)
+
+
+def generateSublayerStack(layerlist, repeats=(), graded=False):
+    """
+    Function to calculate the sublayers used by the reflection calculation
+    when some blocks of layers are repeated
+
+    Args:
+        layerlist (list): incoming media, layers, and substrate
+        repeats (list): (first, last, repetitions) tuples, as in expand_repeats.
+            Blocks must not overlap, and cannot include incoming media or substrate
+        graded (bool): use GradedSublayer items at rough interfaces (see rough_sublayer)
+
+    Returns:
+        list: the sublayers of generateSublayers(expand_repeats(layerlist,repeats)[0]),
+            except that the identical periods inside a block appear only once,
+            as a SublayerRepeat. The first period of a block is written out,
+            since its top interface is with the layer above the block.
+    """
+    stack=[]
+    position=0
+    for first,last,repetitions in sorted(repeats):
+        if first<=position or last>len(layerlist)-2 or first>last:
+            raise ValueError('Repeated blocks must not overlap or include incoming media and substrate')
+        #everything up to the last layer of the first period
+        for i in range(position,last):
+            stack+=rough_sublayer(layerlist[i],layerlist[i+1],graded)[0]
+        if repetitions>1:
+            #the period starts at the interface with the previous period
+            period=rough_sublayer(layerlist[last],layerlist[first],graded)[0]
+            for i in range(first,last):
+                period+=rough_sublayer(layerlist[i],layerlist[i+1],graded)[0]
+            stack.append(SublayerRepeat(period,repetitions-1))
+        position=last
+    for i in range(position,len(layerlist)-1):
+        stack+=rough_sublayer(layerlist[i],layerlist[i+1],graded)[0]
+    return stack
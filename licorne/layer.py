@@ -57,6 +57,9 @@ class Layer(object):
     A Layer object is a container for properties (including fitting)
     for a single layer
     """
+    #layers saved before tables were introduced have no instance attribute
+    _nsld_table=None
+
     def __init__(self,thickness=0.,
                  nsld_real=0.,
                  nsld_imaginary=0.,
@@ -66,7 +69,8 @@ class Layer(object):
                  roughness=0.,
                  roughness_model=RoughnessModel.NONE,
                  sublayers=0,
-                 name=''):
+                 name='',
+                 nsld_table=None):
         """
         Create a layer with the following parameters:
         - thickness: thickness
@@ -79,6 +83,8 @@ class Layer(object):
         - roughess_model: model for the roughness, one of RoughnessModel types
         - sublayers: number of sublayers at the upper surface used to calculate roughness
         - name: an optional string to use as the name of the layer
+        - nsld_table: optional (wavelength, nsld) table, for materials with
+          a wavelength dependent nsld (e.g. absorbing isotopes). See nsld_at
         Numerical parameters have minimum/maximum values that are going
         to be used for fitting. To input just the value, just enter a single number.
         To input the value, minimum and maximum, you should enter a 
@@ -92,6 +98,7 @@ class Layer(object):
         self._roughness_model=roughness_model
         self._sublayers=sublayers
         self._name=name
+        self.nsld_table=nsld_table
 
     def __repr__(self):
         s=[]
@@ -100,6 +107,8 @@ class Layer(object):
             s.append(x.__repr__())
         s.append("roughness_model: {0}".format(self._roughness_model))
         s.append("sublayers: {0}".format(self._sublayers))
+        if self._nsld_table is not None:
+            s.append("nsld_table: {0} wavelengths".format(len(self._nsld_table[0])))
         return '\n '.join(s)
 
     name = property(operator.attrgetter('_name'))
@@ -134,10 +143,35 @@ class Layer(object):
         self._nsld_real.value=v.real
         self._nsld_imaginary.value=v.imag
 
+    nsld_table = property(operator.attrgetter('_nsld_table'))
+    @nsld_table.setter
+    def nsld_table(self,v):
+        if v is None:
+            self._nsld_table = None
+            return
+        wavelength,nsld=v
+        wavelength=np.asarray(wavelength,dtype=np.float64)
+        nsld=np.asarray(nsld,dtype=np.complex128)
+        if wavelength.ndim!=1 or wavelength.shape!=nsld.shape or len(wavelength)==0:
+            raise ValueError('nsld_table must be two 1D arrays of the same length')
+        order=np.argsort(wavelength)
+        self._nsld_table = (wavelength[order],nsld[order])
+
+    def nsld_at(self,wavelength):
+        """
+        nsld at the given wavelengths: the nsld_table interpolated linearly
+        (and held constant outside of it), or the nsld if there is no table
+        """
+        if self._nsld_table is None:
+            return self.nsld
+        table_wavelength,table_nsld=self._nsld_table
+        wavelength=np.asarray(wavelength,dtype=np.float64)
+        return np.interp(wavelength,table_wavelength,table_nsld.real)+1j*np.interp(wavelength,table_wavelength,table_nsld.imag)
+
     msld = property(operator.attrgetter('_msld'))
     @msld.setter
     def msld(self,v):
-        self._msld = MSLD(*v)
+        self._msld = v if isinstance(v,MSLD) else MSLD(*v)
 
     roughness = property(operator.attrgetter('_roughness'))
     @roughness.setter
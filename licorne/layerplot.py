@@ -16,6 +16,7 @@ class layerplot(QtWidgets.QWidget):
     def __init__(self, *args):
         QtWidgets.QWidget.__init__(self, *args)
         self.sample=[Layer(thickness=np.inf),Layer(thickness=np.inf)]
+        self.layer_index=None
         self.setLayout(QtWidgets.QVBoxLayout())
         function_options=['NSLD_REAL','NSLD_IMAGINARY','MSLD_RHO','MSLD_THETA','MSLD_PHI','ROUGHNESS']
         self.combo = QtWidgets.QComboBox(self)
@@ -37,15 +38,14 @@ class layerplot(QtWidgets.QWidget):
         self.canvas.setGeometry(self.paintwidget.rect())
 
     def updateSample(self,newsamplemodel):
-        ll=copy.deepcopy(newsamplemodel.layers)
-        ll.append(newsamplemodel.substrate)
-        ll.insert(0,newsamplemodel.incoming_media)
-        self.sample=ll
-        self.canvas.updateLF(self.sample,self.function)
+        #repeated blocks are plotted as the full profile
+        ll,self.layer_index=newsamplemodel.expanded_layers()
+        self.sample=copy.deepcopy(ll)
+        self.canvas.updateLF(self.sample,self.function,self.layer_index)
 
     def functionSelected(self,text):
         self.function=text
-        self.canvas.updateLF(self.sample,self.function)
+        self.canvas.updateLF(self.sample,self.function,self.layer_index)
 
 
 class PlotCanvas(FigureCanvas):
@@ -55,6 +55,7 @@ class PlotCanvas(FigureCanvas):
         self.ax = self.fig.add_subplot(111)
         self.fig.patch.set_facecolor('white')
         self.corresponding=[]
+        self.layer_index=None
         FigureCanvas.__init__(self, self.fig)
         self.setParent(parent)
         FigureCanvas.setSizePolicy(self,
@@ -65,9 +66,10 @@ class PlotCanvas(FigureCanvas):
         self.fig.canvas.mpl_connect('pick_event', self.onpick)
 
  
-    def updateLF(self,newlayers,newfunction):
+    def updateLF(self,newlayers,newfunction,layer_index=None):
         self.data=newlayers
         self.variable=newfunction
+        self.layer_index=layer_index
         self.plot()
 
     def onpick(self,event):
@@ -84,13 +86,17 @@ class PlotCanvas(FigureCanvas):
         return True
 
     def plot(self):
-        sublayers,self.corresponding=plot_sublayers(self.ax, self.data, parameter=self.variable)
+        sublayers,self.corresponding=plot_sublayers(self.ax, self.data, parameter=self.variable,
+                                                    layer_index=self.layer_index)
         self.fig.tight_layout()
         self.draw()
 
 
-def plot_sublayers(ax, layers, parameter='NSLD_REAL'):
+def plot_sublayers(ax, layers, parameter='NSLD_REAL', layer_index=None):
     sublayers,corresponding=generateSublayers(layers)
+    if layer_index is not None:
+        #map layers of an expanded sample back to the layers of the model
+        corresponding=[layer_index[c] for c in corresponding]
     thick=[sl.thickness.value for sl in sublayers]
     depth=np.array(thick)
     try:
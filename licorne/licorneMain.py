@@ -86,6 +86,8 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
 
         self.data_manager = data_manager_widget.data_manager()
         self.resolution_selector = licorne.resolutionselector.resolutionselector()
+        # resolution matrices by (Q, sigma), reused while the data and resolution do not change
+        self.resolution_cache = licorne.reflection.ResolutionCache()
 
         self.update_sample_model(sample_model)
 
@@ -137,7 +139,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             files_to_zip.append(os.path.join(folder,'layers.txt'))
             #save sublayers
             with open(os.path.join(folder,'sublayers.txt'),'wb') as f:
-                layers = [self.sample_model.incoming_media] + self.sample_model.layers + [self.sample_model.substrate]
+                layers = self.sample_model.expanded_layers()[0]
                 sublayers = licorne.generateSublayers.generateSublayers(layers)[0]
                 values=[[sl.thickness.value, sl.nsld_real.value,
                          sl.nsld_imaginary.value, sl.msld.rho.value,
@@ -280,9 +282,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
     def save_state_yaml(self, filename):
         state = {}
         if self.sample_model is not None:
-            state['model'] = dict(layers=self.sample_model.layers,
-                                  incoming_media=self.sample_model.incoming_media,
-                                  substrate=self.sample_model.substrate)
+            state['model'] = self.sample_model.state()
         if self.data_model is not None:
             state['experimental_data'] = dict(datasets=self.data_model.datasets,
                                               background=self.data_model.background,
@@ -291,6 +291,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         resolution_filename = os.path.join(lu.tempdir().get_tempdir(),'resolution.py')
         with open(resolution_filename) as rf:
             state['resolution'] = rf.read()
+        state['resolution_nodes'] = lu.get_resolution_nodes()
         try:
             with open(filename, 'w') as f:
                 yaml.dump(state, f)
@@ -308,13 +309,11 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
 
     def load_state_yaml(self,file_name):
         with open(file_name,'r') as f:
-            state=yaml.load(f)
+            state=yaml.load(f, Loader=yaml.Loader)
 
         if 'model' in state.keys():
             temp_sample_model=licorne.SampleModel.SampleModel()
-            temp_sample_model.layers=state['model']['layers']
-            temp_sample_model.incoming_media=state['model']['incoming_media']
-            temp_sample_model.substrate=state['model']['substrate']
+            temp_sample_model.set_state(state['model'])
             self.selection = []
             self.refresh(temp_sample_model)
 
@@ -331,6 +330,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             rf.write(state['resolution'])
         self.data_manager.resolution_dialog.comboBox_resolution_mode.setCurrentIndex(2)  # custom
         self.data_manager.resolution_dialog.resolution_mode_changed('Custom')
+        self.data_manager.resolution_dialog.spinBox_nodes.setValue(state.get('resolution_nodes', 0))
 
         self.update_data_figure()
 
@@ -381,39 +381,63 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             string_list.append('{0}\t{0}.{1}\t{2}'.format(name, p, t))
         self.fit_parameters_textEdit.setText('\n'.join(string_list))
 
+    def _reflectivity(self, Q, channels, weights, states, **options):
+        """
+        Spin averaged reflectivity of the datasets in channels, which share the
+        Q grid, averaged over the states of the sample (see SampleModel.sample_states)
+        """
+        pol_eff = np.ones(len(Q), dtype=np.complex128)
+        an_eff = np.ones(len(Q), dtype=np.complex128)
+        n1 = [ds.pol_Polarizer for ds in channels]
+        n2 = [ds.pol_Analyzer for ds in channels]
+        if len(states) > 1:
+            R = licorne.reflection.reflection_domains(Q, states, wavelength=options.get('wavelength'))
+            return np.real(licorne.reflection.spin_av_domains(R, weights, n1, n2, pol_eff, an_eff))
+        R = licorne.reflection.reflection(Q, states[0], **options)
+        return np.real(licorne.reflection.spin_av_multi(R, n1, n2, pol_eff, an_eff))
+
+    def _resolved_reflectivity(self, Q, channels, weights, states, **options):
+        """
+        _reflectivity with the resolution applied, either to the reflectivity at Q
+        or, with Gauss-Hermite nodes (see utilities.get_resolution_nodes), at the nodes around Q.
+        The wavelength of the points, for layers with tabulated nsld, is given by the resolution module.
+        """
+        import resolution
+        sigma = resolution.resolution(Q)
+        nodes = lu.get_resolution_nodes()
+        if nodes:
+            op = self.resolution_cache.gauss_hermite(Q, sigma, nodes)
+            return op(self._reflectivity(op.q, channels, weights, states,
+                                         wavelength=lu.get_wavelength(op.q), **options))
+        return self.resolution_cache(self._reflectivity(Q, channels, weights, states,
+                                                        wavelength=lu.get_wavelength(Q), **options), Q, sigma)
+
     def calculate_reflectivity(self):
-        layers = [self.sample_model.incoming_media] + self.sample_model.layers + [self.sample_model.substrate]
-        sublayers = licorne.generateSublayers.generateSublayers(layers)[0]
-        for ds in self.data_model.datasets:
-            Q = ds.Q / 2.
-            R = licorne.reflection.reflection(Q, sublayers)
-            pol_eff = np.ones(len(Q), dtype=np.complex128)
-            an_eff = np.ones(len(Q), dtype=np.complex128)
-            RR = np.real(licorne.reflection.spin_av(R, ds.pol_Polarizer, ds.pol_Analyzer, pol_eff, an_eff))
-            import resolution
-            sigma = resolution.resolution(Q)
-            RRr = licorne.reflection.resolut(RR, Q, sigma, 4)
-            ds.R_calc = RRr
+        weights, states = self.sample_model.sample_states()
+        for Q, indices in lu.group_by_q(self.data_model.datasets):
+            Q = Q / 2.
+            channels = [self.data_model.datasets[i] for i in indices]
+            RR = self._resolved_reflectivity(Q, channels, weights, states)
+            for ds, RR_ds in zip(channels, RR):
+                ds.R_calc = RR_ds
 
     def calculate_residuals(self, parameters):
         sm = copy.deepcopy(self.sample_model)
         ma = ModelAdapter(sm)
         ma.update_model_from_params(parameters)
-        layers = [sm.incoming_media] + sm.layers + [sm.substrate]
-        sublayers = licorne.generateSublayers.generateSublayers(layers)[0]
-        chi_array = []
-        for ds in self.data_model.datasets:
-            if ds.R is not None and len(ds.R) > 1:
-                Q = ds.Q / 2.
-                R = licorne.reflection.reflection(Q, sublayers)
-                pol_eff = np.ones(len(Q), dtype=np.complex128)
-                an_eff = np.ones(len(Q), dtype=np.complex128)
-                RR = np.real(licorne.reflection.spin_av(R, ds.pol_Polarizer, ds.pol_Analyzer, pol_eff, an_eff))
-                import resolution
-                sigma = resolution.resolution(Q)
-                RRr = licorne.reflection.resolut(RR, Q, sigma, 4)*self.data_model.theory_factor+self.data_model.background
-                chi_array.append((RRr/self.data_model.experiment_factor - ds.R) / ds.E)
-        chi = np.array(chi_array).ravel()
+        weights, states = sm.sample_states()
+        chi_array = {}
+        for Q, indices in lu.group_by_q(self.data_model.datasets):
+            indices = [i for i in indices if self.data_model.datasets[i].R is not None and len(self.data_model.datasets[i].R) > 1]
+            if not indices:
+                continue
+            Q = Q / 2.
+            channels = [self.data_model.datasets[i] for i in indices]
+            RR = self._resolved_reflectivity(Q, channels, weights, states)
+            for i, ds, RR_ds in zip(indices, channels, RR):
+                RRr = RR_ds*self.data_model.theory_factor+self.data_model.background
+                chi_array[i] = (RRr/self.data_model.experiment_factor - ds.R) / ds.E
+        chi = np.concatenate([chi_array[i] for i in sorted(chi_array)]) if chi_array else np.array([])
         print((chi ** 2).mean())
         return chi
 
@@ -25,11 +25,14 @@ class ModelAdapter(object):
         output = ''
         return output
 
-    def params_from_model(self):
+    def _parameters(self):
         """
-        Generate a parameter set with a given layer model.
+        (name, owner, parameter) for every numeric parameter of the sample model,
+        in the order of the parameter set: those of the layers (incoming media
+        first, substrate last), then the weight and magnetization of the domains.
+        The name starts with the name of the owner, the layer or domain.
         """
-        params = Parameters()
+        parameters = []
         all_layers = [self.sample_model.incoming_media] + self.sample_model.layers + [self.sample_model.substrate]
         attribute_list=['thickness','nsld_real','nsld_imaginary','msld','roughness']
         msld_attribute_list=['rho','theta','phi']
@@ -41,41 +44,48 @@ class ModelAdapter(object):
                 num_par = l.__getattribute__(attribute)
                 if attribute == 'msld':
                     for msld_attribute in msld_attribute_list:
-                        msld_par=num_par.__getattribute__(msld_attribute)
-                        par = convert_to_parameter(msld_par,'.'.join([l_name,'msld',msld_attribute]))
-                        params[par.name.replace('.','___').replace(' ','__')] = par
+                        parameters.append(('.'.join([l_name,'msld',msld_attribute]), l,
+                                           num_par.__getattribute__(msld_attribute)))
                 else:
-                    par = convert_to_parameter(num_par,'.'.join([l_name,attribute]))
-                    params[par.name.replace('.','___').replace(' ','__')] = par
+                    parameters.append(('.'.join([l_name,attribute]), l, num_par))
+        for i, d in enumerate(self.sample_model.domains):
+            d_name = d.name
+            if d_name == '':
+                d_name = 'Domain{0}'.format(i)
+            parameters.append(('.'.join([d_name,'weight']), d, d.weight))
+            for j in sorted(d.msld):
+                for msld_attribute in msld_attribute_list:
+                    parameters.append(('.'.join([d_name,'msld{0}'.format(j),msld_attribute]), d,
+                                       d.msld[j].__getattribute__(msld_attribute)))
+        return parameters
+
+    def params_from_model(self):
+        """
+        Generate a parameter set with a given layer model.
+        """
+        params = Parameters()
+        for name, owner, num_par in self._parameters():
+            par = convert_to_parameter(num_par, name)
+            params[par.name.replace('.','___').replace(' ','__')] = par
         return params
 
+    def numeric_parameter(self, params, key):
+        """
+        The parameter object of the sample model that corresponds to params[key]
+        """
+        i = list(params.keys()).index(key)
+        return self._parameters()[i][2]
+
     def update_model_from_params(self,params):
-        for i, p in enumerate(params):
+        for p, (name, owner, num_par) in zip(params, self._parameters()):
             name = params[p].name.replace('___', '.').replace('__', ' ')
-            if i//7 == 0:
-                layer = self.sample_model.incoming_media
-            elif i//7 == len(params)//7-1:
-                layer = self.sample_model.substrate
-            else:
-                layer = self.sample_model.layers[i//7-1]
-            layer.name=name.split('.')[0]
-            property_name = name.split(layer.name+'.')[1]
-            if 'msld' in property_name:
-                msld_property_name = property_name.split('.')[1]
-                layer.msld.__getattribute__(msld_property_name).name=msld_property_name
-                layer.msld.__getattribute__(msld_property_name).value=params[p].value
-                layer.msld.__getattribute__(msld_property_name).minimum=params[p].min
-                layer.msld.__getattribute__(msld_property_name).maximum=params[p].max
-                layer.msld.__getattribute__(msld_property_name).vary=params[p].vary
-                layer.msld.__getattribute__(msld_property_name).expr=params[p].expr
-            else:
-                layer.__getattribute__(property_name).name=property_name
-                layer.__getattribute__(property_name).value=params[p].value
-                layer.__getattribute__(property_name).minimum=params[p].min
-                layer.__getattribute__(property_name).maximum=params[p].max
-                layer.__getattribute__(property_name).vary=params[p].vary
-                layer.__getattribute__(property_name).expr=params[p].expr
-
+            owner.name=name.split('.')[0]
+            num_par.name=name.split('.')[-1]
+            num_par.value=params[p].value
+            num_par.minimum=params[p].min
+            num_par.maximum=params[p].max
+            num_par.vary=params[p].vary
+            num_par.expr=params[p].expr
 
 if __name__ == "__main__":
     from licorne.SampleModel import SampleModel
@@ -0,0 +1,139 @@
+#pylint: disable=invalid-name, not-an-iterable
+"""
+Numba compiled kernels for the reflection calculation.
+Each Q point is computed in one fused loop over the sublayers, with the
+matrices held in small local arrays, and the Q points are distributed over
+the cores with prange. The compiled code is cached on disk (cache=True),
+so it is only compiled the first time a kernel is used.
+Importing this module raises ImportError if numba is not installed.
+"""
+import numpy as np
+import numba
+
+@numba.njit(cache=True)
+def _pauli_block(f_plus, f_minus, B1, B2, B3, Bmod, out, r, c):
+    """ Write f(A + B.sigma) into the 2x2 block of out at row r, column c """
+    F0 = (f_plus + f_minus) / 2.0
+    if Bmod == 0.0:
+        F1 = 0.0j
+    else:
+        F1 = (f_plus - f_minus) / (2.0 * Bmod)
+    out[r, c] = F0 + F1 * B3
+    out[r, c + 1] = F1 * complex(B1, -B2)
+    out[r + 1, c] = F1 * complex(B1, B2)
+    out[r + 1, c + 1] = F0 - F1 * B3
+
+
+@numba.njit(cache=True, parallel=True)
+def matrix_reflection(inc_moment, sub_moment, A, B1, B2, B3, th):
+    """
+    Reflection matrices, shape (2, 2, N), for the potentials of the sublayers
+    (see sublayer_potentials) and the wave vector in the substrate.
+    A has shape (L, N), a constant potential can be passed as a broadcast view.
+    """
+    N = inc_moment.shape[0]
+    R = np.empty((2, 2, N), dtype=np.complex128)
+    for i in numba.prange(N):
+        q2 = inc_moment[i] * inc_moment[i]
+        S = np.eye(4, dtype=np.complex128)
+        M = np.empty((4, 4), dtype=np.complex128)
+        P = np.empty((4, 4), dtype=np.complex128)
+        for j in range(th.shape[0]):
+            Bmod = np.sqrt(B1[j] * B1[j] + B2[j] * B2[j] + B3[j] * B3[j])
+            k_plus = np.sqrt(q2 - (A[j, i] + Bmod))
+            k_minus = np.sqrt(q2 - (A[j, i] - Bmod))
+            cos_plus = np.cos(k_plus * th[j])
+            sin_plus = np.sin(k_plus * th[j])
+            cos_minus = np.cos(k_minus * th[j])
+            sin_minus = np.sin(k_minus * th[j])
+            _pauli_block(cos_plus, cos_minus, B1[j], B2[j], B3[j], Bmod, M, 0, 0)
+            _pauli_block(sin_plus / k_plus, sin_minus / k_minus, B1[j], B2[j], B3[j], Bmod, M, 0, 2)
+            _pauli_block(-k_plus * sin_plus, -k_minus * sin_minus, B1[j], B2[j], B3[j], Bmod, M, 2, 0)
+            for a in range(2):
+                for b in range(2):
+                    M[2 + a, 2 + b] = M[a, b]
+            for a in range(4):
+                for b in range(4):
+                    acc = 0.0j
+                    for k in range(4):
+                        acc += M[a, k] * S[k, b]
+                    P[a, b] = acc
+            S, P = P, S
+        a = 1j * sub_moment[i]
+        b = inc_moment[i] * sub_moment[i]
+        c = 1j * inc_moment[i]
+        D = np.empty((2, 2), dtype=np.complex128)
+        U = np.empty((2, 2), dtype=np.complex128)
+        for r in range(2):
+            for s in range(2):
+                D[r, s] = a * S[r, s] + b * S[r, 2 + s] - S[2 + r, s] + c * S[2 + r, 2 + s]
+                U[r, s] = -a * S[r, s] + b * S[r, 2 + s] + S[2 + r, s] + c * S[2 + r, 2 + s]
+        det = D[0, 0] * D[1, 1] - D[0, 1] * D[1, 0]
+        for s in range(2):
+            R[0, s, i] = (D[1, 1] * U[0, s] - D[0, 1] * U[1, s]) / det
+            R[1, s, i] = (D[0, 0] * U[1, s] - D[1, 0] * U[0, s]) / det
+    return R
+
+
+@numba.njit(cache=True, parallel=True)
+def scalar_reflection(inc_moment, sub_moment, V, th):
+    """
+    Reflection amplitudes, shape (C, N), of C spin channels that do not mix,
+    for the potentials V, shape (C, L, N), of the sublayers
+    """
+    N = inc_moment.shape[0]
+    r = np.empty((V.shape[0], N), dtype=np.complex128)
+    for i in numba.prange(N):
+        q2 = inc_moment[i] * inc_moment[i]
+        a = 1j * sub_moment[i]
+        b = inc_moment[i] * sub_moment[i]
+        c = 1j * inc_moment[i]
+        for ch in range(V.shape[0]):
+            m00 = 1.0 + 0.0j
+            m01 = 0.0j
+            m10 = 0.0j
+            m11 = 1.0 + 0.0j
+            for j in range(th.shape[0]):
+                k = np.sqrt(q2 - V[ch, j, i])
+                cs = np.cos(k * th[j])
+                sn = np.sin(k * th[j])
+                p = sn / k
+                t = -k * sn
+                m00, m10 = cs * m00 + p * m10, t * m00 + cs * m10
+                m01, m11 = cs * m01 + p * m11, t * m01 + cs * m11
+            down = a * m00 + b * m01 - m10 + c * m11
+            up = -a * m00 + b * m01 + m10 + c * m11
+            r[ch, i] = up / down
+    return r
+
+
+@numba.njit(cache=True, parallel=True)
+def spin_av(R, n1, n2, pol_eff, an_eff):
+    """ Tr(rho1 R^+ rho2 R) / 4 for the spin density matrices rho of n1 and n2 """
+    N = R.shape[2]
+    out = np.empty(N, dtype=np.complex128)
+    for i in numba.prange(N):
+        p00 = 1.0 + n1[2] * pol_eff[i]
+        p01 = complex(n1[0], -n1[1]) * pol_eff[i]
+        p10 = complex(n1[0], n1[1]) * pol_eff[i]
+        p11 = 1.0 - n1[2] * pol_eff[i]
+        q00 = 1.0 + n2[2] * an_eff[i]
+        q01 = complex(n2[0], -n2[1]) * an_eff[i]
+        q10 = complex(n2[0], n2[1]) * an_eff[i]
+        q11 = 1.0 - n2[2] * an_eff[i]
+        r00 = R[0, 0, i]
+        r01 = R[0, 1, i]
+        r10 = R[1, 0, i]
+        r11 = R[1, 1, i]
+        # rho2 R
+        t00 = q00 * r00 + q01 * r10
+        t01 = q00 * r01 + q01 * r11
+        t10 = q10 * r00 + q11 * r10
+        t11 = q10 * r01 + q11 * r11
+        # R^+ rho2 R
+        u00 = np.conj(r00) * t00 + np.conj(r10) * t10
+        u01 = np.conj(r00) * t01 + np.conj(r10) * t11
+        u10 = np.conj(r01) * t00 + np.conj(r11) * t10
+        u11 = np.conj(r01) * t01 + np.conj(r11) * t11
+        out[i] = (p00 * u00 + p01 * u10 + p10 * u01 + p11 * u11) / 4.0
+    return out
@@ -1,28 +1,121 @@
 #pylint: disable=invalid-name, protected-access, line-too-long
-from copy import deepcopy
+import atexit
+import warnings
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import numpy as np
+import scipy.sparse
+from licorne.generateSublayers import SublayerRepeat, GradedSublayer
+try:
+    from licorne import numba_kernels
+except ImportError:
+    numba_kernels = None
+
+## 'numba' runs reflection and spin_av with the compiled kernels
+## of numba_kernels when numba is installed, 'numpy' uses the array code below
+BACKEND = 'numpy' if numba_kernels is None else 'numba'
+
+
+def _use_numba(backend):
+    """ True if the numba kernels should be used for the given backend (None for BACKEND) """
+    if backend is None:
+        backend = BACKEND
+    if backend not in ('numpy', 'numba'):
+        raise ValueError("backend must be 'numpy' or 'numba'")
+    if backend == 'numba' and numba_kernels is None:
+        raise ImportError("the numba backend requires numba")
+    return backend == 'numba'
+
+
+def _element(i, j):
+    """ Property exposing one element of a stack of matrices as a view of the array """
+    def getter(self):
+        return self.data[i, j]
+
+    def setter(self, value):
+        self.data[i, j] = value
+    return property(getter, setter)
 
 
 class Mat(object):
-    def __init__(self, size):
-        self.oneone = np.zeros(size, dtype=np.complex128)
-        self.onetwo = np.zeros(size, dtype=np.complex128)
-        self.twoone = np.zeros(size, dtype=np.complex128)
-        self.twotwo = np.zeros(size, dtype=np.complex128)
+    """
+    Stack of 2x2 complex matrices, one per Q point.
+    Elements are stored in a single contiguous (2, 2, N) array,
+    and oneone, onetwo, twoone, twotwo are views into it.
+    """
+    def __init__(self, size=0, data=None):
+        if data is None:
+            data = np.zeros((2, 2, size), dtype=np.complex128)
+        self.data = data
+
+    oneone = _element(0, 0)
+    onetwo = _element(0, 1)
+    twoone = _element(1, 0)
+    twotwo = _element(1, 1)
 
     def __len__(self):
-        return len(self.oneone)
+        return self.data.shape[-1]
+
+
+def _block(i, j):
+    """ Property exposing one 2x2 block of a stack of 4x4 matrices as a Mat view """
+    def getter(self):
+        return Mat(data=self.data[2 * i:2 * i + 2, 2 * j:2 * j + 2])
+
+    def setter(self, value):
+        self.data[2 * i:2 * i + 2, 2 * j:2 * j + 2] = value.data
+    return property(getter, setter)
 
 
 class SMat(object):
-    def __init__(self, size):
-        self.M11 = Mat(size)
-        self.M12 = Mat(size)
-        self.M21 = Mat(size)
-        self.M22 = Mat(size)
+    """
+    Stack of 4x4 complex matrices, one per Q point, stored as a (4, 4, N) array.
+    M11, M12, M21, M22 are the 2x2 blocks, returned as Mat views.
+    """
+    def __init__(self, size=0, data=None):
+        if data is None:
+            data = np.zeros((4, 4, size), dtype=np.complex128)
+        self.data = data
+
+    M11 = _block(0, 0)
+    M12 = _block(0, 1)
+    M21 = _block(1, 0)
+    M22 = _block(1, 1)
 
     def __len__(self):
-        return len(self.M11)
+        return self.data.shape[-1]
+
+
+def _matmul(A, B, out, tmp=None):
+    """
+    Product of two stacks of square matrices with the matrix indices first,
+    i.e. out[i, j, ...] = sum_k A[i, k, ...] * B[k, j, ...]
+    Each row of the result is accumulated in place, so the only temporary
+    is tmp, which has the shape of a single row (B.shape[1:]).
+    out must not share memory with A or B.
+    """
+    if tmp is None:
+        tmp = np.empty(B.shape[1:], dtype=out.dtype)
+    n = A.shape[1]
+    for i in range(A.shape[0]):
+        np.multiply(A[i, 0], B[0], out=out[i])
+        for k in range(1, n):
+            np.multiply(A[i, k], B[k], out=tmp)
+            out[i] += tmp
+    return out
+
+
+def _inv2(A, out):
+    """ Inverse of a stack of 2x2 matrices stored as a (2, 2, ...) array """
+    D = A[0, 0] * A[1, 1] - A[0, 1] * A[1, 0]
+    np.divide(A[1, 1], D, out=out[0, 0])
+    np.divide(A[0, 0], D, out=out[1, 1])
+    np.divide(A[0, 1], D, out=out[0, 1])
+    np.divide(A[1, 0], D, out=out[1, 0])
+    out[0, 1] *= -1.0
+    out[1, 0] *= -1.0
+    return out
 
 
 def s_moment(A, inc_moment2):
@@ -30,511 +123,1745 @@ def s_moment(A, inc_moment2):
     return np.sqrt(T)
 
 
-def s_cos(A, thickness, inc_moment2):
-    T = s_moment(A, inc_moment2) * thickness
-    return np.cos(T)
+def _no_field(Bmod):
+    """ True for a single sublayer without magnetic potential """
+    return np.ndim(Bmod) == 0 and Bmod == 0.0
 
 
-def s_sin(A, thickness, inc_moment2):
-    T = s_moment(A, inc_moment2) * thickness
-    return np.sin(T)
+def eigen_moments(A, Bmod, inc_moment2):
+    """
+    Wave vectors inside a sublayer.
+    The potential A + B.sigma has eigenvalues A + Bmod and A - Bmod,
+    so two square roots give the wave vectors for both spin eigenstates.
+    A and Bmod are scalars for one sublayer, or (L, 1) arrays for a stack.
+    """
+    k_plus = s_moment(A + Bmod, inc_moment2)
+    if _no_field(Bmod):
+        return k_plus, k_plus
+    return k_plus, s_moment(A - Bmod, inc_moment2)
 
 
-def p_cos(A, B1, B2, B3, th, inc_moment2):
-    Bmod = np.sqrt(np.square(B1) + np.square(B2) + np.square(B3))
-    Out = Mat(len(inc_moment2))
-    if Bmod != 0.0:
-        Arg_plus = A + Bmod
-        Arg_minus = A - Bmod
-        F_plus = (s_cos(Arg_plus, th, inc_moment2) + s_cos(Arg_minus, th, inc_moment2)) / 2.0
-        F_minus = (s_cos(Arg_plus, th, inc_moment2) - s_cos(Arg_minus, th, inc_moment2)) / (2.0 * Bmod)
-        Out.oneone = F_plus + B3 * F_minus
-        Out.onetwo = complex(B1, -B2) * F_minus
-        Out.twoone = complex(B1, B2) * F_minus
-        Out.twotwo = F_plus - B3 * F_minus
-    else:
-        T = s_cos(A, th, inc_moment2)
-        Out.oneone = np.copy(T)
-        Out.onetwo.fill(0.0)
-        Out.twoone.fill(0.0)
-        Out.twotwo = T
-    return Out
+def pauli_combine(f_plus, f_minus, B1, B2, B3, Bmod, out, scratch=None):
+    """
+    Write the 2x2 matrix function f(A + B.sigma) into out, given the values
+    f_plus, f_minus of the scalar function on the two eigenvalues A +/- Bmod
+    :param scratch: optional array of shape (2,) + out.shape[2:] for the
+        coefficients of the Pauli decomposition
+    """
+    if _no_field(Bmod):
+        out[0, 0] = f_plus
+        out[1, 1] = f_plus
+        out[0, 1] = 0.0
+        out[1, 0] = 0.0
+        return out
+    if scratch is None:
+        scratch = np.empty((2,) + np.broadcast(f_plus, f_minus).shape, dtype=np.complex128)
+    F_plus, F_minus = scratch
+    np.add(f_plus, f_minus, out=F_plus)
+    F_plus /= 2.0
+    # for sublayers without field f_plus == f_minus, so F_minus is 0
+    np.subtract(f_plus, f_minus, out=F_minus)
+    F_minus /= np.where(Bmod == 0.0, 1.0, 2.0 * Bmod) if np.ndim(Bmod) else 2.0 * Bmod
+    return _pauli(F_plus, F_minus, B1, B2, B3, out)
+
 
+def _pauli(F0, F1, B1, B2, B3, out):
+    """ Write F0 + F1 B.sigma into the (2, 2, ...) array out """
+    np.multiply(B3, F1, out=out[0, 0])
+    np.subtract(F0, out[0, 0], out=out[1, 1])
+    out[0, 0] += F0
+    np.multiply(B1 - 1j * B2, F1, out=out[0, 1])
+    np.multiply(B1 + 1j * B2, F1, out=out[1, 0])
+    return out
 
-def p_sin(A, B1, B2, B3, th, inc_moment2):
+
+def sublayer_matrix(A, B1, B2, B3, th, inc_moment2, out, scratch=None):
+    """
+    Transfer matrix of a constant sublayer, written into the (4, 4, N) array out.
+    The blocks are cos(K th), sin(K th)/K, -K sin(K th) and cos(K th), where
+    K = sqrt(inc_moment2 - A - B.sigma). All four are functions of the same
+    matrix, so they are derived from the two eigen wave vectors with one
+    cos/sin pair each.
+    Passing (L, 1) arrays for the potentials and thickness fills a
+    (4, 4, L, N) stack with the matrices of L sublayers at once.
+    :param scratch: optional complex array of shape (8,) + out.shape[2:]
+        for the intermediate results, so that no arrays are allocated
+    """
     Bmod = np.sqrt(np.square(B1) + np.square(B2) + np.square(B3))
-    Out = Mat(len(inc_moment2))
-    if Bmod > 0.0:
-        Arg_plus = A + Bmod
-        Arg_minus = A - Bmod
-        F_plus = (s_sin(Arg_plus, th, inc_moment2) + s_sin(Arg_minus, th, inc_moment2)) / 2.0
-        F_minus = (s_sin(Arg_plus, th, inc_moment2) - s_sin(Arg_minus, th, inc_moment2)) / (2.0 * Bmod)
-        Out.oneone = F_plus + B3 * F_minus
-        Out.onetwo = complex(B1, -B2) * F_minus
-        Out.twoone = complex(B1, B2) * F_minus
-        Out.twotwo = F_plus - B3 * F_minus
+    if scratch is None:
+        scratch = np.empty((8,) + out.shape[2:], dtype=np.complex128)
+    k_plus, k_minus, f_plus, sin_plus, f_minus, sin_minus = scratch[:6]
+    channels = [(A + Bmod, k_plus, f_plus, sin_plus)]
+    if _no_field(Bmod):
+        k_minus, f_minus, sin_minus = k_plus, f_plus, sin_plus
     else:
-        T = s_sin(A, th, inc_moment2)
-        Out.oneone = np.copy(T)
-        Out.onetwo.fill(0.0)
-        Out.twoone.fill(0.0)
-        Out.twotwo = T
-    return Out
+        channels.append((A - Bmod, k_minus, f_minus, sin_minus))
+    for potential, k, f, sin in channels:
+        np.subtract(inc_moment2, potential, out=k)
+        np.sqrt(k, out=k)
+        np.multiply(k, th, out=f)
+        np.sin(f, out=sin)
+        np.cos(f, out=f)
+    pauli_combine(f_plus, f_minus, B1, B2, B3, Bmod, out[:2, :2], scratch[6:])
+    out[2:, 2:] = out[:2, :2]
+    for potential, k, f, sin in channels:
+        np.divide(sin, k, out=f)
+    pauli_combine(f_plus, f_minus, B1, B2, B3, Bmod, out[:2, 2:], scratch[6:])
+    for potential, k, f, sin in channels:
+        np.multiply(k, sin, out=f)
+        np.negative(f, out=f)
+    pauli_combine(f_plus, f_minus, B1, B2, B3, Bmod, out[2:, :2], scratch[6:])
+    return out
 
 
-def mult_mm(A, B):
-    Out = Mat(len(A))
-    Out.oneone = A.oneone * B.oneone + A.onetwo * B.twoone
-    Out.onetwo = A.oneone * B.onetwo + A.onetwo * B.twotwo
-    Out.twoone = A.twoone * B.oneone + A.twotwo * B.twoone
-    Out.twotwo = A.twoone * B.onetwo + A.twotwo * B.twotwo
-    return Out
+def sublayer_matrix_derivatives(A, B1, B2, B3, th, inc_moment2):
+    """
+    Derivatives of the transfer matrix of one sublayer (see sublayer_matrix)
+    with respect to A, B1, B2, B3 and the thickness, as a (5, 4, 4, N) array.
+    The matrix depends analytically on A, so the derivative with respect
+    to the imaginary part of A is 1j times the first one.
+    Each block is a function f of the potential A + B.sigma; with F0 and
+    F1 the coefficients of f = F0 + F1 B.sigma, its derivative along B_i
+    is dF0/dB_i + dF1/dB_i B.sigma + F1 sigma_i.
+    """
+    Bmod = np.sqrt(B1 * B1 + B2 * B2 + B3 * B3)
+    no_field = Bmod == 0.0
+    b = 1.0 if no_field else Bmod
+    k = np.array(eigen_moments(A, Bmod, inc_moment2))
+    sin = np.sin(k * th)
+    cos = np.cos(k * th)
+    # the blocks cos(k th), sin(k th)/k, -k sin(k th) as functions of the eigenvalue
+    # of the potential, their derivatives along it (dk = -1/2k) and along th
+    blocks = (cos, sin / k, -k * sin)
+    d_potential = (th * sin / (2.0 * k), (sin - k * th * cos) / (2.0 * k ** 3), (sin + k * th * cos) / (2.0 * k))
+    d_thickness = (-k * sin, cos, -k * k * cos)
+    out = np.zeros((5, 4, 4, len(inc_moment2)), dtype=np.complex128)
+    sigma = (np.array([[0.0, 1.0], [1.0, 0.0]]), np.array([[0.0, -1j], [1j, 0.0]]), np.array([[1.0, 0.0], [0.0, -1.0]]))
+    for (r, c), f, df, dth in zip(((0, 0), (0, 1), (1, 0)), blocks, d_potential, d_thickness):
+        rows, cols = slice(2 * r, 2 * r + 2), slice(2 * c, 2 * c + 2)
+        pauli_combine(df[0], df[1], B1, B2, B3, Bmod, out[0, rows, cols])
+        pauli_combine(dth[0], dth[1], B1, B2, B3, Bmod, out[4, rows, cols])
+        if no_field:
+            F1 = df[0]
+            dF0 = dF1 = 0.0
+        else:
+            F1 = (f[0] - f[1]) / (2.0 * b)
+            dF0 = (df[0] - df[1]) / (2.0 * b)
+            dF1 = ((df[0] + df[1]) / 2.0 - F1) / (b * b)
+        for i, Bi in enumerate((B1, B2, B3)):
+            _pauli(dF0 * Bi, dF1 * Bi, B1, B2, B3, out[1 + i, rows, cols])
+            out[1 + i, rows, cols] += sigma[i][:, :, np.newaxis] * F1
+    out[:, 2:, 2:] = out[:, :2, :2]
+    return out
 
 
-def mult_nm(A, B):
-    Out = Mat(len(B))
-    Out.oneone = A * B.oneone
-    Out.onetwo = A * B.onetwo
-    Out.twoone = A * B.twoone
-    Out.twotwo = A * B.twotwo
-    return Out
+## memory (in bytes) that the stacked sublayer matrices may use in 'tree' mode
+TREE_MEMORY = 8 * 1024 * 1024
 
 
-def s_invmoment(A, inc_moment2):
-    T = inc_moment2 - A
-    T = np.sqrt(T)
-    T = np.reciprocal(T)
-    return T
+def tree_product(mats):
+    """
+    Ordered product mats[..., L-1, :] ... mats[..., 0, :] of a stack of
+    matrices with shape (n, n, L, N), reduced pairwise: neighbouring
+    matrices are multiplied in one vectorized call per level, so only
+    ceil(log2(L)) Python-level steps are needed.
+    Returns an (n, n, N) array.
+    """
+    while mats.shape[2] > 1:
+        pairs = mats.shape[2] // 2
+        prod = np.empty(mats.shape[:2] + (pairs,) + mats.shape[3:], dtype=mats.dtype)
+        _matmul(mats[:, :, 1:2 * pairs:2], mats[:, :, 0:2 * pairs:2], prod)
+        if mats.shape[2] % 2:
+            prod = np.concatenate((prod, mats[:, :, -1:]), axis=2)
+        mats = prod
+    return mats[:, :, 0]
 
 
-def p_moment(A, B1, B2, B3, inc_moment2):
-    Bmod = np.sqrt(np.square(B1) + np.square(B2) + np.square(B3))
-    Out = Mat(len(inc_moment2))
-    if Bmod != 0.0:
-        Arg_plus = A + Bmod
-        Arg_minus = A - Bmod
-        F_plus = (s_moment(Arg_plus, inc_moment2) + s_moment(Arg_minus, inc_moment2)) / 2.0
-        F_minus = (s_moment(Arg_plus, inc_moment2) - s_moment(Arg_minus, inc_moment2)) / (2.0 * Bmod)
-        Out.oneone = F_plus + B3 * F_minus
-        Out.onetwo = complex(B1, -B2) * F_minus
-        Out.twoone = complex(B1, B2) * F_minus
-        Out.twotwo = F_plus - B3 * F_minus
-    else:
-        T = s_moment(A, inc_moment2)
-        Out.oneone = np.copy(T)
-        Out.onetwo.fill(0.0)
-        Out.twoone.fill(0.0)
-        Out.twotwo = T
-    return Out
+def _identity(n, N):
+    """ (n, n, N) stack of identity matrices """
+    S = np.zeros((n, n, N), dtype=np.complex128)
+    for i in range(n):
+        S[i, i] = 1.0
+    return S
 
 
-def p_invmoment(A, B1, B2, B3, inc_moment2):
-    Bmod = np.sqrt(np.square(B1) + np.square(B2) + np.square(B3))
-    Out = Mat(len(inc_moment2))
-    if Bmod != 0.0:
-        Arg_plus = A + Bmod
-        Arg_minus = A - Bmod
-        F_plus = (s_invmoment(Arg_plus, inc_moment2) + s_invmoment(Arg_minus, inc_moment2)) / 2.0
-        F_minus = (s_invmoment(Arg_plus, inc_moment2) - s_invmoment(Arg_minus, inc_moment2)) / (2.0 * Bmod)
-        Out.oneone = F_plus + B3 * F_minus
-        Out.onetwo = complex(B1, -B2) * F_minus
-        Out.twoone = complex(B1, B2) * F_minus
-        Out.twotwo = F_plus - B3 * F_minus
-    else:
-        T = s_invmoment(A, inc_moment2)
-        Out.oneone = np.copy(T)
-        Out.onetwo.fill(0.0)
-        Out.twoone.fill(0.0)
-        Out.twotwo = T
+def _groups(L, N, n):
+    """
+    Slices of the sublayers such that the (n, n, group, N) stack of
+    their matrices fits in TREE_MEMORY
+    """
+    size = max(2, TREE_MEMORY // (16 * n * n * max(N, 1)))
+    return [slice(i, min(i + size, L)) for i in range(0, L, size)]
+
+
+def transfer_product(A, B1, B2, B3, th, inc_moment2, product='sequential', tree_points=None, workspace=None):
+    """
+    Ordered product of the transfer matrices of all sublayers, as a (4, 4, N) array.
+    Potentials of shape (L, K, 1) describe K stacks, and give a (4, 4, K, N) array.
+    A can also have shape (L, N), for a nuclear potential that depends on Q.
+    :param str product: 'sequential' multiplies one sublayer at a time;
+        'tree' builds the matrices of the sublayers as one stack and reduces
+        it with tree_product. Stacks larger than TREE_MEMORY are split into
+        groups of sublayers, and the group products are multiplied in order.
+    :param int tree_points: number of Q points the groups are sized for, when
+        inc_moment2 is a chunk of a larger array (default: len(inc_moment2)).
+        The groups set the order of the products, so this keeps the results
+        of a chunk identical to those for the whole array.
+    :param ReflectionWorkspace workspace: buffers for the sequential product of
+        a single stack; the result is then one of the workspace arrays
+    """
+    if workspace is not None and product == 'sequential' and B1.ndim == 1:
+        return _transfer_product_workspace(A, B1, B2, B3, th, inc_moment2, workspace)
+    # potentials of shape (L, K, 1) give K stacks at once, and (4, 4, K, N) products
+    shape = np.broadcast(np.empty(A.shape[1:]), inc_moment2).shape
+    S = _identity(4, int(np.prod(shape))).reshape((4, 4) + shape)
+    if len(th) == 0:
+        return S
+    if product == 'tree':
+        work = np.empty_like(S)
+        points = S[0, 0].size if tree_points is None else S[0, 0].size // len(inc_moment2) * tree_points
+        for g in _groups(len(th), points, 4):
+            stacked = [x[g] if x.ndim > 1 else x[g, np.newaxis] for x in (A, B1, B2, B3, th)]
+            mats = np.empty((4, 4, g.stop - g.start) + shape, dtype=np.complex128)
+            sublayer_matrix(*(stacked + [inc_moment2, mats]))
+            _matmul(tree_product(mats), S, work)
+            S, work = work, S
+        return S
+    if product != 'sequential':
+        raise ValueError("product must be 'sequential' or 'tree'")
+    # M, work and row are reused for every sublayer,
+    # so the loop does not allocate 4x4 stacks
+    M = np.empty_like(S)
+    work = np.empty_like(S)
+    row = np.empty((4,) + shape, dtype=np.complex128)
+    for j in range(len(th)):
+        sublayer_matrix(A[j], B1[j], B2[j], B3[j], th[j], inc_moment2, M)
+        _matmul(M, S, work, row)
+        S, work = work, S
+    return S
+
+
+def _transfer_product_workspace(A, B1, B2, B3, th, inc_moment2, workspace):
+    """ Sequential transfer_product written into the arrays of a ReflectionWorkspace """
+    S, work, M = workspace.matrices
+    S[...] = 0.0
+    for i in range(4):
+        S[i, i] = 1.0
+    scratch = workspace.scratch[:, 0]
+    for j in range(len(th)):
+        sublayer_matrix(A[j], B1[j], B2[j], B3[j], th[j], inc_moment2, M, scratch)
+        _matmul(M, S, work, workspace.row)
+        S, work = work, S
+    return S
+
+
+class ProductCache(object):
+    """
+    Segment tree of partial products of sublayer matrices, kept between calls
+    with the same Q (e.g. the residual evaluations of a fit).
+    Nodes are keyed by content: a leaf by the potentials of its sublayer,
+    an inner node by the keys of its two children. When k sublayers change,
+    only the nodes above them are missing, so the product costs
+    O(k log L) matrix products instead of O(L).
+    At most max_memory bytes of matrices are kept, the least recently used
+    nodes are dropped first. The cache is cleared when Q changes.
+    """
+    def __init__(self, max_memory=64 * 1024 * 1024):
+        self.max_memory = max_memory
+        self.memory = 0
+        self.products = 0
+        self._nodes = OrderedDict()
+        self._next_id = 0
+        self._inc_moment = None
+
+    def clear(self):
+        self._nodes.clear()
+        self.memory = 0
+
+    def check_q(self, inc_moment):
+        """ Clear the cache if inc_moment differs from the previous call """
+        if self._inc_moment is None or not np.array_equal(self._inc_moment, inc_moment):
+            self.clear()
+            self._inc_moment = np.array(inc_moment, copy=True)
+
+    def _lookup(self, key):
+        node = self._nodes.pop(key, None)
+        if node is not None:
+            # re-inserted as the most recently used
+            self._nodes[key] = node
+        return node
+
+    def _store(self, key, matrix):
+        node = (self._next_id, matrix)
+        self._next_id += 1
+        self._nodes[key] = node
+        self.memory += matrix.nbytes
+        while self.memory > self.max_memory and self._nodes:
+            self.memory -= self._nodes.popitem(last=False)[1][1].nbytes
+        return node
+
+    def product(self, keys, leaf_matrices):
+        """
+        Ordered product of the matrices of a run of sublayers.
+        :param list keys: hashable content key of each sublayer
+        :param leaf_matrices: function returning the stacked matrices,
+            shape (n, n, len(index), ...), of the sublayers in the index array
+        """
+        nodes = [self._lookup(key) for key in keys]
+        missing = [j for j, node in enumerate(nodes) if node is None]
+        if missing:
+            mats = leaf_matrices(np.array(missing))
+            self.products += len(missing)
+            for i, j in enumerate(missing):
+                nodes[j] = self._lookup(keys[j]) or self._store(keys[j], np.ascontiguousarray(mats[:, :, i]))
+        while len(nodes) > 1:
+            pairs = [(nodes[i], nodes[i + 1]) for i in range(0, len(nodes) - 1, 2)]
+            parents = [self._lookup((left[0], right[0])) for left, right in pairs]
+            missing = [i for i, node in enumerate(parents) if node is None]
+            if missing:
+                # the missing products of one level are done in a single call
+                lefts = np.stack([pairs[i][0][1] for i in missing], axis=2)
+                rights = np.stack([pairs[i][1][1] for i in missing], axis=2)
+                prod = _matmul(rights, lefts, np.empty_like(lefts))
+                self.products += len(missing)
+                for m, i in enumerate(missing):
+                    key = (pairs[i][0][0], pairs[i][1][0])
+                    parents[i] = self._lookup(key) or self._store(key, np.ascontiguousarray(prod[:, :, m]))
+            if len(nodes) % 2:
+                parents.append(nodes[-1])
+            nodes = parents
+        return nodes[0][1]
+
+
+def cached_transfer_product(cache, A, B1, B2, B3, th, inc_moment2):
+    """ transfer_product, with the partial products kept in a ProductCache """
+    if len(th) == 0:
+        return _identity(4, len(inc_moment2))
+    keys = list(zip(A.real.tolist(), A.imag.tolist(), B1.tolist(), B2.tolist(), B3.tolist(), th.tolist()))
+
+    def leaf_matrices(index):
+        col = np.newaxis
+        mats = np.empty((4, 4, len(index), len(inc_moment2)), dtype=np.complex128)
+        return sublayer_matrix(A[index, col], B1[index, col], B2[index, col], B3[index, col],
+                               th[index, col], inc_moment2, mats)
+    return cache.product(keys, leaf_matrices)
+
+
+def cached_scalar_product(cache, V, th, inc_moment2):
+    """ scalar_product, with the partial products kept in a ProductCache """
+    if len(th) == 0:
+        return _identity(2, V.shape[0] * len(inc_moment2)).reshape((2, 2, V.shape[0], len(inc_moment2)))
+    keys = [('scalar',) + tuple(v) + (t,) for v, t in zip(V.T.tolist(), th.tolist())]
+    return cache.product(keys, lambda index: scalar_matrices(V[:, index], th[index], inc_moment2))
+
+
+def mult_mm(A, B):
+    Out = Mat(data=np.empty(np.broadcast(A.data, B.data).shape, dtype=np.complex128))
+    _matmul(A.data, B.data, Out.data)
     return Out
 
 
+def mult_nm(A, B):
+    return Mat(data=A * B.data)
+
+
 def plus_mm(A, B):
-    Out = Mat(len(A))
-    Out.oneone = A.oneone + B.oneone
-    Out.onetwo = A.onetwo + B.onetwo
-    Out.twoone = A.twoone + B.twoone
-    Out.twotwo = A.twotwo + B.twotwo
-    return Out
+    return Mat(data=A.data + B.data)
 
 
 def mult_s(A, B):
-    Out = SMat(len(A))
-    Out.M11 = plus_mm(mult_mm(A.M11, B.M11), mult_mm(A.M12, B.M21))
-    Out.M12 = plus_mm(mult_mm(A.M11, B.M12), mult_mm(A.M12, B.M22))
-    Out.M21 = plus_mm(mult_mm(A.M21, B.M11), mult_mm(A.M22, B.M21))
-    Out.M22 = plus_mm(mult_mm(A.M21, B.M12), mult_mm(A.M22, B.M22))
+    Out = SMat(data=np.empty(np.broadcast(A.data, B.data).shape, dtype=np.complex128))
+    _matmul(A.data, B.data, Out.data)
     return Out
 
 
 def mult_vm(A, B):
-    Out = Mat(len(B))
-    Out.oneone = A * B.oneone
-    Out.onetwo = A * B.onetwo
-    Out.twoone = A * B.twoone
-    Out.twotwo = A * B.twotwo
-    return Out
+    return Mat(data=A * B.data)
 
 
 def inv(A):
-    Out = Mat(len(A))
-    D = A.oneone * A.twotwo - A.onetwo * A.twoone
-    Out.oneone = A.twotwo / D
-    Out.onetwo = -1.0 * A.onetwo / D
-    Out.twoone = -1.0 * A.twoone / D
-    Out.twotwo = A.oneone / D
-    return Out
+    return Mat(data=_inv2(A.data, np.empty_like(A.data)))
+
+
+def _layer_nsld(layer, wavelength):
+    """ nsld of a layer, as an array over the Q points if it is tabulated (see Layer.nsld_at) """
+    if wavelength is None or layer.nsld_table is None:
+        return layer.nsld
+    return layer.nsld_at(wavelength)
+
+
+def _potentials(inner, incoming_media_nsld, wavelength=None):
+    """
+    Potential arrays (A, B1, B2, B3, thickness) for a list of sublayers.
+    A has shape (L, N) if the nsld of any sublayer or of the incoming
+    media depends on the wavelength of the N points, (L,) otherwise.
+    """
+    if wavelength is None or (all(l.nsld_table is None for l in inner) and np.ndim(incoming_media_nsld) == 0):
+        nsld = np.array([l.nsld for l in inner], dtype=np.complex128)
+    else:
+        nsld = np.empty((len(inner), len(wavelength)), dtype=np.complex128)
+        for row, l in zip(nsld, inner):
+            row[...] = _layer_nsld(l, wavelength)
+    rho = np.array([l.msld.rho.value for l in inner], dtype=np.float64)
+    theta = np.deg2rad([l.msld.theta.value for l in inner])
+    phi = np.deg2rad([l.msld.phi.value for l in inner])
+    A = 4.0 * np.pi * (nsld - incoming_media_nsld)
+    B1 = 4.0 * np.pi * rho * np.sin(theta) * np.cos(phi)
+    B2 = 4.0 * np.pi * rho * np.sin(theta) * np.sin(phi)
+    B3 = 4.0 * np.pi * rho * np.cos(theta)
+    th = np.array([l.thickness.value for l in inner], dtype=np.float64)
+    return A, B1, B2, B3, th
+
+
+def sublayer_potentials(sublayers, wavelength=None):
+    """
+    Potentials of the sublayers between the incoming media and the substrate.
+    Returns arrays with one entry per sublayer: the nuclear part A (relative
+    to the incoming media), the magnetic vector components B1, B2, B3,
+    and the thickness. With the wavelength of each Q point, tabulated nsld
+    values are interpolated and A has one row per sublayer (see _potentials).
+    """
+    return _potentials(sublayers[1:-1], _layer_nsld(sublayers[0], wavelength), wavelength)
+
+
+def stack_segments(sublayers, wavelength=None):
+    """
+    Split the sublayers between the incoming media and the substrate into
+    segments: runs of plain sublayers, and periods of repeated blocks
+    (SublayerRepeat items, see generateSublayerStack).
+    Returns a list of (potentials, repetitions) tuples,
+    with potentials as returned by sublayer_potentials.
+    """
+    incoming_media_nsld = _layer_nsld(sublayers[0], wavelength)
+    segments = []
+    run = []
+    for item in sublayers[1:-1]:
+        if isinstance(item, SublayerRepeat):
+            if run:
+                segments.append((_potentials(run, incoming_media_nsld, wavelength), 1))
+                run = []
+            segments.append((_potentials(item.sublayers, incoming_media_nsld, wavelength), item.repetitions))
+        else:
+            run.append(item)
+    if run or not segments:
+        segments.append((_potentials(run, incoming_media_nsld, wavelength), 1))
+    return segments
+
+
+def is_collinear(B1, B2, B3):
+    """
+    True if every magnetic vector is zero or parallel to the polarization axis (z),
+    in which case the two spin channels do not mix
+    """
+    return bool(np.all(np.hypot(B1, B2) <= 1e-12 * np.abs(B3)))
+
+
+def matrix_power(M, n):
+    """
+    n-th power (n >= 1) of a stack of matrices with the matrix indices first,
+    by repeated squaring: O(log n) products
+    """
+    result = None
+    while True:
+        if n & 1:
+            result = M if result is None else _matmul(M, result, np.empty_like(M))
+        n >>= 1
+        if not n:
+            return result
+        M = _matmul(M, M, np.empty_like(M))
+
+
+def _segments_product(segments, segment_product):
+    """
+    Ordered product of the matrices of all segments. segment_product
+    returns the product for the potentials of one segment; repeated
+    periods are raised to their power with matrix_power.
+    """
+    S = None
+    for potentials, repetitions in segments:
+        P = segment_product(*potentials)
+        if repetitions > 1:
+            P = matrix_power(P, repetitions)
+        S = P if S is None else _matmul(P, S, np.empty_like(S))
+    return S
+
+
+## one sublayer of a stack in the array description used by reflection_batch
+STACK_DTYPE = np.dtype([('thickness', np.float64), ('nsld', np.complex128),
+                        ('msld_rho', np.float64), ('msld_theta', np.float64), ('msld_phi', np.float64)])
+
+
+def flatten_sublayers(sublayers):
+    """ Sublayer list with the SublayerRepeat items written out """
+    flat = []
+    for item in sublayers:
+        if isinstance(item, SublayerRepeat):
+            flat.extend(item.sublayers * item.repetitions)
+        else:
+            flat.append(item)
+    return flat
+
+
+def stack_array(stacks):
+    """
+    (K, L) array description (dtype STACK_DTYPE) of K sublayer lists,
+    with the incoming media in the first column and the substrate in the last.
+    Shorter stacks are padded before the substrate with zero thickness
+    slices of the incoming media, which have identity transfer matrices.
+    The array has no gradients, so GradedSublayer items raise ValueError.
+    """
+    stacks = [flatten_sublayers(sublayers) for sublayers in stacks]
+    if any(_graded(sublayers) for sublayers in stacks):
+        raise ValueError("stack_array does not describe GradedSublayer items, use reflection")
+    out = np.zeros((len(stacks), max(len(sublayers) for sublayers in stacks)), dtype=STACK_DTYPE)
+    for row, sublayers in zip(out, stacks):
+        row['nsld'] = sublayers[0].nsld
+        for j, l in enumerate(sublayers[:-1] + [None] * (len(row) - len(sublayers)) + sublayers[-1:]):
+            if l is not None:
+                row[j] = (l.thickness.value, l.nsld, l.msld.rho.value, l.msld.theta.value, l.msld.phi.value)
+    return out
+
+
+## number of (model, Q) points evaluated together by reflection_batch;
+## larger batches no longer fit in the processor cache and get slower
+BATCH_POINTS = 4096
+
+
+def reflection_batch(inc_moment, stacks, fast_path=True, product='sequential', backend=None):
+    """
+    Reflection amplitude matrices of K models on the same Q grid.
+    The models are evaluated together, every step of the calculation
+    runs on (K, N) arrays, in chunks of BATCH_POINTS points.
+    With the numba backend for stacks that mix the spin channels, or when
+    a chunk would only hold one model (more than BATCH_POINTS / 2 Q points),
+    the models are evaluated one after the other instead, as by reflection.
+    A list with GradedSublayer items (see stack_array) is evaluated model by model with reflection.
+    :param ndarray inc_moment: incoming wave vector (Q/2), shape (N,)
+    :param stacks: (K, L) array from stack_array, or a list of K sublayer lists
+    :param bool fast_path: use the scalar kernel for chunks where no stack mixes the spin channels
+    :param str product: 'sequential' or 'tree' (see transfer_product)
+    :param str backend: 'numpy' or 'numba' (default: BACKEND), see reflection
+    :return: Mat with data of shape (2, 2, K, N)
+    """
+    inc_moment = np.asarray(inc_moment, dtype=np.float64)
+    R = Mat(data=np.zeros((2, 2, len(stacks), len(inc_moment)), dtype=np.complex128))
+    if not isinstance(stacks, np.ndarray):
+        if _each_stack(R, inc_moment, stacks, fast_path, product, backend):
+            return R
+        stacks = stack_array(stacks)
+    size = max(1, BATCH_POINTS // max(len(inc_moment), 1))
+    numba = _rows_numba(stacks, fast_path, product, backend)
+    if numba or size == 1:
+        R.data[...] = _reflection_rows(inc_moment, stacks, fast_path, product, numba)
+        return R
+    for i in range(0, len(stacks), size):
+        R.data[:, :, i:i + size] = _reflection_batch(inc_moment, stacks[i:i + size], fast_path, product)
+    return R
+
+
+def _stack_potentials(stacks):
+    """ Potentials (A, B1, B2, B3, thickness) of a (K, L) stack array, as (K, L - 2) arrays """
+    inner = stacks[:, 1:-1]
+    theta = np.deg2rad(inner['msld_theta'])
+    phi = np.deg2rad(inner['msld_phi'])
+    A = 4.0 * np.pi * (inner['nsld'] - stacks['nsld'][:, :1])
+    B1 = 4.0 * np.pi * inner['msld_rho'] * np.sin(theta) * np.cos(phi)
+    B2 = 4.0 * np.pi * inner['msld_rho'] * np.sin(theta) * np.sin(phi)
+    B3 = 4.0 * np.pi * inner['msld_rho'] * np.cos(theta)
+    return A, B1, B2, B3, inner['thickness']
+
+
+def _rows_numba(stacks, fast_path, product, backend):
+    """
+    True if _reflection_rows should use the numba kernels. The scalar kernel
+    on (K, N) arrays is at least as fast as the compiled one, so they are
+    only used for stacks that mix the spin channels.
+    """
+    collinear = fast_path and is_collinear(*_stack_potentials(stacks)[1:4])
+    return _use_numba(backend) and product == 'sequential' and not collinear
+
+
+def _reflection_rows(inc_moment, stacks, fast_path, product, numba):
+    """ (2, 2, K, N) reflection matrices for a (K, L) stack array, one stack at a time """
+    R = np.empty((2, 2, len(stacks), len(inc_moment)), dtype=np.complex128)
+    A, B1, B2, B3, th = _stack_potentials(stacks)
+    for k in range(len(stacks)):
+        # the padding slices (zero thickness) have identity transfer matrices
+        keep = th[k] != 0.
+        potentials = tuple(x[k, keep] for x in (A, B1, B2, B3, th))
+        sub_nsld = stacks['nsld'][k, -1]
+        if numba:
+            R[:, :, k] = _numba_reflection(inc_moment, sub_nsld, potentials, fast_path).data
+        else:
+            R[:, :, k] = _reflection(inc_moment, sub_nsld, [(potentials, 1)], fast_path, product).data
+    return R
+
+
+def _reflection_batch(inc_moment, stacks, fast_path, product):
+    """ (2, 2, K, N) reflection matrices for a (K, L) stack array """
+    inc_moment2 = np.square(inc_moment)
+    sub_moment = np.sqrt(inc_moment2 - 4.0 * np.pi * stacks['nsld'][:, -1:])
+    A, B1, B2, B3, th = _stack_potentials(stacks)
+    K = len(stacks)
+    if fast_path and is_collinear(B1, B2, B3):
+        R = np.zeros((2, 2, K, len(inc_moment)), dtype=np.complex128)
+        if np.all(B3 == 0.0):
+            m = scalar_product(A, th, inc_moment2, product)
+            R[0, 0] = _scalar_interface(m, inc_moment, sub_moment)
+            R[1, 1] = R[0, 0]
+        else:
+            # both channels of all stacks in one scalar product
+            m = scalar_product(np.concatenate((A + B3, A - B3)), np.concatenate((th, th)), inc_moment2, product)
+            r = _scalar_interface(m, inc_moment, np.concatenate((sub_moment, sub_moment)))
+            R[0, 0] = r[:K]
+            R[1, 1] = r[K:]
+        return R
+    batch = lambda x: x.T[:, :, np.newaxis]
+    S = transfer_product(batch(A), batch(B1), batch(B2), batch(B3), batch(th), inc_moment2, product)
+    return _interface(S, inc_moment, sub_moment).data
+
+
+## (state, Q) points evaluated together by reflection_domains; the products
+## shared by the states are recomputed for each chunk of states
+DOMAIN_POINTS = 65536
+
+
+def reflection_domains(inc_moment, stacks, fast_path=True, product='sequential', backend=None, wavelength=None):
+    """
+    Reflection amplitude matrices of K states of one sample that differ in
+    a few sublayers, such as the magnetic domain states or the realizations
+    of the fluctuations of SampleModel.
+    The sublayers above the first and below the last sublayer that differs
+    between the states are multiplied once, and the ones in between are
+    evaluated for all states together, as in reflection_batch,
+    in chunks of DOMAIN_POINTS points.
+    If that range covers more than half of the sublayers, little is shared
+    and the states are evaluated one after the other (see reflection_batch).
+    The array description has constant potentials, so a list of states with
+    GradedSublayer items or tabulated nsld (see reflection, wavelength) is
+    evaluated state by state with reflection.
+    :param ndarray inc_moment: incoming wave vector (Q/2), shape (N,)
+    :param stacks: (K, L) array from stack_array, or a list of K sublayer lists
+    :param bool fast_path: use the scalar kernel if no state mixes the spin channels
+    :param str product: 'sequential' or 'tree' (see transfer_product)
+    :param str backend: 'numpy' or 'numba' (default: BACKEND), for the states
+        evaluated one after the other
+    :param ndarray wavelength: wavelength of each Q point, as in reflection
+    :return: Mat with data of shape (2, 2, K, N)
+    """
+    inc_moment = np.asarray(inc_moment, dtype=np.float64)
+    R = Mat(data=np.zeros((2, 2, len(stacks), len(inc_moment)), dtype=np.complex128))
+    if not isinstance(stacks, np.ndarray):
+        if _each_stack(R, inc_moment, stacks, fast_path, product, backend, wavelength):
+            return R
+        stacks = stack_array(stacks)
+    first, last = _differing_range(_stack_potentials(stacks))
+    if 2 * (last - first) > stacks.shape[1] - 2:
+        R.data[...] = _reflection_rows(inc_moment, stacks, fast_path, product,
+                                       _rows_numba(stacks, fast_path, product, backend))
+        return R
+    size = max(1, DOMAIN_POINTS // max(len(inc_moment), 1))
+    for i in range(0, len(stacks), size):
+        R.data[:, :, i:i + size] = _reflection_domains(inc_moment, stacks[i:i + size], fast_path, product)
+    return R
+
+
+def _graded(sublayers):
+    """ True if any of the sublayers is a GradedSublayer """
+    return any(isinstance(l, GradedSublayer) for l in sublayers)
+
+
+def _each_stack(R, inc_moment, stacks, fast_path, product, backend, wavelength=None):
+    """
+    Write the reflection of each of the sublayer lists stacks into R.data[:, :, k]
+    and return True, if stack_array does not describe them: they have
+    GradedSublayer items, or tabulated nsld and wavelength is given.
+    Return False otherwise.
+    """
+    flat = [flatten_sublayers(sublayers) for sublayers in stacks]
+    if not any(_graded(sublayers) or _tabulated(sublayers, wavelength) for sublayers in flat):
+        return False
+    for k, sublayers in enumerate(stacks):
+        R.data[:, :, k] = reflection(inc_moment, sublayers, fast_path, product, backend=backend,
+                                     wavelength=wavelength).data
+    return True
+
+
+def _tabulated(sublayers, wavelength):
+    """
+    True if any sublayer has an nsld_table and wavelength is given;
+    warns that the tables are ignored if wavelength is None
+    """
+    if all(l.nsld_table is None for l in sublayers):
+        return False
+    if wavelength is None:
+        warnings.warn("nsld_table is ignored without the wavelength of the Q points, the nsld value is used")
+        return False
+    return True
+
+
+def _differing_range(potentials):
+    """ First and one past the last sublayer whose potentials differ between the stacks """
+    differ = np.flatnonzero(np.any([np.any(x != x[:1], axis=0) for x in potentials], axis=0))
+    return (differ[0], differ[-1] + 1) if len(differ) else (0, 0)
+
+
+def _reflection_domains(inc_moment, stacks, fast_path, product):
+    """ (2, 2, K, N) reflection matrices for a (K, L) stack array of states of one sample """
+    inc_moment2 = np.square(inc_moment)
+    sub_moment = np.sqrt(inc_moment2 - 4.0 * np.pi * stacks['nsld'][:, -1:])
+    potentials = _stack_potentials(stacks)
+    first, last = _differing_range(potentials)
+    above = [x[0, :first] for x in potentials]
+    states = [x[:, first:last] for x in potentials]
+    below = [x[0, last:] for x in potentials]
+    K = len(stacks)
+    # below * states * above, with the shared products broadcast over the states
+    combine = lambda bottom, middle, top: _matmul(bottom[..., np.newaxis, :], _matmul(
+        middle, top[..., np.newaxis, :], np.empty_like(middle), np.empty(middle.shape[1:], dtype=middle.dtype)),
+        np.empty_like(middle))
+    if fast_path and is_collinear(*potentials[1:4]):
+        channels = lambda A, B1, B2, B3, th: scalar_product(np.array([A + B3, A - B3]), th, inc_moment2, product)
+        A, B1, B2, B3, th = states
+        # both channels of all states in one scalar product, as (2, 2, channel, state, N)
+        middle = scalar_product(np.concatenate((A + B3, A - B3)), np.concatenate((th, th)), inc_moment2, product)
+        middle = middle.reshape((2, 2, 2, K, len(inc_moment)))
+        R = np.zeros((2, 2, K, len(inc_moment)), dtype=np.complex128)
+        R[0, 0], R[1, 1] = _scalar_interface(combine(channels(*below), middle, channels(*above)),
+                                             inc_moment, sub_moment)
+        return R
+    batch = lambda x: x.T[:, :, np.newaxis]
+    middle = transfer_product(*([batch(x) for x in states] + [inc_moment2, product]))
+    S = combine(transfer_product(*(below + [inc_moment2, product])), middle,
+                transfer_product(*(above + [inc_moment2, product])))
+    return _interface(S, inc_moment, sub_moment).data
+
+
+def spin_av_domains(R, weights, n1, n2, pol_eff, an_eff):
+    """
+    Incoherent average of spin_av_multi over K states (e.g. magnetic domains
+    larger than the coherence length of the neutrons).
+    :param Mat R: reflection matrices of the states, data of shape (2, 2, K, N)
+    :param weights: weight of each state, normalized by their sum
+    :return: complex (C, N) array, as spin_av_multi
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    # spin_av_multi is linear in T, so the states are averaged before the sums over the pairs
+    T = np.tensordot(_spin_terms(R), weights / weights.sum(), axes=([2], [0]))
+    return _spin_sums(T, n1, n2, pol_eff, an_eff)
+
+
+## Q points per chunk when reflection runs on several threads:
+## the 4x4 temporaries of a chunk (256 bytes per point) stay in L2.
+## Short arrays are split in smaller chunks, down to THREAD_MIN_CHUNK,
+## so that all threads get work
+THREAD_CHUNK = 512
+THREAD_MIN_CHUNK = 64
+_thread_pools = {}
+
+
+def _thread_pool(threads):
+    """ Thread pool with the given number of workers, created on first use and kept """
+    if threads not in _thread_pools:
+        _thread_pools[threads] = ThreadPool(threads)
+    return _thread_pools[threads]
+
+
+@atexit.register
+def _close_thread_pools():
+    for pool in _thread_pools.values():
+        pool.close()
+        pool.join()
+    _thread_pools.clear()
+
+
+class ReflectionWorkspace(object):
+    """
+    Preallocated arrays for the reflection calculation on a grid of N Q points,
+    for repeated calls such as the residual evaluations of a fit.
+    reflection(..., workspace=workspace) writes the products, the intermediate
+    results and the returned matrix into these arrays, so the sequential
+    product does not allocate arrays per sublayer. The returned Mat is
+    workspace.R, and is overwritten by the next call with the same workspace.
+    """
+    def __init__(self, N):
+        self.N = N
+        # accumulated product, work array and sublayer matrix
+        self.matrices = np.empty((3, 4, 4, N), dtype=np.complex128)
+        self.row = np.empty((4, N), dtype=np.complex128)
+        # products of up to two scalar channels
+        self.scalar = np.empty((2, 2, 2, N), dtype=np.complex128)
+        self.scratch = np.empty((8, 2, N), dtype=np.complex128)
+        self.interface = np.empty((3, 2, 2, N), dtype=np.complex128)
+        self.R = Mat(N)
+
+    def check_q(self, inc_moment):
+        if len(inc_moment) != self.N:
+            raise ValueError("the workspace is for %d Q points, not %d" % (self.N, len(inc_moment)))
+
+
+def reflection(inc_moment, sublayers, fast_path=True, product='sequential', cache=None, threads=None,
+               backend=None, workspace=None, formalism='transfer', born_threshold=None,
+               wavelength=None):
+    """
+    Reflection amplitude matrix for a list of sublayers
+    (incoming media first, substrate last).
+    :param ndarray inc_moment: incoming wave vector (Q/2)
+    :param list sublayers: Layer objects. Periods of repeated blocks can be
+        given as SublayerRepeat items, their matrix is raised to the number
+        of repetitions instead of multiplying every copy.
+    :param bool fast_path: use the scalar kernel when the spin channels do not mix
+    :param str product: how the sublayer matrices are multiplied,
+        'sequential' or 'tree' (see transfer_product)
+    :param ProductCache cache: keep partial products between calls, so that
+        only the products involving changed sublayers are recomputed
+        (product is ignored then)
+    :param threads: split inc_moment in chunks and evaluate them on a thread
+        pool (numpy releases the GIL). True uses up to one thread per core,
+        an int sets the number of threads. Every point is computed with the
+        same operations as in the serial path, so the results are identical.
+        Not used together with cache.
+    :param str backend: 'numpy' or 'numba' (default: BACKEND). The numba
+        kernels run the sequential product, in parallel over Q, so cache,
+        threads, workspace and product='tree' select the numpy code, as do repeated blocks.
+    :param ReflectionWorkspace workspace: arrays reused between calls, the
+        result is written into workspace.R (not used together with threads)
+    :param str formalism: 'transfer' multiplies the transfer matrices of the
+        sublayers; 'parratt' uses the recursion on the reflection matrices
+        (see parratt), which only involves bounded quantities and stays accurate
+        for thick absorbing sublayers. The options above apply to 'transfer'.
+    :param float born_threshold: if given, the points with inc_moment above
+        it are computed in the Born approximation (see born), and the other
+        points with the options above (except workspace). The lowest
+        BORN_CHECK_POINTS points of the Born part are also computed exactly,
+        and if the largest difference exceeds BORN_TOLERANCE times the largest
+        exact amplitude there, all points are computed exactly.
+    :param ndarray wavelength: wavelength of each Q point, for sublayers with
+        an nsld_table (see Layer.nsld_at). Their potentials are then arrays
+        over Q, which the kernels broadcast; cache and threads are not used,
+        and born_threshold is not available. Without tabulated sublayers
+        wavelength is ignored; without wavelength the tables are ignored
+        (the nsld value of the layer is used), with a warning.
+
+    Stacks with GradedSublayer items (linear potential across the sublayer)
+    are computed by _reflection_graded in the transfer formalism, whatever
+    the options above; the Parratt and Born calculations use the potentials
+    in the middle of the graded sublayers.
+    """
+    if not _tabulated(flatten_sublayers(sublayers), wavelength):
+        wavelength = None
+    if wavelength is not None:
+        wavelength = np.asarray(wavelength, dtype=np.float64)
+        if wavelength.shape != np.shape(inc_moment):
+            raise ValueError("wavelength must have one value per Q point")
+        if born_threshold is not None:
+            raise ValueError("born_threshold is not available for wavelength dependent nsld")
+        cache = None
+        threads = None
+    if born_threshold is not None:
+        inc_moment = np.asarray(inc_moment, dtype=np.float64)
+        exact = lambda index, cache=None: reflection(inc_moment[index], sublayers, fast_path, product, cache, threads,
+                                                     backend, formalism=formalism)
+        return _reflection_born(inc_moment, born_threshold, exact, lambda index: born(inc_moment[index], sublayers),
+                                cache)
+    sub_nsld = _layer_nsld(sublayers[-1], wavelength)
+    segments = stack_segments(sublayers, wavelength)
+    N = len(inc_moment)
+    if formalism == 'parratt':
+        return _reflection_parratt(np.asarray(inc_moment, dtype=np.float64), sub_nsld, segments, fast_path)
+    if formalism != 'transfer':
+        raise ValueError("formalism must be 'transfer' or 'parratt'")
+    flat = flatten_sublayers(sublayers)
+    if _graded(flat):
+        return _reflection_graded(np.asarray(inc_moment, dtype=np.float64), flat, fast_path, wavelength)
+    if _use_numba(backend) and cache is None and workspace is None and not threads and product == 'sequential' \
+            and len(segments) == 1 and segments[0][1] == 1:
+        return _numba_reflection(np.asarray(inc_moment, dtype=np.float64), sub_nsld, segments[0][0], fast_path)
+    if threads and cache is None and workspace is None and N > THREAD_MIN_CHUNK:
+        workers = cpu_count() if threads is True else threads
+        size = min(THREAD_CHUNK, max(THREAD_MIN_CHUNK, -(-N // workers)))
+        chunks = [slice(i, i + size) for i in range(0, N, size)]
+        R = Mat(N)
+
+        def evaluate(part):
+            R.data[:, :, part] = _reflection(inc_moment[part], sub_nsld, segments, fast_path, product,
+                                             tree_points=N).data
+        _thread_pool(min(workers, len(chunks))).map(evaluate, chunks)
+        return R
+    return _reflection(inc_moment, sub_nsld, segments, fast_path, product, cache, workspace=workspace)
+
+
+## relative difference between the Born approximation and the exact calculation
+## accepted at the crossover of reflection(..., born_threshold=...)
+BORN_TOLERANCE = 1e-2
+## number of points of the Born part checked against the exact calculation
+BORN_CHECK_POINTS = 4
+## memory (in bytes) of the (channels, interfaces, points) arrays of born
+BORN_MEMORY = 1024 * 1024
+
+def _numba_reflection(inc_moment, sub_nsld, potentials, fast_path):
+    """ Reflection matrix with the kernels of numba_kernels """
+    A, B1, B2, B3, th = potentials
+    sub_moment = np.sqrt(np.square(inc_moment) - 4.0 * np.pi * sub_nsld)
+    # the kernels take the potentials per Q point, constant ones are broadcast without copies
+    N = len(inc_moment)
+    if fast_path and is_collinear(B1, B2, B3):
+        V = _channels(A, B3)
+        if V.ndim == 2:
+            V = np.broadcast_to(V[:, :, np.newaxis], V.shape + (N,))
+        r = numba_kernels.scalar_reflection(inc_moment, sub_moment, V, th)
+        R = Mat(N)
+        R.oneone, R.twotwo = r
+        return R
+    if A.ndim == 1:
+        A = np.broadcast_to(A[:, np.newaxis], A.shape + (N,))
+    return Mat(data=numba_kernels.matrix_reflection(inc_moment, sub_moment, A, B1, B2, B3, th))
 
 
-def reflection(inc_moment, sublayers):
+def _reflection(inc_moment, sub_nsld, segments, fast_path, product, cache=None, tree_points=None,
+                workspace=None):
+    """ Reflection matrix for the segments of a stack (see stack_segments) """
     inc_moment2 = np.square(inc_moment)
-    sub = sublayers[-1]
-    T = inc_moment2 - 4.0 * np.pi * sub.nsld
+    T = inc_moment2 - 4.0 * np.pi * sub_nsld
     sub_moment = np.sqrt(T)
-    S = SMat(len(T))
-    S.M11.oneone.fill(complex(1.0, 0.0))
-    S.M11.twotwo.fill(complex(1.0, 0.0))
-    S.M22.oneone.fill(complex(1.0, 0.0))
-    S.M22.twotwo.fill(complex(1.0, 0.0))
-    incoming_media_nsld = sublayers[0].nsld
-    for cur_layer in sublayers[1:-1]:
-        A = 4.0 * np.pi * (cur_layer.nsld - incoming_media_nsld)
-        th = cur_layer.thickness.value
-        B1 = 4.0 * np.pi * cur_layer.msld.rho.value \
-             * np.sin(np.deg2rad(cur_layer.msld.theta.value)) \
-             * np.cos(np.deg2rad(cur_layer.msld.phi.value))
-        B2 = 4.0 * np.pi * cur_layer.msld.rho.value \
-             * np.sin(np.deg2rad(cur_layer.msld.theta.value)) \
-             * np.sin(np.deg2rad(cur_layer.msld.phi.value))
-        B3 = 4.0 * np.pi * cur_layer.msld.rho.value \
-             * np.cos(np.deg2rad(cur_layer.msld.theta.value))
-        M = SMat(len(inc_moment2))
-        M.M11 = p_cos(A, B1, B2, B3, th, inc_moment2)
-        Msin = p_sin(A, B1, B2, B3, th, inc_moment2)
-        M.M12 = mult_mm(p_invmoment(A, B1, B2, B3, inc_moment2), Msin)
-        M.M21 = mult_mm(mult_nm(complex(-1.0, 0.0), p_moment(A, B1, B2, B3, inc_moment2)), Msin)
-        M.M22 = deepcopy(M.M11)
-        S = mult_s(M, S)
-    Down11 = mult_vm(complex(0.0, 1.0) * sub_moment, S.M11)
-    Down12 = mult_vm(inc_moment * sub_moment, S.M12)
-    Down21 = mult_nm(complex(-1.0, 0.0), S.M21)
-    Down22 = mult_vm(complex(0.0, 1.0) * inc_moment, S.M22)
-    D_1 = inv(plus_mm(plus_mm(plus_mm(Down11, Down12), Down21), Down22))
-    Up11 = mult_vm(complex(0.0, -1.0) * sub_moment, S.M11)
-    Up12 = deepcopy(Down12)
-    Up21 = deepcopy(S.M21)
-    Up22 = deepcopy(Down22)
-    R = mult_mm(D_1, plus_mm(plus_mm(plus_mm(Up11, Up12), Up21), Up22))
+    if cache is not None:
+        cache.check_q(inc_moment)
+    if workspace is not None:
+        workspace.check_q(inc_moment)
+    # the products of several segments would overwrite each other in the workspace
+    product_workspace = workspace if len(segments) == 1 else None
+    if fast_path and all(is_collinear(*p[1:4]) for p, _ in segments):
+        return _reflection_collinear(inc_moment, sub_moment, segments, product, cache, tree_points,
+                                     workspace, product_workspace)
+    if cache is not None:
+        S = _segments_product(segments, lambda A, B1, B2, B3, th:
+                              cached_transfer_product(cache, A, B1, B2, B3, th, inc_moment2))
+    else:
+        S = _segments_product(segments, lambda A, B1, B2, B3, th:
+                              transfer_product(A, B1, B2, B3, th, inc_moment2, product, tree_points,
+                                               product_workspace))
+    return _interface(S, inc_moment, sub_moment, workspace)
+
+
+def scalar_matrices(V, th, inc_moment2):
+    """
+    Scalar sublayer matrices [[cos(k th), sin(k th)/k], [-k sin(k th), cos(k th)]]
+    for potentials V of shape (C, L) or (C, L, N) and thicknesses th of shape (L,) or (C, L).
+    Sublayers come first and channels ride along as a batch dimension:
+    the result has shape (2, 2, L, C, N).
+    """
+    k = s_moment(V.swapaxes(0, 1) if V.ndim == 3 else V.T[:, :, np.newaxis], inc_moment2)
+    kth = k * np.atleast_2d(th).T[:, :, np.newaxis]
+    mats = np.empty((2, 2) + k.shape, dtype=np.complex128)
+    np.cos(kth, out=mats[0, 0])
+    mats[1, 1] = mats[0, 0]
+    s = np.sin(kth)
+    np.divide(s, k, out=mats[0, 1])
+    np.multiply(-k, s, out=mats[1, 0])
+    return mats
+
+
+def _sublayer(V, j):
+    """ Potential of sublayer j for the channels of V (see scalar_product), as a (C, 1) or (C, N) array """
+    return V[:, j] if V.ndim == 3 else V[:, j, np.newaxis]
+
+
+def _channels(A, B3):
+    """ Potentials A + B3 and A - B3 of the two spin channels, shape (2, L) or (2, L, N) """
+    if A.ndim == 2:
+        B3 = B3[:, np.newaxis]
+    return np.array([A + B3, A - B3])
+
+
+def scalar_product(V, th, inc_moment2, product='sequential', tree_points=None, workspace=None):
+    """
+    Ordered product of the scalar (single spin channel) sublayer matrices.
+    :param ndarray V: potential of each sublayer for each channel, shape (C, L),
+        or (C, L, N) for potentials that depend on Q
+    :param ndarray th: thickness of each sublayer, shape (L,),
+        or (C, L) when the channels belong to different stacks
+    :param ndarray inc_moment2: square of the incoming wave vector, shape (N,)
+    :param str product: 'sequential' or 'tree', as in transfer_product
+    :param int tree_points: as in transfer_product
+    :param ReflectionWorkspace workspace: buffers for the sequential product
+        of up to two channels; the result is then a view of the workspace
+    :return: (2, 2, C, N) array
+    """
+    shape = (V.shape[0], len(inc_moment2))
+    if product == 'tree':
+        m = _identity(2, shape[0] * shape[1]).reshape((2, 2) + shape)
+        work = np.empty_like(m)
+        points = shape[0] * (shape[1] if tree_points is None else tree_points)
+        for g in _groups(V.shape[1], points, 2):
+            _matmul(tree_product(scalar_matrices(V[:, g], th[..., g], inc_moment2)), m, work)
+            m, work = work, m
+        return m
+    if product != 'sequential':
+        raise ValueError("product must be 'sequential' or 'tree'")
+    if workspace is not None and th.ndim == 1 and shape[0] <= 2:
+        m = workspace.scalar[:, :, :shape[0]]
+        m[...] = 0.0
+        m[0, 0] = 1.0
+        m[1, 1] = 1.0
+        k, c, s, p, tmp, tmp2 = workspace.scratch[:6, :shape[0]]
+    else:
+        m = _identity(2, shape[0] * shape[1]).reshape((2, 2) + shape)
+        k, c, s, p, tmp, tmp2 = np.empty((6,) + shape, dtype=np.complex128)
+    th = np.atleast_2d(th)
+    for j in range(V.shape[1]):
+        np.subtract(inc_moment2, _sublayer(V, j), out=k)
+        np.sqrt(k, out=k)
+        np.multiply(k, th[:, j, np.newaxis], out=c)
+        np.sin(c, out=s)
+        np.cos(c, out=c)
+        np.divide(s, k, out=p)
+        k *= s
+        np.negative(k, out=k)
+        # (m11, m21) and (m12, m22) are the columns of the accumulated product
+        for top, bottom in ((m[0, 0], m[1, 0]), (m[0, 1], m[1, 1])):
+            np.multiply(p, bottom, out=tmp)
+            bottom *= c
+            np.multiply(k, top, out=tmp2)
+            bottom += tmp2
+            top *= c
+            top += tmp
+    return m
+
+
+def _scalar_interface(m, inc_moment, sub_moment, workspace=None):
+    """ Scalar version of _interface, for a (2, 2, ...) product m """
+    I = complex(0.0, 1.0)
+    a = I * sub_moment
+    b = inc_moment * sub_moment
+    c = I * inc_moment
+    if workspace is None:
+        Down = a * m[0, 0] + b * m[0, 1] - m[1, 0] + c * m[1, 1]
+        Up = -a * m[0, 0] + b * m[0, 1] + m[1, 0] + c * m[1, 1]
+        return Up / Down
+    # the same operations, with the results and temporaries in the workspace
+    Down, Up, tmp = workspace.interface[:, 0, :m.shape[2]]
+    np.multiply(a, m[0, 0], out=Down)
+    np.multiply(-a, m[0, 0], out=Up)
+    np.multiply(b, m[0, 1], out=tmp)
+    Down += tmp
+    Up += tmp
+    Down -= m[1, 0]
+    Up += m[1, 0]
+    np.multiply(c, m[1, 1], out=tmp)
+    Down += tmp
+    Up += tmp
+    Up /= Down
+    return Up
+
+
+def abeles(inc_moment, sub_moment, V, th, product='sequential'):
+    """
+    Scalar (single spin channel) reflectivity amplitude, using the same
+    transfer matrix formalism as the spin-resolved calculation.
+    :param ndarray inc_moment: incoming wave vector, shape (N,)
+    :param ndarray sub_moment: wave vector in the substrate, shape (N,)
+    :param ndarray V: potential of each sublayer for each channel, shape (C, L)
+    :param ndarray th: thickness of each sublayer, shape (L,)
+    :param str product: 'sequential' or 'tree', as in transfer_product
+    :return: amplitudes, shape (C, N)
+    """
+    m = scalar_product(V, th, np.square(inc_moment), product)
+    return _scalar_interface(m, inc_moment, sub_moment)
+
+
+def _reflection_collinear(inc_moment, sub_moment, segments, product='sequential', cache=None, tree_points=None,
+                          workspace=None, product_workspace=None):
+    """
+    Reflection matrix when the spin channels do not mix: the matrix is diagonal,
+    and each channel is a scalar problem with potential A + B3 (up) or A - B3 (down)
+    """
+    inc_moment2 = np.square(inc_moment)
+    if cache is not None:
+        channel_product = lambda V, th: cached_scalar_product(cache, V, th, inc_moment2)
+    else:
+        channel_product = lambda V, th: scalar_product(V, th, inc_moment2, product, tree_points, product_workspace)
+    if workspace is None:
+        R = Mat(len(inc_moment))
+    else:
+        R = workspace.R
+        R.onetwo = 0.0
+        R.twoone = 0.0
+    if all(np.all(p[3] == 0.0) for p, _ in segments):
+        m = _segments_product(segments, lambda A, B1, B2, B3, th: channel_product(A[np.newaxis], th))
+        r = _scalar_interface(m, inc_moment, sub_moment, workspace)[0]
+        R.oneone = r
+        R.twotwo = r
+    else:
+        m = _segments_product(segments, lambda A, B1, B2, B3, th: channel_product(_channels(A, B3), th))
+        R.oneone, R.twotwo = _scalar_interface(m, inc_moment, sub_moment, workspace)
+    return R
+
+
+def _interface(S, inc_moment, sub_moment, workspace=None):
+    """
+    Reflection amplitude matrix from the product S of the sublayer matrices,
+    the incoming wave vector and the wave vector in the substrate.
+    With a ReflectionWorkspace, the result is written into workspace.R.
+    """
+    S11 = S[:2, :2]
+    S12 = S[:2, 2:]
+    S21 = S[2:, :2]
+    S22 = S[2:, 2:]
+    a = complex(0.0, 1.0) * sub_moment
+    b = inc_moment * sub_moment
+    c = complex(0.0, 1.0) * inc_moment
+    if workspace is None:
+        Down, Up, tmp = np.empty((3,) + S11.shape, dtype=np.complex128)
+        R = Mat(data=np.empty_like(Up))
+    else:
+        Down, Up, tmp = workspace.interface
+        R = workspace.R
+    np.multiply(a, S11, out=Down)
+    np.multiply(-a, S11, out=Up)
+    np.multiply(b, S12, out=tmp)
+    Down += tmp
+    Up += tmp
+    Down -= S21
+    Up += S21
+    np.multiply(c, S22, out=tmp)
+    Down += tmp
+    Up += tmp
+    # tmp is free again, and holds the inverse of Down
+    D_1 = _inv2(Down, tmp)
+    _matmul(D_1, Up, R.data, workspace.row[:2] if workspace is not None else None)
+    return R
+
+
+def parratt(inc_moment, sub_potential, V, th):
+    """
+    Scalar (single spin channel) reflectivity amplitude by Parratt's recursion,
+    with the conventions of abeles. Starting from the substrate, the reflection
+    amplitude at the top of each sublayer is (f + r) / (1 + f r) exp(2i k th),
+    with r the amplitude below it and f the Fresnel coefficient of the interface.
+    Since |exp(2i k th)| <= 1 for absorbing sublayers, no quantity grows with
+    the thickness.
+    :param ndarray inc_moment: incoming wave vector, shape (N,)
+    :param sub_potential: potential 4 pi nsld of the substrate
+    :param ndarray V: potential of each sublayer for each channel, shape (C, L) or (C, L, N)
+    :param ndarray th: thickness of each sublayer, shape (L,)
+    :return: amplitudes, shape (C, N)
+    """
+    inc_moment2 = np.square(inc_moment)
+    V_below = sub_potential
+    k_below = np.sqrt(inc_moment2 - V_below)
+    # one row per channel, also when the stack has no sublayers to broadcast against
+    r = np.zeros((V.shape[0], len(inc_moment)), dtype=np.complex128)
+    for j in range(V.shape[1] - 1, -2, -1):
+        if j < 0:
+            V_j, k = 0.0, inc_moment
+        else:
+            V_j = _sublayer(V, j)
+            k = s_moment(V_j, inc_moment2)
+        # (k - k_below) / (k + k_below), without the cancellation in k - k_below
+        f = (V_below - V_j) / np.square(k + k_below)
+        r = (f + r) / (1.0 + f * r)
+        if j >= 0:
+            r *= np.exp(2j * k * th[j])
+        V_below, k_below = V_j, k
+    return r
+
+
+def _expand_segments(segments):
+    """ Potentials of all sublayers, with the periods of repeated blocks written out """
+    return [np.concatenate([np.concatenate([p[i]] * n) for p, n in segments]) for i in range(5)]
+
+
+def _parratt_interface(K, K_below, R_below):
+    """
+    Reflection matrix above an interface, from the wave vector matrix K
+    above it, and the wave vector and reflection matrices below it:
+    with P = 1 + R_below and Q = K_below (1 - R_below), 2 P (K P + Q)^-1 K - 1
+    """
+    P = R_below.copy()
+    Q = -R_below
+    for i in range(2):
+        P[i, i] += 1.0
+        Q[i, i] += 1.0
+    Q = _matmul(K_below, Q, np.empty_like(Q))
+    X = _matmul(K, P, np.empty_like(P))
+    X += Q
+    Y = _matmul(P, _inv2(X, Q), X)
+    r = _matmul(Y, K, P)
+    r *= 2.0
+    for i in range(2):
+        r[i, i] -= 1.0
+    return r
+
+
+def graded_matrices(V_top, V_bottom, th, inc_moment2):
+    """
+    Scalar transfer matrices (see scalar_matrices) of sublayers whose potential
+    varies linearly from V_top to V_bottom, by the fourth order Magnus
+    integrator: with X(z) = [[0, 1], [V(z) - inc_moment2, 0]] at the two
+    Gauss points z1, z2, the matrix is exp(Omega), where
+    Omega = th (X1 + X2) / 2 + sqrt(3) th^2 [X2, X1] / 12
+          = [[c, th], [-th k^2, -c]],
+    k the wave vector for the mean potential and c = th^2 (V_top - V_bottom) / 12.
+    Omega has zero trace, so exp(Omega) = cos(phi) + sin(phi) / phi Omega
+    with phi^2 = th^2 k^2 - c^2. This is exact for constant potentials, and
+    the error for the gradient is of order th^5 per sublayer.
+    The arguments broadcast together, the result has shape (2, 2) + their shape.
+    """
+    k2 = inc_moment2 - (V_top + V_bottom) / 2.0
+    c = np.square(th) * (V_top - V_bottom) / 12.0
+    phi = np.sqrt(np.square(th) * k2 - np.square(c) + 0j)
+    cos = np.cos(phi)
+    sinc = np.sin(phi) / phi
+    mats = np.empty((2, 2) + cos.shape, dtype=cos.dtype)
+    np.multiply(c, sinc, out=mats[0, 1])
+    np.add(cos, mats[0, 1], out=mats[0, 0])
+    np.subtract(cos, mats[0, 1], out=mats[1, 1])
+    np.multiply(th, sinc, out=mats[0, 1])
+    np.multiply(-th * k2, sinc, out=mats[1, 0])
+    return mats
+
+
+def _graded_potentials(inner):
+    """
+    For the sublayers between the incoming media and the substrate:
+    the change dA of the nuclear potential from the top to the bottom of each
+    sublayer, the direction n, shape (3, L), of the magnetization, its magnitude
+    b along n in the middle and its change db. dA and db are zero except for
+    GradedSublayer items.
+    """
+    dA = np.array([4.0 * np.pi * l.nsld_step if isinstance(l, GradedSublayer) else 0.0 for l in inner],
+                  dtype=np.complex128)
+    db = np.array([4.0 * np.pi * l.msld_rho_step if isinstance(l, GradedSublayer) else 0.0 for l in inner],
+                  dtype=np.float64)
+    b = 4.0 * np.pi * np.array([l.msld.rho.value for l in inner], dtype=np.float64)
+    theta = np.deg2rad([l.msld.theta.value for l in inner])
+    phi = np.deg2rad([l.msld.phi.value for l in inner])
+    n = np.array([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)]).reshape((3, len(inner)))
+    return dA, n, b, db
+
+
+def graded_sublayer_matrix(A, dA, n, b, db, th, inc_moment2, out):
+    """
+    Transfer matrix (see sublayer_matrix) of a sublayer with the nuclear potential
+    A - dA / 2 at the top and A + dA / 2 at the bottom, and the magnetic potential
+    (b +/- db / 2) n.sigma along the fixed direction n. The spin components
+    along n do not mix, so each block is combined from the graded_matrices
+    of the two eigen potentials A +/- b.
+    """
+    plus = graded_matrices(A - dA / 2.0 + (b - db / 2.0), A + dA / 2.0 + (b + db / 2.0), th, inc_moment2)
+    if b == 0.0 and db == 0.0:
+        for r in range(2):
+            for c in range(2):
+                pauli_combine(plus[r, c], plus[r, c], 0.0, 0.0, 0.0, 0.0, out[2 * r:2 * r + 2, 2 * c:2 * c + 2])
+        return out
+    minus = graded_matrices(A - dA / 2.0 - (b - db / 2.0), A + dA / 2.0 - (b + db / 2.0), th, inc_moment2)
+    for r in range(2):
+        for c in range(2):
+            _pauli((plus[r, c] + minus[r, c]) / 2.0, (plus[r, c] - minus[r, c]) / 2.0, n[0], n[1], n[2],
+                   out[2 * r:2 * r + 2, 2 * c:2 * c + 2])
+    return out
+
+
+def _reflection_graded(inc_moment, sublayers, fast_path, wavelength=None):
+    """
+    Reflection matrix for a sublayer list (without SublayerRepeat items) that
+    contains GradedSublayer items: the matrices of all sublayers come from
+    graded_matrices, and are multiplied sequentially
+    """
+    inc_moment2 = np.square(inc_moment)
+    sub_moment = np.sqrt(inc_moment2 - 4.0 * np.pi * _layer_nsld(sublayers[-1], wavelength))
+    A, B1, B2, B3, th = sublayer_potentials(sublayers, wavelength)
+    dA, n, b, db = _graded_potentials(sublayers[1:-1])
+    N = len(inc_moment)
+    R = Mat(N)
+    if fast_path and is_collinear(B1, B2, B3) and is_collinear(*(n * db)):
+        # channels along z, with potentials A +/- b n3 and their changes dA +/- db n3
+        if np.all(b * n[2] == 0.0) and np.all(db * n[2] == 0.0):
+            V, dV = A[np.newaxis], dA[np.newaxis]
+        else:
+            V, dV = _channels(A, b * n[2]), np.array([dA + db * n[2], dA - db * n[2]])
+        m = _identity(2, V.shape[0] * N).reshape((2, 2, V.shape[0], N))
+        work = np.empty_like(m)
+        for j in range(len(th)):
+            V_j = _sublayer(V, j)
+            _matmul(graded_matrices(V_j - dV[:, j, np.newaxis] / 2.0, V_j + dV[:, j, np.newaxis] / 2.0, th[j],
+                                    inc_moment2), m, work)
+            m, work = work, m
+        r = _scalar_interface(m, inc_moment, sub_moment)
+        R.oneone = r[0]
+        R.twotwo = r[-1]
+        return R
+    S = _identity(4, N)
+    M = np.empty_like(S)
+    work = np.empty_like(S)
+    for j in range(len(th)):
+        graded_sublayer_matrix(A[j], dA[j], n[:, j], b[j], db[j], th[j], inc_moment2, M)
+        _matmul(M, S, work)
+        S, work = work, S
+    return _interface(S, inc_moment, sub_moment)
+
+
+def _reflection_parratt(inc_moment, sub_nsld, segments, fast_path):
+    """
+    Reflection matrix by the matrix form of Parratt's recursion: the
+    reflection matrix at the top of each sublayer is obtained from the one
+    below it with _parratt_interface, and moved to the top through the
+    sublayer with the propagator E = exp(i K th): R = E r E.
+    Periods of repeated blocks are written out.
+    """
+    A, B1, B2, B3, th = _expand_segments(segments)
+    inc_moment2 = np.square(inc_moment)
+    sub_potential = 4.0 * np.pi * sub_nsld
+    N = len(inc_moment)
+    R = Mat(N)
+    if fast_path and is_collinear(B1, B2, B3):
+        if np.all(B3 == 0.0):
+            r = parratt(inc_moment, sub_potential, A[np.newaxis], th)[0]
+            R.oneone = r
+            R.twotwo = r
+        else:
+            R.oneone, R.twotwo = parratt(inc_moment, sub_potential, _channels(A, B3), th)
+        return R
+    K_below = _identity(2, N) * np.sqrt(inc_moment2 - sub_potential)
+    K = np.empty_like(K_below)
+    E = np.empty_like(K_below)
+    for j in range(len(th) - 1, -1, -1):
+        Bmod = np.sqrt(B1[j] ** 2 + B2[j] ** 2 + B3[j] ** 2)
+        k_plus, k_minus = eigen_moments(A[j], Bmod, inc_moment2)
+        pauli_combine(k_plus, k_minus, B1[j], B2[j], B3[j], Bmod, K)
+        pauli_combine(np.exp(1j * k_plus * th[j]), np.exp(1j * k_minus * th[j]), B1[j], B2[j], B3[j], Bmod, E)
+        r = _parratt_interface(K, K_below, R.data)
+        R.data = _matmul(_matmul(E, r, np.empty_like(r)), E, r)
+        K, K_below = K_below, K
+    R.data = _parratt_interface(_identity(2, N) * inc_moment, K_below, R.data)
+    return R
+
+
+def born(inc_moment, sublayers):
+    """
+    Reflection amplitude matrix in the kinematic (Born) approximation: the sum
+    over the interfaces of the sublayer profile of the potential step,
+    divided by (k_above + k_below)^2, times the phase factor accumulated down
+    to the interface and back. The wave vectors and phases include the
+    refraction by the sublayers, so each term is the first order Fresnel
+    coefficient of its interface, and only the multiple reflections are
+    neglected. Valid well above the critical edge.
+    When the spin channels do not mix, the phases are cumulative sums and all
+    sublayers and Q points are evaluated as arrays. Otherwise the phase
+    factors are 2x2 matrices, exp(i K th), multiplied sublayer by sublayer.
+    :param ndarray inc_moment: incoming wave vector (Q/2)
+    :param list sublayers: as in reflection
+    :return: Mat
+    """
+    inc_moment = np.asarray(inc_moment, dtype=np.float64)
+    A, B1, B2, B3, th = _expand_segments(stack_segments(sublayers))
+    # potentials from the incoming media (0) to the substrate, which has no magnetic part
+    zero = np.zeros(1)
+    sub_potential = 4.0 * np.pi * sublayers[-1].nsld
+    extend = lambda x, substrate=0.0: np.concatenate((zero, x, [substrate]))
+    R = Mat(len(inc_moment))
+    if is_collinear(B1, B2, B3):
+        if np.all(B3 == 0.0):
+            r = _born_channels(inc_moment, extend(A, sub_potential)[np.newaxis], th)[0]
+            R.oneone = r
+            R.twotwo = r
+        else:
+            V = np.array([extend(A + B3, sub_potential), extend(A - B3, sub_potential)])
+            R.oneone, R.twotwo = _born_channels(inc_moment, V, th)
+        return R
+    inc_moment2 = np.square(inc_moment)
+    N = len(inc_moment)
+    # phase factors down to the interface (left) and back up (right)
+    left = _identity(2, N)
+    right = _identity(2, N)
+    K_above = _identity(2, N) * inc_moment
+    K = np.empty_like(left)
+    E = np.empty_like(left)
+    work = np.empty_like(left)
+    fresnel = np.empty_like(left)
+    term = np.empty_like(left)
+    for j in range(len(th) + 1):
+        if j < len(th):
+            Bmod = np.sqrt(B1[j] ** 2 + B2[j] ** 2 + B3[j] ** 2)
+            k_plus, k_minus = eigen_moments(A[j], Bmod, inc_moment2)
+            pauli_combine(k_plus, k_minus, B1[j], B2[j], B3[j], Bmod, K)
+        else:
+            K = _identity(2, N) * np.sqrt(inc_moment2 - sub_potential)
+        # Fresnel matrix of the interface above sublayer j, (K_above + K)^-1 (K_above - K)
+        _matmul(_inv2(K_above + K, work), K_above - K, fresnel)
+        R.data += _matmul(left, _matmul(fresnel, right, work), term)
+        if j < len(th):
+            # to first order, the reflection below the interface is seen as (1 - f) R (1 + f)
+            pauli_combine(np.exp(1j * k_plus * th[j]), np.exp(1j * k_minus * th[j]), B1[j], B2[j], B3[j], Bmod, E)
+            fresnel *= -1.0
+            for i in range(2):
+                fresnel[i, i] += 1.0
+            left = _matmul(_matmul(left, fresnel, work), E, left)
+            fresnel *= -1.0
+            for i in range(2):
+                fresnel[i, i] += 2.0
+            right = _matmul(E, _matmul(fresnel, right, work), right)
+            K_above, K = K, K_above
+    return R
+
+
+def _born_channels(inc_moment, V, th):
+    """
+    Born approximation (see born) for C scalar channels with potentials V of
+    shape (C, L + 2), from the incoming media to the substrate.
+    Returns the amplitudes, shape (C, N).
+    """
+    r = np.empty((V.shape[0], len(inc_moment)), dtype=np.complex128)
+    # chunks of Q, such that the (channels, interfaces, points) arrays fit in BORN_MEMORY
+    size = max(1, BORN_MEMORY // (16 * V.size))
+    for i in range(0, len(inc_moment), size):
+        part = slice(i, i + size)
+        k = np.sqrt(np.square(inc_moment[part]) - V[:, :, np.newaxis])
+        phase = np.zeros(k[:, 1:].shape, dtype=np.complex128)
+        np.cumsum(k[:, 1:-1] * th[:, np.newaxis], axis=1, out=phase[:, 1:])
+        terms = np.exp(2j * phase)
+        terms *= np.diff(V, axis=1)[:, :, np.newaxis]
+        terms /= np.square(k[:, :-1] + k[:, 1:])
+        r[:, part] = terms.sum(axis=1)
+    return r
+
+
+def _reflection_born(inc_moment, threshold, exact, born_part, cache=None):
+    """
+    Reflection matrix with the points above threshold in the Born approximation
+    (see reflection). exact(index, cache) and born_part(index) return the Mat of the
+    exact calculation and of born at the points inc_moment[index]. The cache
+    is only used for the exact part, the check points would clear it.
+    """
+    high = np.flatnonzero(inc_moment > threshold)
+    if len(high) == 0:
+        return exact(slice(None), cache)
+    # continuity check on the lowest points of the Born part
+    check = high[np.argsort(inc_moment[high])[:BORN_CHECK_POINTS]]
+    reference = exact(check).data
+    deviation = np.abs(born_part(check).data - reference).max() / np.abs(reference).max()
+    if not deviation <= BORN_TOLERANCE:
+        return exact(slice(None), cache)
+    low = np.flatnonzero(inc_moment <= threshold)
+    R = Mat(len(inc_moment))
+    R.data[:, :, high] = born_part(high).data
+    if len(low):
+        R.data[:, :, low] = exact(low, cache).data
     return R
 
 
-def spin_av(R, n1, n2, pol_eff, an_eff):
+def _spin_density(n, eff):
+    """ Spin density matrix for polarization vector n and efficiency eff """
     I = complex(0.0, 1.0)
-    Spin_dens1 = Mat(len(pol_eff))
-    Spin_dens1.oneone = 1.0 + n1[2] * pol_eff
-    Spin_dens1.onetwo = (n1[0] - I * n1[1]) * pol_eff
-    Spin_dens1.twoone = (n1[0] + I * n1[1]) * pol_eff
-    Spin_dens1.twotwo = 1.0 - n1[2] * pol_eff
-    Spin_dens2 = Mat(len(an_eff))
-    Spin_dens2.oneone = 1.0 + n2[2] * an_eff
-    Spin_dens2.onetwo = (n2[0] - I * n2[1]) * an_eff
-    Spin_dens2.twoone = (n2[0] + I * n2[1]) * an_eff
-    Spin_dens2.twotwo = 1.0 - n2[2] * an_eff
-
-    Rch = Mat(len(R))
-    Rch.oneone = np.conj(R.oneone)
-    Rch.twotwo = np.conj(R.twotwo)
-    Rch.onetwo = np.conj(R.twoone)
-    Rch.twoone = np.conj(R.onetwo)
+    rho = Mat(len(eff))
+    rho.oneone = 1.0 + n[2] * eff
+    rho.onetwo = (n[0] - I * n[1]) * eff
+    rho.twoone = (n[0] + I * n[1]) * eff
+    rho.twotwo = 1.0 - n[2] * eff
+    return rho
+
+
+def spin_av(R, n1, n2, pol_eff, an_eff, backend=None):
+    if _use_numba(backend) and R.data.ndim == 3:
+        return numba_kernels.spin_av(R.data, np.asarray(n1, dtype=np.float64), np.asarray(n2, dtype=np.float64),
+                                     np.asarray(pol_eff, dtype=np.complex128), np.asarray(an_eff, dtype=np.complex128))
+    Spin_dens1 = _spin_density(n1, pol_eff)
+    Spin_dens2 = _spin_density(n2, an_eff)
+    Rch = Mat(data=np.conj(R.data.swapaxes(0, 1)))
     RRt = mult_mm(Spin_dens1, mult_mm(Rch, mult_mm(Spin_dens2, R)))
     Out = (RRt.oneone + RRt.twotwo) / 4.0
     return Out
 
 
+def spin_av_multi(R, n1, n2, pol_eff, an_eff):
+    """
+    spin_av for C (polarizer, analyzer) pairs at once.
+    With rho = 1 + eff n.sigma, Tr(rho1 R^+ rho2 R) / 4 is bilinear in the
+    vectors u = (1, pol_eff n1) and v = (1, an_eff n2):
+    sum over mu, nu of u_mu v_nu T_mu,nu / 4, with T_mu,nu = Tr(R sigma_mu R^+ sigma_nu)
+    and sigma_0 the identity. T is real and only depends on R, so it is
+    computed once, and the sums over the pairs are matrix products.
+    :param Mat R: reflection matrices, data of shape (2, 2, N)
+    :param ndarray n1: polarizer vectors, shape (C, 3)
+    :param ndarray n2: analyzer vectors, shape (C, 3)
+    :return: complex (C, N) array; row c is spin_av(R, n1[c], n2[c], pol_eff, an_eff)
+    """
+    return _spin_sums(_spin_terms(R), n1, n2, pol_eff, an_eff)
+
+
+def _spin_terms(R):
+    """ T_mu,nu of spin_av_multi, shape (4, 4) + R.data.shape[2:] """
+    r11, r12, r21, r22 = R.oneone, R.onetwo, R.twoone, R.twotwo
+    # Q = R sigma_mu R^+ for mu = 0..3, as (Q11, Q12, Q21, Q22)
+    c11, c12, c21, c22 = np.conj(r11), np.conj(r21), np.conj(r12), np.conj(r22)
+    Qs = ((r11 * c11 + r12 * c21, r11 * c12 + r12 * c22, r21 * c11 + r22 * c21, r21 * c12 + r22 * c22),
+          (r12 * c11 + r11 * c21, r12 * c12 + r11 * c22, r22 * c11 + r21 * c21, r22 * c12 + r21 * c22),
+          (1j * (r12 * c11 - r11 * c21), 1j * (r12 * c12 - r11 * c22),
+           1j * (r22 * c11 - r21 * c21), 1j * (r22 * c12 - r21 * c22)),
+          (r11 * c11 - r12 * c21, r11 * c12 - r12 * c22, r21 * c11 - r22 * c21, r21 * c12 - r22 * c22))
+    T = np.empty((4, 4) + r11.shape)
+    for mu, (Q11, Q12, Q21, Q22) in enumerate(Qs):
+        T[mu, 0] = np.real(Q11 + Q22)
+        T[mu, 1] = np.real(Q12 + Q21)
+        T[mu, 2] = np.real(1j * (Q12 - Q21))
+        T[mu, 3] = np.real(Q11 - Q22)
+    return T
+
+
+def _spin_sums(T, n1, n2, pol_eff, an_eff):
+    """ The sums over mu, nu of spin_av_multi for the (4, 4, N) terms T """
+    n1 = np.asarray(n1, dtype=np.float64)
+    n2 = np.asarray(n2, dtype=np.float64)
+    both = (n1[:, :, np.newaxis] * n2[:, np.newaxis, :]).reshape(len(n1), 9)
+    Out = T[0, 0] + pol_eff * n1.dot(T[1:, 0]) + an_eff * n2.dot(T[0, 1:]) \
+        + pol_eff * an_eff * both.dot(T[1:, 1:].reshape(9, -1))
+    return Out / 4.0
+
+
+def _trace_product(X, Y):
+    """ Tr(X Y) for stacks of matrices with the matrix indices first """
+    return np.einsum('ab...,ba...->...', X, Y)
+
+
+## memory (in bytes) of the prefix products kept by reflectivity_gradient
+GRADIENT_MEMORY = 64 * 1024 * 1024
+
+
+def reflectivity_gradient(inc_moment, sublayers, n1, n2, pol_eff, an_eff):
+    """
+    Spin averaged reflectivity (the real part of spin_av) and its derivatives
+    with respect to the potentials of every sublayer, by reverse mode
+    differentiation of the transfer matrix product: one backward sweep gives
+    the derivatives for all sublayers, so that the cost does not grow with
+    the number of fit parameters.
+    The prefix products of the sublayer matrices are kept, which takes
+    256 bytes per sublayer and Q point, so Q is split in chunks
+    that fit in GRADIENT_MEMORY.
+    :return: rr, shape (N,); the derivatives with respect to the real and
+        imaginary part of A, B1, B2, B3 and the thickness of each sublayer
+        between the incoming media and the substrate, shape (L, 6, N);
+        and the derivatives with respect to the real and imaginary part
+        of the substrate nsld, shape (2, N)
+    """
+    sublayers = flatten_sublayers(sublayers)
+    inc_moment = np.asarray(inc_moment, dtype=np.float64)
+    pol_eff = np.broadcast_to(pol_eff, inc_moment.shape)
+    an_eff = np.broadcast_to(an_eff, inc_moment.shape)
+    L, N = len(sublayers) - 2, len(inc_moment)
+    size = max(1, GRADIENT_MEMORY // (256 * (L + 1)))
+    if N <= size:
+        return _reflectivity_gradient(inc_moment, sublayers, n1, n2, pol_eff, an_eff)
+    rr = np.empty(N)
+    gradient = np.empty((L, 6, N))
+    sub_gradient = np.empty((2, N))
+    for i in range(0, N, size):
+        part = slice(i, i + size)
+        rr[part], gradient[:, :, part], sub_gradient[:, part] = _reflectivity_gradient(
+            inc_moment[part], sublayers, n1, n2, pol_eff[part], an_eff[part])
+    return rr, gradient, sub_gradient
+
+
+def _reflectivity_gradient(inc_moment, sublayers, n1, n2, pol_eff, an_eff):
+    """ reflectivity_gradient for a flat list of sublayers, in one chunk """
+    inc_moment2 = np.square(inc_moment)
+    sub_moment = np.sqrt(inc_moment2 - 4.0 * np.pi * sublayers[-1].nsld)
+    A, B1, B2, B3, th = sublayer_potentials(sublayers)
+    L, N = len(th), len(inc_moment)
+    # forward sweep: prefix[j] is the product of the matrices of the sublayers before j
+    prefix = np.empty((L + 1, 4, 4, N), dtype=np.complex128)
+    prefix[0] = _identity(4, N)
+    M = np.empty((4, 4, N), dtype=np.complex128)
+    for j in range(L):
+        _matmul(sublayer_matrix(A[j], B1[j], B2[j], B3[j], th[j], inc_moment2, M), prefix[j], prefix[j + 1])
+    S = prefix[L]
+    R = _interface(S, inc_moment, sub_moment)
+    rr = np.real(spin_av(R, n1, n2, pol_eff, an_eff))
+    # d rr = Re Tr(G dR), with G = rho1 R^+ rho2 / 2 for the spin density matrices rho
+    Rch = Mat(data=np.conj(R.data.swapaxes(0, 1)))
+    G = mult_mm(_spin_density(n1, pol_eff), mult_mm(Rch, _spin_density(n2, an_eff))).data / 2.0
+    # R = Down^-1 Up, so d rr = Re Tr(X dUp - Y dDown) with X = G Down^-1, Y = R X
+    I = complex(0.0, 1.0)
+    a = I * sub_moment
+    b = inc_moment * sub_moment
+    c = I * inc_moment
+    Down = a * S[:2, :2] + b * S[:2, 2:] - S[2:, :2] + c * S[2:, 2:]
+    X = _matmul(G, _inv2(Down, np.empty_like(Down)), np.empty_like(G))
+    Y = _matmul(R.data, X, np.empty_like(X))
+    # adjoint of S: d rr = Re Tr(gS dS)
+    gS = np.empty((4, 4, N), dtype=np.complex128)
+    gS[:2, :2] = -a * (X + Y)
+    gS[:2, 2:] = X + Y
+    gS[2:, :2] = b * (X - Y)
+    gS[2:, 2:] = c * (X - Y)
+    dsub = _trace_product(X, -I * S[:2, :2] + inc_moment * S[:2, 2:]) \
+        - _trace_product(Y, I * S[:2, :2] + inc_moment * S[:2, 2:])
+    dsub = dsub * (-2.0 * np.pi / sub_moment)
+    sub_gradient = np.array([np.real(dsub), np.real(I * dsub)])
+    # backward sweep: tail is gS times the product of the matrices after sublayer j
+    gradient = np.empty((L, 6, N))
+    tail = gS
+    work = np.empty_like(M)
+    for j in range(L - 1, -1, -1):
+        gM = _matmul(prefix[j], tail, work)
+        derivatives = sublayer_matrix_derivatives(A[j], B1[j], B2[j], B3[j], th[j], inc_moment2)
+        traces = _trace_product(gM[:, :, np.newaxis], derivatives.transpose(1, 2, 0, 3))
+        gradient[j, 0] = np.real(traces[0])
+        gradient[j, 1] = np.real(I * traces[0])
+        gradient[j, 2:] = np.real(traces[1:])
+        if j:
+            tail = _matmul(tail, sublayer_matrix(A[j], B1[j], B2[j], B3[j], th[j], inc_moment2, M), np.empty_like(M))
+    return rr, gradient, sub_gradient
+
+
 def resolut1(RR, q, dq):
-    N = len(q)
-    denominator = np.zeros(N)
-    RRr = np.zeros(N)
-    # left neighbours
-    for i in range(1, N):
-        k = 1;
-        while q[i] - q[i - k] <= dq[i] / 2.0:
-            denominator[i] = denominator[i] + 1.0
-            RRr[i] = RRr[i] + RR[i - k].real
-            k = k + 1
-            if i - k < 0:
-                break;
-
-    # right neighbours and center
-    denominator[N - 1] = denominator[N - 1] + 1
-    RRr[N - 1] = (RRr[N - 1] + RR[N - 1].real) / denominator[N - 1]
-    for i in range(N - 1):
-        k = 1
-        denominator[i] = denominator[i] + 1
-        RRr[i] = RRr[i] + RR[i].real
-        while q[i + k] - q[i] <= dq[i] / 2.0:
-            denominator[i] = denominator[i] + 1
-            RRr[i] = RRr[i] + RR[i + k].real
-            k = k + 1
-            if i + k > N - 1:
-                break
-        RRr[i] = RRr[i] / denominator[i]
-    return RRr
+    """
+    Average of RR over the neighbours within dq/2 of each point (top hat resolution),
+    the window ending at the first point further away. For q in ascending order
+    the window bounds are found by bisection, otherwise with _window_length. The
+    window sums are differences of cumulative sums, in O(N). The sums run from the
+    last point, the high Q end for ascending q, so the small reflectivities at high
+    Q are not differences of large sums.
+    """
+    q = np.asarray(q, dtype=np.float64)
+    rows = np.arange(len(q))
+    half_width = np.asarray(dq, dtype=np.float64) / 2.0
+    if np.all(np.diff(q) >= 0.0):
+        lo = np.minimum(np.searchsorted(q, q - half_width, 'left'), rows)
+        hi = np.maximum(np.searchsorted(q, q + half_width, 'right'), rows + 1)
+    else:
+        lo = rows - _window_length(q, rows, 0, half_width, -1)
+        hi = rows + 1 + _window_length(q, rows, len(q) - 1, half_width, 1)
+    tail = np.zeros(len(q) + 1)
+    tail[:-1] = np.cumsum(np.real(RR)[::-1])[::-1]
+    return (tail[lo] - tail[hi]) / (hi - lo)
 
 
-def resolut2(RR, q, dq):
+def _window_length(q, rows, limit, three_sigma, side):
+    """
+    Number of points from rows + side towards limit (included), up to the first
+    one further than three_sigma from q[rows]; q in ascending order,
+    side -1 (left) or 1 (right).
+    """
+    distance = lambda j: side * (q[j] - q[rows])
+    j = np.searchsorted(q, q[rows] + side * three_sigma, 'left' if side < 0 else 'right') - (side > 0)
+    j = np.minimum(j, rows) if side < 0 else np.maximum(j, rows)
+    # bisection finds the furthest point up to the rounding of q[rows] +- three_sigma,
+    # move it to where the distances themselves cross three_sigma
+    while True:
+        out = distance(j) > three_sigma
+        further = np.clip(j + side, 0, len(q) - 1)
+        grow = ~out & (further != j) & (distance(further) <= three_sigma)
+        if not (out.any() or grow.any()):
+            break
+        j = j - side * out + side * grow
+    last = np.maximum(j, limit) if side < 0 else np.minimum(j, limit)
+    return np.maximum(side * (last - rows), 0)
+
+
+def _tail_sums(first, step, three_sigma, sigma_sq):
+    """
+    Sums of the Gaussian factors of the extrapolated tails of resolut2 and resolut3:
+    at first, first + step, ... while below three_sigma. The distances are
+    accumulated one step at a time, so the tails end where stepping through them would
+    """
+    if not len(first):
+        return np.zeros(0)
+    terms = int(np.max(np.floor((three_sigma - first) / step))) + 2
+    qq = np.empty((len(first), max(terms, 1)))
+    qq[:, 0] = first
+    qq[:, 1:] = step[:, np.newaxis]
+    np.cumsum(qq, axis=1, out=qq)
+    factors = np.exp(-np.square(qq) / sigma_sq[:, np.newaxis])
+    return np.where(qq <= three_sigma[:, np.newaxis], factors, 0.).sum(axis=1)
+
+
+def _resolut_matrix(q, dq, res_mode):
+    """
+    Sparse matrix of resolut2 (res_mode 2) or resolut3 (res_mode 3).
+    Each point is the trapezoidal integral of the reflectivity times the Gaussian
+    of width dq, up to 3 dq. Resolution 2 weights a neighbour with its distance
+    to the next point towards the center, resolution 3 with half the distance
+    between its two neighbours (and leaves out the end points).
+    Where the window goes past the end of the data, the end point is
+    extrapolated as a constant (tail). Points with dq below a quarter of
+    the spacing are copied.
+    """
+    q = np.asarray(q, dtype=np.float64)
+    dq = np.asarray(dq, dtype=np.float64)
     N = len(q)
-    Nm1 = N - 1
-    RRr = np.zeros(N)
-    pi_s = np.sqrt(2.0 * np.pi)
-
-    for i in range(1, Nm1):
-        dqc = np.abs(q[i + 1] - q[i - 1]) / 2.0
-        if dq[i] < dqc / 2.0:
-            RRr[i] = RR[i].real
-        else:
-            sigma_pi = dq[i] * pi_s
-            sigma_sq = 2.0 * np.square(dq[i])
-            # central part
-            RRr[i] = RR[i].real * dqc / sigma_pi
-            # left part
-            k = 1
-            qq = np.abs(q[i] - q[i - 1])
-            deltaq = qq
-            Rk = RR[i - k].real
-            three_sigma = 3.0 * dq[i]
-            while qq <= three_sigma:
-                RRr[i] = RRr[i] + Rk * np.exp(-1.0 * np.square(qq) / sigma_sq) * deltaq / sigma_pi
-                k = k + 1
-                if i - k < 0:
-                    # left tail
-                    deltaq = np.abs(q[1] - q[0])
-                    qq = qq + deltaq
-                    Rk = RR[0].real
-                else:
-                    qq = np.abs(q[i] - q[i - k])
-                    deltaq = np.abs(q[i - k + 1] - q[i - k])
-                    Rk = RR[i - k].real
-            # right part
-            k = 1
-            qq = np.abs(q[i + 1] - q[i])
-            deltaq = qq
-            Rk = RR[i + k].real
-            while qq <= three_sigma:
-                RRr[i] = RRr[i] + Rk * np.exp(-1.0 * np.square(qq) / sigma_sq) * deltaq / sigma_pi
-                k = k + 1
-                if i + k > Nm1:
-                    # right tail
-                    deltaq = np.abs(q[Nm1] - q[Nm1 - 1])
-                    qq = qq + deltaq
-                    Rk = RR[Nm1].real
-                else:
-                    qq = np.abs(q[i + k] - q[i])
-                    deltaq = np.abs(q[i + k] - q[i + k - 1])
-                    Rk = RR[i + k].real
-    # first point
-    dqc = np.abs(q[1] - q[0])
-    if dq[0] < dqc / 2.0:
-        RRr[0] = RR[0].real
+    if q[-1] < q[0]:
+        # the same distances, in ascending order
+        q = -q
+    # number of rows at each end handled separately, with extrapolated tails on their outer side
+    edge = 1 if res_mode == 2 else 2
+    three_sigma = 3.0 * dq
+    sigma_sq = 2.0 * np.square(dq)
+    sigma_pi = dq * np.sqrt(2.0 * np.pi)
+    dqc = np.empty(N)
+    dqc[1:-1] = np.abs(q[2:] - q[:-2]) / 2.0
+    dqc[0] = np.abs(q[1] - q[0])
+    dqc[-1] = np.abs(q[-1] - q[-2])
+    if res_mode == 2:
+        left_width = np.append(np.abs(np.diff(q)), 0.)
+        right_width = np.insert(np.abs(np.diff(q)), 0, 0.)
     else:
-        sigma_pi = dq[0] * pi_s
-        sigma_sq = 2.0 * dq[0] * dq[0]
-        # central part
-        RRr[0] = RR[0].real * dqc / (sigma_pi)
-        # right part
-        k = 1
-        qq = abs(q[1] - q[0])
-        three_sigma = 3.0 * dq[0]
-        while qq <= three_sigma:
-            RRr[0] = RRr[0] + RR[k].real * np.exp(-1.0 * np.square(qq) / sigma_sq) * np.abs(q[k] - q[k - 1]) / sigma_pi
-            k = k + 1
-            if k > Nm1:
-                break
-            qq = np.abs(q[k] - q[0])
-        qq = abs(q[1] - q[0])
-        deltaq = qq
-        while qq <= three_sigma:
-            RRr[0] = RRr[0] + RR[0].real * np.exp(-1.0 * np.square(qq) / sigma_sq) * deltaq / sigma_pi
-            qq = qq + deltaq
-    # last point
-    dqc = abs(q[Nm1] - q[N - 2])
-    if dq[Nm1] < dqc / 2.0:
-        RRr[Nm1] = RR[Nm1].real
-    else:
-        sigma_pi = dq[Nm1] * pi_s
-        sigma_sq = 2.0 * dq[Nm1] * dq[Nm1]
-        # central part
-        RRr[Nm1] = RR[Nm1].real * dqc / sigma_pi
-        # left part
-        k = 1
-        qq = abs(q[Nm1] - q[N - 2])
-        three_sigma = 3.0 * dq[Nm1]
-        while qq <= three_sigma:
-            RRr[Nm1] = RRr[Nm1] + RR[Nm1 - k].real * np.exp(-1.0 * np.square(qq) / sigma_sq) * np.abs(
-                q[Nm1 - k + 1] - q[Nm1 - k]) / sigma_pi
-            k = k + 1
-            if Nm1 - k < 0:
-                break
-            qq = np.abs(q[Nm1] - q[Nm1 - k])
-        qq = abs(q[Nm1] - q[N - 2])
-        deltaq = qq
-        while qq <= three_sigma:
-            RRr[Nm1] = RRr[Nm1] + RR[Nm1].real * np.exp(-1.0 * np.square(qq) / sigma_sq) * deltaq / sigma_pi
-            qq = qq + deltaq
-    return RRr
+        left_width = right_width = np.concatenate(([0.], dqc[1:-1], [0.]))
+    step_first, step_last = dqc[0], dqc[-1]
+    copied = dq < dqc / 2.0
+    if res_mode == 3:
+        # the second point is tested with the resolution of the first one, see below
+        copied_second, copied[1] = dq[0] < dqc[1] / 2.0, False
+    # (row, column, weight) of the nonzero elements
+    rows, cols, weights = [np.arange(N)], [np.arange(N)], [np.where(copied, 1., dqc / sigma_pi)]
+    for side, limit, part, step, end in ((-1, edge - 1, slice(edge, N), step_first, 0),
+                                         (1, N - edge, slice(0, N - edge), step_last, N - 1)):
+        r = np.arange(N)[part]
+        r = r[~copied[r]]
+        count = _window_length(q, r, limit, three_sigma[r], side)
+        row = np.repeat(r, count)
+        col = row + side * (np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count) + 1)
+        rows.append(row)
+        cols.append(col)
+        weights.append(np.exp(-np.square(np.abs(q[row] - q[col])) / sigma_sq[row])
+                       * (left_width if side < 0 else right_width)[col] / sigma_pi[row])
+        # inner rows whose window reaches the limit continue into the tail
+        r = r[(count == side * (limit - r)) & (r >= edge) & (r < N - edge)]
+        rows.append(r)
+        cols.append(np.full(len(r), end))
+        weights.append(_tail_sums(np.abs(q[r] - q[limit]) + step, np.full(len(r), step), three_sigma[r],
+                                  sigma_sq[r]) * step / sigma_pi[r])
+    # tails outwards from the end rows
+    r = np.array([0, N - 1] if res_mode == 2 else [0, 1, N - 2, N - 1])
+    step = np.array([step_first, step_last] if res_mode == 2 else [step_first, dqc[1], dqc[-2], step_last])
+    keep = ~copied[r]
+    r, step = r[keep], step[keep]
+    rows.append(r)
+    cols.append(np.where(r < edge, 0, N - 1))
+    weights.append(_tail_sums(np.where(r < edge, step_first, step_last), step, three_sigma[r], sigma_sq[r])
+                   * step / sigma_pi[r])
+    rows, cols, weights = np.concatenate(rows), np.concatenate(cols), np.concatenate(weights)
+    if res_mode == 3 and copied_second:
+        # then resolut3 copies the first point, and leaves the second one at 0
+        keep = rows > 1
+        rows, cols, weights = np.append(rows[keep], 0), np.append(cols[keep], 0), np.append(weights[keep], 1.)
+    return scipy.sparse.csr_matrix((weights, (rows, cols)), shape=(N, N))
+
+
+def resolut2(RR, q, dq):
+    """
+    Gaussian resolution, integrated over the neighbours within 3 dq
+    (see _resolut_matrix); q in ascending or descending order
+    """
+    return _resolut_matrix(q, dq, 2).dot(np.real(RR))
 
 
 def resolut3(RR, q, dq):
-    N = len(q)
-    Nm1 = N - 1
-    RRr = np.zeros(N)
-    pi_s = np.sqrt(2.0 * np.pi)
-    for i in range(2, Nm1 - 1):
-        dqc = abs(q[i + 1] - q[i - 1]) / 2.0
-        if dq[i] < dqc / 2.0:
-            RRr[i] = RR[i]
-        else:
-            sigma_pi = dq[i] * pi_s
-            sigma_sq = 2.0 * dq[i] * dq[i]
-            # central part
-            RRr[i] = RR[i].real * dqc
-            # left part
-            k = 1
-            qq = np.abs(q[i] - q[i - 1])
-            deltaq = np.abs(q[i] - q[i - 2]) / 2.0
-            Rk = RR[i - k].real
-            three_sigma = 3.0 * dq[i]
-            while qq <= three_sigma:
-                RRr[i] = RRr[i] + Rk * np.exp(-qq * qq / sigma_sq) * deltaq
-                k = k + 1
-                ik = i - k
-                if ik < 1:
-                    # left tail
-                    deltaq = np.abs(q[1] - q[0])
-                    qq = qq + deltaq
-                    Rk = RR[0].real
-                else:
-                    qq = np.abs(q[i] - q[ik])
-                    deltaq = np.abs(q[ik + 1] - q[ik - 1]) / 2.0
-                    Rk = RR[i - k].real
-            # right part
-            k = 1
-            qq = np.abs(q[i + 1] - q[i])
-            deltaq = np.abs(q[i + 2] - q[i]) / 2.0
-            Rk = RR[i + k].real
-            while qq <= three_sigma:
-                RRr[i] = RRr[i] + Rk * np.exp(-1.0 * qq * qq / sigma_sq) * deltaq
-                k = k + 1
-                ik = i + k
-                if ik > Nm1 - 1:
-                    # right tail
-                    deltaq = np.abs(q[Nm1] - q[Nm1 - 1])
-                    qq = qq + deltaq
-                    Rk = RR[Nm1].real
-                else:
-                    qq = np.abs(q[ik] - q[i])
-                    deltaq = np.abs(q[ik + 1] - q[ik - 1]) / 2.0
-                    Rk = RR[ik].real
-            RRr[i] = RRr[i] / sigma_pi
-    # first point
-    dqc = np.abs(q[1] - q[0])
-    if dq[0] < dqc / 2.0:
-        RRr[0] = RR[0].real
-    else:
-        sigma_pi = dq[0] * pi_s
-        sigma_sq = 2.0 * dq[0] * dq[0]
-        # central part
-        RRr[0] = RR[0].real * dqc / (sigma_pi)
-        # right part
-        k = 1
-        qq = np.abs(q[1] - q[0])
-        three_sigma = 3.0 * dq[0]
-        while qq <= three_sigma:
-            RRr[0] = RRr[0] + RR[k].real * np.exp(-qq * qq / sigma_sq) * np.abs(q[k + 1] - q[k - 1]) / (2.0 * sigma_pi)
-            k = k + 1
-            if k > Nm1 - 1:
-                break
-            qq = np.abs(q[k] - q[0])
-        qq = np.abs(q[1] - q[0])
-        deltaq = qq
-        while qq <= three_sigma:
-            RRr[0] = RRr[0] + RR[0].real * np.exp(-qq * qq / sigma_sq) * deltaq / sigma_pi
-            qq = qq + deltaq
-    # second point
-    dqc = np.abs(q[2] - q[0]) / 2
-    if dq[0] < dqc / 2.0:
-        RRr[0] = RR[0].real
-    else:
-        sigma_pi = dq[1] * pi_s
-        sigma_sq = 2.0 * dq[1] * dq[1]
-        # central part
-        RRr[1] = RR[1].real * dqc / (sigma_pi)
-        # right part
-        k = 2
-        qq = np.abs(q[2] - q[1])
-        three_sigma = 3.0 * dq[1]
-        while qq <= three_sigma:
-            RRr[1] = RRr[1] + RR[k].real * np.exp(-qq * qq / sigma_sq) * np.abs(q[k + 1] - q[k - 1]) / (2.0 * sigma_pi)
-            k = k + 1
-            if k > Nm1 - 1:
-                break
-            qq = np.abs(q[k] - q[1])
-        qq = np.abs(q[1] - q[0])
-        deltaq = np.abs(q[2] - q[0]) / 2.0
-        while qq <= three_sigma:
-            RRr[1] = RRr[1] + RR[0].real * np.exp(-qq * qq / sigma_sq) * deltaq / sigma_pi
-            qq = qq + deltaq
-    # point before last
-    dqc = np.abs(q[Nm1] - q[Nm1 - 2]) / 2.0
-    if dq[Nm1 - 1] < dqc / 2.0:
-        RRr[Nm1 - 1] = RR[Nm1 - 1].real
-    else:
-        sigma_pi = dq[Nm1 - 1] * pi_s
-        sigma_sq = 2.0 * dq[Nm1 - 1] * dq[Nm1 - 1]
-        # central part
-        RRr[Nm1 - 1] = RR[Nm1 - 1].real * dqc / (sigma_pi)
-        # left part
-        k = 2
-        qq = np.abs(q[Nm1 - 1] - q[Nm1 - 2])
-        three_sigma = 3.0 * dq[Nm1 - 1]
-        while qq <= three_sigma:
-            RRr[Nm1 - 1] = RRr[Nm1 - 1] + RR[Nm1 - k].real * np.exp(-qq * qq / sigma_sq) * np.abs(
-                q[Nm1 - k + 1] - q[Nm1 - k - 1]) / (2.0 * sigma_pi)
-            k = k + 1
-            if Nm1 - k < 1:
-                break
-            qq = abs(q[Nm1 - 1] - q[Nm1 - k])
-        qq = np.abs(q[Nm1] - q[Nm1 - 1])
-        deltaq = np.abs(q[Nm1] - q[Nm1 - 2]) / 2.0
-        while qq <= three_sigma:
-            RRr[Nm1 - 1] = RRr[Nm1 - 1] + RR[Nm1].real * np.exp(-qq * qq / sigma_sq) * deltaq / sigma_pi
-            qq = qq + deltaq
-    # last point
-    dqc = abs(q[Nm1] - q[Nm1 - 1])
-    if dq[Nm1] < dqc / 2.0:
-        RRr[Nm1] = RR[Nm1].real
-    else:
-        sigma_pi = dq[Nm1] * pi_s
-        sigma_sq = 2.0 * dq[Nm1] * dq[Nm1]
-        # central part
-        RRr[Nm1] = RR[Nm1].real * dqc / (sigma_pi)
-        # left part
-        k = 1
-        qq = abs(q[Nm1] - q[Nm1 - 1])
-        three_sigma = 3.0 * dq[Nm1]
-        while qq <= three_sigma:
-            RRr[Nm1] = RRr[Nm1] + RR[Nm1 - k].real * np.exp(-qq * qq / sigma_sq) * np.abs(
-                q[Nm1 - k + 1] - q[Nm1 - k - 1]) / (2.0 * sigma_pi)
-            k = k + 1
-            if Nm1 - k < 1:
-                break
-            qq = abs(q[Nm1] - q[Nm1 - k])
-        qq = abs(q[Nm1] - q[Nm1 - 1])
-        deltaq = qq
-        while qq <= three_sigma:
-            RRr[Nm1] = RRr[Nm1] + RR[Nm1].real * np.exp(-qq * qq / sigma_sq) * deltaq / sigma_pi
-            qq = qq + deltaq
-    return RRr
+    """
+    Gaussian resolution, integrated over the neighbours within 3 dq with
+    centered weights (see _resolut_matrix); q in ascending or descending order
+    """
+    return _resolut_matrix(q, dq, 3).dot(np.real(RR))
+
 
 ## 1/sqrt(2pi) constant so we don't have to recalculate it.
 SQRT2PI = 1.0/np.sqrt(2.0*np.pi)
@@ -543,20 +1870,166 @@ def gaussian(x, mu, sig):
     """ Gaussian function """
     return SQRT2PI/sig * np.exp(-np.power(x - mu, 2.) / (2 * np.power(sig, 2.)))
 
+## half width of the gaussian_resolution kernel, in standard deviations:
+## the weights left out are below exp(-GAUSS_CUTOFF**2/2) of the peak
+GAUSS_CUTOFF = 8.0
+
+
+def gaussian_kernel(q, dq):
+    """
+    Sparse (CSR) matrix of gaussian_resolution, with rows normalized to 1.
+    Column i is the Gaussian of width dq[i] around q[i], on the points
+    within GAUSS_CUTOFF * dq[i] of q[i], found by bisection in the sorted q.
+    """
+    q = np.asarray(q, dtype=np.float64)
+    dq = np.asarray(dq, dtype=np.float64)
+    order = np.argsort(q, kind='mergesort')
+    q_sorted = q[order]
+    lo = np.searchsorted(q_sorted, q - GAUSS_CUTOFF * dq, 'left')
+    hi = np.searchsorted(q_sorted, q + GAUSS_CUTOFF * dq, 'right')
+    indptr = np.concatenate(([0], np.cumsum(hi - lo)))
+    # row of every point of every window, without a loop over the columns
+    rows = order[np.arange(indptr[-1]) - np.repeat(indptr[:-1] - lo, hi - lo)]
+    inv_dq = np.repeat(1.0 / dq, hi - lo)
+    weights = q[rows] - np.repeat(q, hi - lo)
+    weights *= inv_dq
+    weights *= weights
+    weights *= -0.5
+    np.exp(weights, out=weights)
+    weights *= inv_dq
+    # the constant factor of the Gaussians cancels in the normalization
+    kernel = scipy.sparse.csc_matrix((weights, rows, indptr), shape=(len(q), len(q))).tocsr()
+    kernel.data /= np.repeat(np.add.reduceat(kernel.data, kernel.indptr[:-1]), np.diff(kernel.indptr))
+    return kernel
+
+
 def gaussian_resolution(RR, q, dq):
     """
-        Faster Gaussian resolution.
+        Faster Gaussian resolution: each point of RR is spread with a Gaussian
+        of width dq, and the result is normalized by the sum of the Gaussians.
+        Only the points within GAUSS_CUTOFF * dq are used (see gaussian_kernel).
         :param ndarrray RR: reflectivity array
         :param ndarray q: q values
         :param ndarray dq: value of dq for each q value
     """
-    r_ = np.zeros(q.size)
-    n_ = np.zeros(q.size)
-    for i in range(q.size):
-        gauss_ = gaussian(q, q[i], dq[i])
-        n_ += gauss_
-        r_ += RR[i].real * gauss_
-    return r_/n_
+    return gaussian_kernel(q, dq).dot(np.real(RR))
+
+## Gauss-Hermite nodes per data point of GaussHermiteResolution
+GAUSS_HERMITE_NODES = 7
+## spacing (in units of dq) of the grid the nodes are interpolated on, 0 calculates every node
+GAUSS_HERMITE_MERGE = 0.0
+
+
+class GaussHermiteResolution(object):
+    """
+    Gaussian resolution integrated on the theory rather than on the data points.
+    The reflectivity is calculated at the Gauss-Hermite nodes q + dq x_m of every
+    point, and R_res(q) = sum_m w_m R(q + dq x_m), which is exact when R is a
+    polynomial of degree below 2 * nodes over the width of the resolution.
+    Narrow features (e.g. the fringes of thick films) are then smeared correctly
+    even where the data points do not resolve them.
+    Nodes are put on a shared grid in units of the local resolution, with a
+    spacing of merge (0 only shares identical nodes), so neighbouring points
+    with overlapping resolution reuse each other's nodes; R at a node is then
+    interpolated linearly between the grid points around it. The reflectivity is even in Q, so nodes
+    below 0 are folded back.
+    Usage: R_res = op(R(op.q)), with R calculated at the nodes op.q
+    """
+    def __init__(self, q, dq, nodes=GAUSS_HERMITE_NODES, merge=GAUSS_HERMITE_MERGE):
+        q = np.asarray(q, dtype=np.float64)
+        dq = np.asarray(dq, dtype=np.float64)
+        x, w = np.polynomial.hermite_e.hermegauss(nodes)
+        points = (q[:, np.newaxis] + dq[:, np.newaxis] * x).ravel()
+        rows = np.repeat(np.arange(len(q)), nodes)
+        weights = np.tile(w / w.sum(), len(q))
+        if merge > 0:
+            # position in units of the resolution (d units / dQ = 1 / dq along the data)
+            order = np.argsort(q)
+            q_sorted, dq_sorted = q[order], dq[order]
+            u = np.concatenate(([0.], np.cumsum(np.diff(q_sorted) * (1. / dq_sorted[1:] + 1. / dq_sorted[:-1]) / 2.)))
+            to_units = lambda x: np.interp(x, q_sorted, u) + np.minimum(x - q_sorted[0], 0.) / dq_sorted[0] \
+                + np.maximum(x - q_sorted[-1], 0.) / dq_sorted[-1]
+            to_q = lambda x: np.interp(x, u, q_sorted) + np.minimum(x - u[0], 0.) * dq_sorted[0] \
+                + np.maximum(x - u[-1], 0.) * dq_sorted[-1]
+            # each node is interpolated linearly between the two grid points around it
+            position = to_units(points) / merge
+            left = np.floor(position)
+            fraction = position - left
+            rows = np.concatenate((rows, rows))
+            weights = np.concatenate((weights * (1. - fraction), weights * fraction))
+            grid, index = np.unique(np.concatenate((left, left + 1.)), return_inverse=True)
+            self.q = np.abs(to_q(grid * merge))
+        else:
+            self.q, index = np.unique(np.abs(points), return_inverse=True)
+        self.matrix = scipy.sparse.csr_matrix((weights, (rows, index.ravel())), shape=(len(q), len(self.q)))
+
+    def __call__(self, RR):
+        """ Resolution of the reflectivity RR at the nodes self.q, shape (K,), or of each row of a (C, K) array """
+        return self.matrix.dot(np.real(RR).T).T
+
+
+## a ResolutionOperator keeps its matrix dense when at least this fraction
+## of the elements is nonzero (a dense mat-vec is faster then) ...
+DENSE_RESOLUTION_FILL = 0.25
+## ... and the matrix has at most this many elements
+DENSE_RESOLUTION_SIZE = 1 << 22
+
+
+class ResolutionOperator(object):
+    """
+    resolut(RR, q, dq, res_mode) as a precomputed matrix, for a Q grid and
+    resolution that do not change between calls (e.g. a dataset during a fit).
+    The matrix is sparse (see gaussian_kernel and _resolut_matrix), or dense
+    when it is small and mostly filled, and applying it is one mat-vec.
+    """
+    def __init__(self, q, dq, res_mode=4):
+        if res_mode not in (2, 3, 4):
+            raise ValueError("ResolutionOperator is for resolution modes 2, 3 and 4")
+        kernel = gaussian_kernel(q, dq) if res_mode == 4 else _resolut_matrix(q, dq, res_mode)
+        size = kernel.shape[0] * kernel.shape[1]
+        if size <= DENSE_RESOLUTION_SIZE and kernel.nnz >= DENSE_RESOLUTION_FILL * size:
+            kernel = kernel.toarray()
+        self.matrix = kernel
+
+    def __call__(self, RR):
+        """ Resolution of the reflectivity RR, shape (N,), or of each row of a (C, N) array """
+        return self.matrix.dot(np.real(RR).T).T
+
+
+class ResolutionCache(object):
+    """
+    The ResolutionOperator of each (q, dq) pair, kept between calls and looked
+    up by hashes of the contents of q and dq. At most max_size operators are
+    kept, the least recently used ones are dropped first.
+    """
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self._operators = OrderedDict()
+
+    def _lookup(self, kind, q, dq, build):
+        q = np.ascontiguousarray(q, dtype=np.float64)
+        dq = np.ascontiguousarray(dq, dtype=np.float64)
+        key = (kind, len(q), hash(q.tobytes()), hash(dq.tobytes()))
+        op = self._operators.pop(key, None)
+        if op is None:
+            op = build(q, dq)
+        self._operators[key] = op
+        while len(self._operators) > self.max_size:
+            self._operators.popitem(last=False)
+        return op
+
+    def operator(self, q, dq, res_mode=4):
+        return self._lookup(res_mode, q, dq, lambda q, dq: ResolutionOperator(q, dq, res_mode))
+
+    def gauss_hermite(self, q, dq, nodes=GAUSS_HERMITE_NODES, merge=GAUSS_HERMITE_MERGE):
+        """ GaussHermiteResolution for q and dq """
+        return self._lookup(('gauss_hermite', nodes, merge), q, dq,
+                            lambda q, dq: GaussHermiteResolution(q, dq, nodes, merge))
+
+    def __call__(self, RR, q, dq, res_mode=4):
+        """ Same as resolut(RR, q, dq, res_mode) """
+        return self.operator(q, dq, res_mode)(RR)
+
 
 def resolut(RR, q, dq, res_mode):
     """ Choose which resolution implementation to use """
@@ -31,6 +31,8 @@ class resolutionselector(QtWidgets.QWidget,Ui_resolution):
         self.comboBox_resolution_mode.addItem("Custom")
         self.resolution_mode='TOF'
         self.comboBox_resolution_mode.activated[str].connect(self.resolution_mode_changed)
+        self.spinBox_nodes.setValue(lu.get_resolution_nodes())
+        self.spinBox_nodes.valueChanged[int].connect(self.nodes_changed)
         self.resolution_mode_changed(self.resolution_mode)
         self.apply_btn=self.buttonBox.button(QtWidgets.QDialogButtonBox.Apply)
         self.apply_btn.clicked.connect(self.test_script)
@@ -72,12 +74,17 @@ class resolutionselector(QtWidgets.QWidget,Ui_resolution):
                 sys.path.append(self.tempdir)
             #Force reloading of the resolution function
             import resolution
-            if hasattr(resolution,'resolution'):
-                del resolution.resolution
+            for name in ('resolution','wavelength'):
+                if hasattr(resolution,name):
+                    delattr(resolution,name)
             reload(resolution)
             self.update_text_from_file()
             self.update_plot()
 
+    def nodes_changed(self,nodes):
+        lu.set_resolution_nodes(nodes)
+        self.resolution_changed.emit()
+
     def update_text_from_file(self):
         self.ignore_text_changed=True
         filename=os.path.join(self.tempdir,'resolution.py')
@@ -1,5 +1,6 @@
 import tempfile
 import shutil
+import hashlib
 import numpy
 
 class tempdir(object):
@@ -37,3 +38,54 @@ def calculated_color():
 
 def get_minimizer():
     return 'leastsq'
+
+
+## Gauss-Hermite nodes per data point, set in the resolution dialog
+_resolution_nodes=0
+
+
+def set_resolution_nodes(nodes):
+    global _resolution_nodes
+    _resolution_nodes=int(nodes)
+
+
+def get_resolution_nodes():
+    """
+    Gauss-Hermite nodes per data point for the resolution, the reflectivity
+    is then calculated at the nodes (see reflection.GaussHermiteResolution).
+    0 applies the resolution to the reflectivity at the data points.
+    """
+    return _resolution_nodes
+
+
+def get_wavelength(Q):
+    """
+    Wavelength of each Q point, from the wavelength function of the resolution
+    module, for layers with tabulated nsld (see layer.Layer.nsld_at).
+    Q is half the momentum transfer, as for the resolution function.
+    None if the resolution module does not define one.
+    """
+    import resolution
+    if not hasattr(resolution, 'wavelength'):
+        return None
+    return numpy.broadcast_to(numpy.asarray(resolution.wavelength(Q), dtype=numpy.float64), numpy.shape(Q))
+
+
+def group_by_q(datasets):
+    """
+    Group datasets that have the same Q array (e.g. the polarization channels
+    of one run), so that the reflection is calculated once per Q grid.
+    Q arrays are compared by a hash of their content.
+    Returns a list of (Q, list of indices into datasets), in order of first appearance
+    """
+    groups=[]
+    position={}
+    for i,ds in enumerate(datasets):
+        Q=numpy.ascontiguousarray(ds.Q)
+        key=(Q.dtype.str,Q.shape,hashlib.sha1(Q.tobytes()).hexdigest())
+        if key in position:
+            groups[position[key]][1].append(i)
+        else:
+            position[key]=len(groups)
+            groups.append((ds.Q,[i]))
+    return groups
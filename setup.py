@@ -14,4 +14,5 @@ setup(
     scripts=["bin/licorne"],
     packages=['licorne'],
     package_data=package_data,
+    extras_require={'numba': ['numba']},
 )
@@ -1,7 +1,10 @@
-from licorne.layer import Layer
+from licorne.layer import Layer, MSLD, RoughnessModel
 from licorne.SampleModel import SampleModel
+from licorne.model_adapter import ModelAdapter
+from licorne.reflection import reflection, reflection_domains, spin_av_domains, spin_av_multi, stack_array
 import numpy as np
 import unittest
+import yaml
 
 class TestSampleModelClass(unittest.TestCase):
 
@@ -87,6 +90,144 @@ class TestSampleModelClass(unittest.TestCase):
         self.assertEqual([s.name for s in [sm.incoming_media]+sm.layers+[sm.substrate]],
                          expected_names)
 
+    def test_repeats(self):
+        sm=SampleModel()
+        for name in 'abcd':
+            sm.addItem(Layer(name=name,thickness=10.))
+        sm.add_repeat(1,2,3)
+        self.assertRaises(ValueError,sm.add_repeat,2,3,2)
+        self.assertRaises(ValueError,sm.add_repeat,3,4,2)
+        expanded,index=sm.expanded_layers()
+        self.assertEqual([l.name for l in expanded],
+                         ['incoming media','a','b','c','b','c','b','c','d','substrate'])
+        self.assertEqual(index,[0,1,2,3,2,3,2,3,4,5])
+        #layers do not move into or out of a repeated block
+        sm.move_down_1([2])
+        sm.move_up_1([1])
+        sm.move_down_1([0])
+        self.assertEqual([l.name for l in sm.layers],['a','b','c','d'])
+        sm.move_down_1([1])
+        self.assertEqual([l.name for l in sm.layers],['a','c','b','d'])
+        self.assertEqual((sm.repeats[0].first,sm.repeats[0].last),(1,2))
+        sm.addItem(Layer(name='e'),0)
+        self.assertEqual((sm.repeats[0].first,sm.repeats[0].last),(2,3))
+        sm.delItem(2)
+        self.assertEqual((sm.repeats[0].first,sm.repeats[0].last),(2,2))
+        sm.delItem(2)
+        self.assertEqual(sm.repeats,[])
+
+    def test_domains(self):
+        sm=SampleModel()
+        for name in 'abc':
+            sm.addItem(Layer(name=name,thickness=10.,nsld_real=2e-6,msld_rho=1e-6,msld_theta=90.))
+        self.assertRaises(ValueError,sm.add_domain,{3:(1e-6,90.,180.)})
+        sm.add_domain({1:(1e-6,90.,180.)},weight=2.)
+        sm.add_domain({},weight=1.)
+        weights,states=sm.domain_states()
+        np.testing.assert_array_equal(weights,[2.,1.])
+        self.assertEqual([l.msld.phi.value for l in states[0]],[0.,0.,0.,180.,180.,0.,0.,0.])
+        self.assertEqual([l.msld.phi.value for l in states[1]],[0.]*8)
+        #the magnetization stays with its layer
+        sm.move_up_1([1])
+        self.assertEqual(list(sm.domains[0].msld),[0])
+        sm.addItem(Layer(name='d'),0)
+        self.assertEqual(list(sm.domains[0].msld),[1])
+        sm.delItem(1)
+        self.assertEqual(sm.domains[0].msld,{})
+        #weights and magnetizations of the domains are fit parameters
+        sm.domains[1].msld[0]=MSLD(1e-6,0.,0.)
+        ma=ModelAdapter(sm)
+        params=ma.params_from_model()
+        self.assertEqual(len(params),7*5+1+4)
+        params['Domain1___weight'].value=0.5
+        params['Domain1___msld0___theta'].value=45.
+        params['a___thickness'].value=12.
+        ma.update_model_from_params(params)
+        self.assertEqual(sm.domains[1].weight.value,0.5)
+        self.assertEqual(sm.domains[1].msld[0].theta.value,45.)
+        self.assertEqual(sm.layers[1].thickness.value,12.)
+        self.assertIs(ma.numeric_parameter(params,'Domain0___weight'),sm.domains[0].weight)
+
+    def test_fluctuations(self):
+        sm=SampleModel()
+        sm.substrate.nsld_real=2e-6
+        sm.addItem(Layer(name='a',thickness=200.,nsld_real=6e-6,msld_rho=1e-6,msld_theta=90.))
+        sm.addItem(Layer(name='b',thickness=50.,nsld_real=3e-6,roughness=5.))
+        self.assertRaises(ValueError,sm.set_fluctuations,{(2,'thickness'):1.},10)
+        self.assertRaises(ValueError,sm.set_fluctuations,{(0,'name'):1.},10)
+        self.assertIsNone(sm.set_fluctuations({(0,'thickness'):10.},0))
+        q=np.linspace(0.002,0.05,200)
+        n=[[0,0,1],[0,0,-1]]
+        eff=np.ones(len(q))
+        average=lambda: np.real(spin_av_domains(reflection_domains(q,sm.sample_states()[1]),
+                                                sm.sample_states()[0],n,n,eff,eff))
+        #no spread: every realization is the sample itself
+        sm.set_fluctuations({(0,'thickness'):0.,(1,'roughness'):0.},3,'gauss')
+        self.assertEqual(len(sm.sample_states()[1]),9)
+        np.testing.assert_allclose(average(),np.real(spin_av_multi(reflection(q,sm.sublayers()),n,n,eff,eff)),
+                                   rtol=1e-12)
+        #the quadrature and the Monte-Carlo averages agree, and the seed fixes the realizations
+        sm.set_fluctuations({(0,'thickness'):10.},16,'gauss')
+        gauss=average()
+        sm.set_fluctuations({(0,'thickness'):10.},400,seed=1)
+        monte_carlo=average()
+        np.testing.assert_allclose(monte_carlo,gauss,rtol=0.1)
+        np.testing.assert_array_equal(average(),monte_carlo)
+        self.assertEqual(sm.layers[0].thickness.value,200.)
+        #the fluctuations stay with their layer
+        sm.addItem(Layer(name='c'),0)
+        self.assertEqual(list(sm.fluctuations.widths),[(1,'thickness')])
+        sm.delItem(1)
+        self.assertEqual(sm.fluctuations.widths,{})
+
+    def test_graded_states(self):
+        sm=SampleModel()
+        sm.substrate.nsld_real=2e-6
+        sm.substrate.roughness=6.
+        sm.substrate.roughness_model=RoughnessModel.TANH
+        sm.substrate.sublayers=4
+        for name in 'ab':
+            sm.addItem(Layer(name=name,thickness=60.,nsld_real=5e-6,msld_rho=1e-6,msld_theta=90.,roughness=8.,
+                             roughness_model=RoughnessModel.TANH,sublayers=4))
+        sm.add_domain({1:(1e-6,90.,180.)})
+        sm.add_domain({})
+        sm.graded_sublayers=True
+        q=np.linspace(0.002,0.1,150)
+        weights,states=sm.sample_states()
+        self.assertRaises(ValueError,stack_array,states)
+        #each state keeps its graded interfaces
+        R=reflection_domains(q,states)
+        for k,state in enumerate(states):
+            np.testing.assert_allclose(R.data[:,:,k],reflection(q,state).data,rtol=1e-12,atol=1e-14)
+        sm.graded_sublayers=False
+        self.assertFalse(np.allclose(reflection_domains(q,sm.sample_states()[1]).data,R.data,rtol=1e-6,atol=0))
+
+    def test_state_round_trip(self):
+        sm=SampleModel()
+        sm.substrate.nsld_real=2e-6
+        for name in 'abcd':
+            sm.addItem(Layer(name=name,thickness=20.,nsld_real=4e-6,msld_rho=1e-6,msld_theta=90.,roughness=3.))
+        sm.add_repeat(1,2,5)
+        sm.add_domain({1:(1e-6,90.,180.)},weight=2.)
+        sm.add_domain({},weight=1.)
+        sm.set_fluctuations({(0,'thickness'):2.,(3,'msld.phi'):10.},3,'gauss')
+        sm.graded_sublayers=True
+        loaded=SampleModel()
+        loaded.set_state(yaml.load(yaml.dump(sm.state()),Loader=yaml.Loader))
+        self.assertEqual([(r.first,r.last,r.repetitions) for r in loaded.repeats],[(1,2,5)])
+        self.assertEqual([d.weight.value for d in loaded.domains],[2.,1.])
+        self.assertEqual(loaded.fluctuations.widths,sm.fluctuations.widths)
+        self.assertTrue(loaded.graded_sublayers)
+        q=np.linspace(0.002,0.05,100)
+        weights,states=sm.sample_states()
+        loaded_weights,loaded_states=loaded.sample_states()
+        np.testing.assert_array_equal(loaded_weights,weights)
+        np.testing.assert_array_equal(reflection_domains(q,loaded_states).data,reflection_domains(q,states).data)
+        #state files from before repeats, domains, fluctuations and graded sublayers
+        old=SampleModel()
+        old.set_state(dict(layers=sm.layers,incoming_media=sm.incoming_media,substrate=sm.substrate))
+        self.assertEqual((old.repeats,old.domains,old.fluctuations,old.graded_sublayers),([],[],None,False))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,225 @@
+import unittest
+import copy
+import numpy as np
+from licorne.SampleModel import SampleModel
+from licorne.layer import Layer, RoughnessModel
+from licorne.data_model import data_model
+from licorne.experimental_data import experimental_data
+from licorne.model_adapter import ModelAdapter
+from licorne.fit_worker import FitWorker
+import licorne.fit_worker
+import licorne.reflection
+import licorne.DefaultResolutionTOF
+import licorne.DefaultResolutionMONO
+from licorne.reflection import reflection, resolut, spin_av, GaussHermiteResolution
+
+
+class FitWorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        sm = SampleModel()
+        sm.substrate.nsld = 3.533e-6
+        sm.substrate.roughness = 5.
+        sm.substrate.roughness_model = RoughnessModel.TANH
+        sm.substrate.sublayers = 3
+        sm.addItem(Layer(thickness=40.1, nsld_real=2.6e-6, nsld_imaginary=-3e-8, msld_rho=1e-6, msld_theta=90,
+                         msld_phi=20, sublayers=5, roughness=8, roughness_model=RoughnessModel.TANH))
+        sm.addItem(Layer(thickness=74.9, nsld_real=2.7e-6, nsld_imaginary=-3e-8, msld_rho=8e-7, msld_theta=90,
+                         msld_phi=60, sublayers=4, roughness=5.7, roughness_model=RoughnessModel.ERFC))
+        for l in sm.layers:
+            for par in (l.thickness, l.nsld_real, l.msld.phi, l.roughness, l.msld.rho):
+                par.vary = True
+        sm.substrate.nsld_real.vary = True
+        dm = data_model()
+        for pol in ([0, 0, 1.], [1., 0, 0]):
+            ds = experimental_data()
+            ds.Q = np.linspace(0.005, 0.12, 80)
+            ds.R = np.ones(80)
+            ds.E = np.full(80, 0.1)
+            ds.sigmaQ = 0.02 * ds.Q / 2.
+            ds.pol_Polarizer = pol
+            ds.pol_Analyzer = [0, 0, 1.]
+            dm.datasets.append(ds)
+        self.worker = FitWorker()
+        self.worker.sample_model = sm
+        self.worker.data_model = dm
+        self.worker.group_datasets()
+
+
+class TestJacobian(FitWorkerTestCase):
+    def test_jacobian_matches_finite_differences(self):
+        params = ModelAdapter(copy.deepcopy(self.worker.sample_model)).params_from_model()
+        keys = [k for k in params if params[k].vary]
+        jacobian = self.worker.calculate_jacobian(params)
+        self.assertEqual(jacobian.shape, (160, len(keys)))
+        for i, k in enumerate(keys):
+            value = params[k].value
+            h = 1e-5 * abs(value)
+            params[k].value = value + h
+            plus = self.worker.calculate_residuals(params)
+            params[k].value = value - h
+            minus = self.worker.calculate_residuals(params)
+            params[k].value = value
+            column = (plus - minus) / (2 * h)
+            self.assertLess(np.abs(jacobian[:, i] - column).max(), 1e-6 * np.abs(column).max(), k)
+        self.assertTrue(self.worker.analytic_jacobian(params))
+
+    def test_graded_sublayers(self):
+        # the analytic derivatives are for constant sublayers, they do not describe graded ones
+        self.worker.sample_model.graded_sublayers = True
+        params = ModelAdapter(copy.deepcopy(self.worker.sample_model)).params_from_model()
+        self.assertFalse(self.worker.analytic_jacobian(params))
+        jacobian = self.worker.calculate_jacobian(params)
+        k = 'Layer1___roughness'
+        i = [key for key in params if params[key].vary].index(k)
+        value = params[k].value
+        h = 1e-5 * abs(value)
+        params[k].value = value + h
+        plus = self.worker.calculate_residuals(params)
+        params[k].value = value - h
+        minus = self.worker.calculate_residuals(params)
+        column = (plus - minus) / (2 * h)
+        self.assertGreater(np.abs(jacobian[:, i] - column).max(), 1e-3 * np.abs(column).max())
+
+
+class TestSharedQ(FitWorkerTestCase):
+    def test_datasets_grouped_by_q(self):
+        dm = self.worker.data_model
+        other = copy.deepcopy(dm.datasets[0])
+        other.Q = np.linspace(0.01, 0.1, 50)
+        other.R = np.ones(50)
+        other.E = np.full(50, 0.1)
+        other.sigmaQ = 0.02 * other.Q / 2.
+        dm.datasets.insert(1, other)
+        # a copy of the first Q array is still the same grid
+        dm.datasets[2].Q = dm.datasets[0].Q.copy()
+        self.worker.group_datasets()
+        self.assertEqual([indices for Q, indices in self.worker.q_groups], [[0, 2], [1]])
+
+    def test_no_data(self):
+        self.worker.data_model = data_model()
+        self.worker.group_datasets()
+        params = ModelAdapter(copy.deepcopy(self.worker.sample_model)).params_from_model()
+        with np.errstate(all='ignore'):
+            self.assertEqual(self.worker.calculate_residuals(params).shape, (0,))
+
+    def test_reflection_once_per_group(self):
+        calls = []
+
+        def counting_reflection(*args, **kwargs):
+            calls.append(1)
+            return reflection(*args, **kwargs)
+
+        params = ModelAdapter(copy.deepcopy(self.worker.sample_model)).params_from_model()
+        original = licorne.fit_worker.reflection
+        licorne.fit_worker.reflection = counting_reflection
+        try:
+            chi = self.worker.calculate_residuals(params)
+        finally:
+            licorne.fit_worker.reflection = original
+        self.assertEqual(len(calls), 1)
+        # same residuals as one reflection per dataset
+        sublayers = self.worker.sample_model.sublayers()
+        expected = []
+        for ds in self.worker.data_model.datasets:
+            q = ds.Q / 2.
+            ones = np.ones(len(q), dtype=np.complex128)
+            rr = np.real(spin_av(reflection(q, sublayers), ds.pol_Polarizer, ds.pol_Analyzer, ones, ones))
+            rrr = resolut(rr, q, ds.sigmaQ, 4) * self.worker.data_model.theory_factor + self.worker.data_model.background
+            expected.append((rrr / self.worker.data_model.experiment_factor - ds.R) / ds.E)
+        np.testing.assert_allclose(chi, np.concatenate(expected), rtol=1e-12, atol=1e-12)
+
+    def test_tabulated_nsld(self):
+        sm = self.worker.sample_model
+        sm.layers[1].nsld_table = ([1., 20.], [2e-6 - 1e-8j, 4e-6 - 1e-6j])
+        for ds in self.worker.data_model.datasets:
+            ds.wavelength = 4 * np.pi * np.sin(0.01) / ds.Q
+        params = ModelAdapter(copy.deepcopy(sm)).params_from_model()
+        for nodes in (0, 5):
+            licorne.fit_worker.lu.set_resolution_nodes(nodes)
+            try:
+                chi = self.worker.calculate_residuals(params)
+            finally:
+                licorne.fit_worker.lu.set_resolution_nodes(0)
+            sublayers = sm.sublayers()
+            expected = []
+            for ds in self.worker.data_model.datasets:
+                q = ds.Q / 2.
+                if nodes:
+                    op = GaussHermiteResolution(q, ds.sigmaQ, nodes)
+                    q_nodes = op.q
+                else:
+                    op = lambda rr: resolut(rr, q, ds.sigmaQ, 4)
+                    q_nodes = q
+                ones = np.ones(len(q_nodes), dtype=np.complex128)
+                wavelength = np.interp(2 * q_nodes, ds.Q, ds.wavelength)
+                rr = np.real(spin_av(reflection(q_nodes, sublayers, wavelength=wavelength),
+                                     ds.pol_Polarizer, ds.pol_Analyzer, ones, ones))
+                rrr = op(rr) * self.worker.data_model.theory_factor + self.worker.data_model.background
+                expected.append((rrr / self.worker.data_model.experiment_factor - ds.R) / ds.E)
+            np.testing.assert_allclose(chi, np.concatenate(expected), rtol=1e-12, atol=1e-12)
+            # the tables change the reflectivity
+            for ds in self.worker.data_model.datasets:
+                ds.wavelength = None
+            self.assertFalse(np.allclose(self.worker.calculate_residuals(params), chi, rtol=1e-6))
+            for ds in self.worker.data_model.datasets:
+                ds.wavelength = 4 * np.pi * np.sin(0.01) / ds.Q
+
+    def test_workspace_products(self):
+        params = ModelAdapter(copy.deepcopy(self.worker.sample_model)).params_from_model()
+        expected = self.worker.calculate_residuals(params)
+        allocations = []
+        identity = licorne.reflection._identity
+        licorne.reflection._identity = lambda *args: allocations.append(args) or identity(*args)
+        try:
+            chi = self.worker.calculate_residuals(params)
+        finally:
+            licorne.reflection._identity = identity
+        # the products are written into the workspace of the Q grid
+        self.assertEqual(allocations, [])
+        np.testing.assert_array_equal(chi, expected)
+        sublayers = self.worker.sample_model.sublayers()
+        R = reflection(self.worker.q_groups[0][0] / 2., sublayers, backend='numpy')
+        np.testing.assert_array_equal(self.worker.workspaces[0].R.data, R.data)
+
+    def test_gauss_hermite_resolution(self):
+        calls = []
+
+        def counting_reflection(*args, **kwargs):
+            calls.append(len(args[0]))
+            return reflection(*args, **kwargs)
+
+        params = ModelAdapter(copy.deepcopy(self.worker.sample_model)).params_from_model()
+        original = licorne.fit_worker.reflection
+        licorne.fit_worker.reflection = counting_reflection
+        licorne.fit_worker.lu.set_resolution_nodes(5)
+        try:
+            chi = self.worker.calculate_residuals(params)
+        finally:
+            licorne.fit_worker.reflection = original
+            licorne.fit_worker.lu.set_resolution_nodes(0)
+        # the datasets share the resolution, so the nodes are calculated once
+        self.assertEqual(calls, [5 * 80])
+        sublayers = self.worker.sample_model.sublayers()
+        expected = []
+        for ds in self.worker.data_model.datasets:
+            op = GaussHermiteResolution(ds.Q / 2., ds.sigmaQ, 5)
+            ones = np.ones(len(op.q), dtype=np.complex128)
+            rrr = op(spin_av(reflection(op.q, sublayers), ds.pol_Polarizer, ds.pol_Analyzer, ones, ones))
+            rrr = rrr * self.worker.data_model.theory_factor + self.worker.data_model.background
+            expected.append((rrr / self.worker.data_model.experiment_factor - ds.R) / ds.E)
+        np.testing.assert_allclose(chi, np.concatenate(expected), rtol=1e-12, atol=1e-12)
+
+
+class TestResolutionModules(unittest.TestCase):
+    def test_wavelength(self):
+        # the argument is half the momentum transfer, as for resolution
+        q = np.array([0., 0.01, 0.05])
+        Q = 2 * q[1:]
+        wavelength = licorne.DefaultResolutionTOF.wavelength(q)
+        self.assertEqual(wavelength[0], np.inf)
+        np.testing.assert_allclose(wavelength[1:], 4 * np.pi * np.sin(0.01) / Q)
+        np.testing.assert_array_equal(licorne.DefaultResolutionMONO.wavelength(q), [5., 5., 5.])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,8 @@
 import unittest,os
 import numpy as np
+from copy import deepcopy
 from licorne.layer import Layer,RoughnessModel
-from licorne.generateSublayers import generateSublayers
+from licorne.generateSublayers import generateSublayers,generateSublayerStack,expand_repeats,SublayerRepeat,GradedSublayer
 
 def layer_data_for_testing():
     Incoming=Layer(thickness=np.inf,
@@ -127,5 +128,67 @@ class TestGenerateSublayers(unittest.TestCase):
             self.assertAlmostEqual(t,layers[int(l)].msld.theta.value)
             self.assertAlmostEqual(p,layers[int(l)].msld.phi.value)
 
+    def test_repeated_blocks(self):
+        layers=layer_data_for_testing()
+        repeats=[(2,3,4),(5,5,3),(7,8,2)]
+        expanded,index=expand_repeats(layers,repeats)
+        self.assertEqual(len(expanded),len(layers)+2*3+2+2)
+        for l,i in zip(expanded,index):
+            self.assertIs(l,layers[i])
+        expected=generateSublayers(expanded)[0]
+        stack=generateSublayerStack(layers,repeats)
+        flat=[]
+        for item in stack:
+            if isinstance(item,SublayerRepeat):
+                flat+=item.sublayers*item.repetitions
+            else:
+                flat.append(item)
+        self.assertEqual(len(flat),len(expected))
+        for a,b in zip(flat,expected):
+            self.assertAlmostEqual(a.thickness.value,b.thickness.value)
+            self.assertAlmostEqual(a.nsld_real.value,b.nsld_real.value)
+            self.assertAlmostEqual(a.msld.rho.value,b.msld.rho.value)
+            self.assertAlmostEqual(a.msld.phi.value,b.msld.phi.value)
+        self.assertEqual(sum(isinstance(item,SublayerRepeat) for item in stack),3)
+        self.assertRaises(ValueError,generateSublayerStack,layers,[(0,2,2)])
+        self.assertRaises(ValueError,generateSublayerStack,layers,[(2,4,2),(4,5,2)])
+
+    def test_nsld_table(self):
+        layers=layer_data_for_testing()
+        layers[2].nsld_table=([1.,4.,10.],[3.5e-6-3e-8j,3.6e-6-2e-7j,3.9e-6-1e-6j])
+        layers[3].nsld_table=([2.,8.],[2.3e-6-1e-8j,2.0e-6-5e-7j])
+        sublayers=generateSublayers(layers)[0]
+        for wavelength in (1.5,4.,7.):
+            fixed=deepcopy(layers)
+            for l in fixed:
+                l.nsld=l.nsld_at(wavelength)
+                l.nsld_table=None
+            expected=generateSublayers(fixed)[0]
+            self.assertEqual(len(sublayers),len(expected))
+            for a,b in zip(sublayers,expected):
+                self.assertAlmostEqual(a.thickness.value,b.thickness.value)
+                self.assertAlmostEqual(abs(a.nsld_at(wavelength)-b.nsld)*1e6,0.)
+        self.assertIsNone(sublayers[1].nsld_table)
+        self.assertRaises(ValueError,setattr,layers[2],'nsld_table',([1.,2.],[1e-6]))
+
+    def test_graded_sublayers(self):
+        layers=layer_data_for_testing()
+        constant=generateSublayers(layers)[0]
+        graded=generateSublayers(layers,graded=True)[0]
+        self.assertEqual(len(graded),len(constant))
+        self.assertTrue(any(isinstance(l,GradedSublayer) for l in graded))
+        for a,b in zip(graded,constant):
+            self.assertAlmostEqual(a.thickness.value,b.thickness.value)
+            self.assertEqual(a.msld.theta.value,b.msld.theta.value)
+            if isinstance(a,GradedSublayer):
+                #the profile is monotonic, and its mean close to the value in the middle
+                self.assertAlmostEqual(a.nsld_real.value*1e6,b.nsld_real.value*1e6,1)
+            else:
+                self.assertEqual(a.nsld,b.nsld)
+        #across an interface, the ends of neighbouring graded sublayers nearly match
+        rough=[l for l in graded if isinstance(l,GradedSublayer)][:10]
+        for a,b in zip(rough[:-1],rough[1:]):
+            self.assertAlmostEqual((a.nsld+a.nsld_step/2-b.nsld+b.nsld_step/2).real*1e6,0.,1)
+
 if __name__ == '__main__':
     unittest.main()
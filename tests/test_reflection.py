@@ -4,64 +4,546 @@ import numpy as np
 from numpy.testing import assert_array_almost_equal
 import os,copy
 import unittest
+import warnings
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
 
+def read_refl_par():
+    """
+    Layers, Q, resolution and polarization settings of the refl_par.dat reference case
+    """
+    paramfile = open(os.path.join(os.path.dirname(__file__),'data/refl_par.dat'),'r')
+    n_monte_carlo = int(paramfile.readline())
+    formalism = int(paramfile.readline())
+    res_mode = int(paramfile.readline())
+    n_of_outputs = int(paramfile.readline())
+    pol_vecs = np.array([float(value) for value in paramfile.readline().strip().split()]).reshape(6,3)
+    an_vecs = np.array([float(value) for value in paramfile.readline().strip().split()]).reshape(6,3)
+    pol_fun = [int(value) for value in paramfile.readline().split()]
+    norm_factor = [int(value) for value in paramfile.readline().split()]
+    maxwell = int(paramfile.readline())
+    glance_angle = int(paramfile.readline())
+    background = float(paramfile.readline())
+    percentage = float(paramfile.readline())
+    nlayers1 = int(paramfile.readline())
+    substrate_tmp = [float(value) for value in paramfile.readline().split()]
+    substrate=Layer()
+    substrate.nsld = complex(substrate_tmp[0],substrate_tmp[1])
+    NC = float(paramfile.readline())
+    layers = [Layer(name='Incoming media')]
+    for i in range(nlayers1):
+        l = Layer()
+        l.thickness = float(paramfile.readline())
+        nsld_tmp = [float(value) for value in paramfile.readline().split()]
+        l.nsld = complex(nsld_tmp[0], nsld_tmp[1])
+        msld_xyz = np.array([float(value) for value in paramfile.readline().split()])
+        l.msld.rho = np.sqrt(msld_xyz.dot(msld_xyz))
+        l.msld.phi= np.degrees(np.arctan2(msld_xyz[1],msld_xyz[0]))
+        l.msld.theta=0
+        if l.msld.rho.value!=0:
+            l.msld.theta=np.degrees(np.arccos(np.nan_to_num(msld_xyz[2]/l.msld.rho.value)))
+        l.NC = float(paramfile.readline())
+        layers.append(l)
+
+    paramfile.close()
+
+    q, dq = np.loadtxt(os.path.join(os.path.dirname(__file__),'data/refl_q_dq.dat'),unpack=True)
+    inc_moment = q / 2.0
+
+    pol_eff = np.ones(len(q), dtype=np.complex128)
+    an_eff = np.ones(len(q), dtype=np.complex128)
+    layers.append(substrate)
+    return layers, q, dq, inc_moment, pol_eff, an_eff, pol_vecs, an_vecs, n_of_outputs, norm_factor, background
+
+
+def random_sublayers(n, magnetic=True, seed=0, collinear=False):
+    """
+    Incoming media, n random sublayers and a substrate (as benchmarks.random_stack)
+    """
+    rng = np.random.RandomState(seed)
+    layers = [Layer(name='Incoming media')]
+    for i in range(n):
+        layers.append(Layer(thickness=rng.uniform(2., 30.), nsld_real=rng.uniform(1e-6, 6e-6),
+                            nsld_imaginary=-1e-8, msld_rho=rng.uniform(0, 2e-6) * magnetic,
+                            msld_theta=0. if collinear else 90., msld_phi=rng.uniform(-180., 180.)))
+    layers.append(Layer(nsld_real=2.07e-6))
+    return layers
+
+
 class TestReflectionClass(unittest.TestCase):
     def test_reference_results(self):
-        paramfile = open(os.path.join(os.path.dirname(__file__),'data/refl_par.dat'),'r')
-        n_monte_carlo = int(paramfile.readline())
-        formalism = int(paramfile.readline())
-        res_mode = int(paramfile.readline())
-        n_of_outputs = int(paramfile.readline())
-        pol_vecs = np.array([float(value) for value in paramfile.readline().strip().split()]).reshape(6,3)
-        an_vecs = np.array([float(value) for value in paramfile.readline().strip().split()]).reshape(6,3)
-        pol_fun = [int(value) for value in paramfile.readline().split()]
-        norm_factor = [int(value) for value in paramfile.readline().split()]
-        maxwell = int(paramfile.readline())
-        glance_angle = int(paramfile.readline())
-        background = float(paramfile.readline())
-        percentage = float(paramfile.readline())
-        nlayers1 = int(paramfile.readline())
-        substrate_tmp = [float(value) for value in paramfile.readline().split()]
-        substrate=Layer()
-        substrate.nsld = complex(substrate_tmp[0],substrate_tmp[1])
-        NC = float(paramfile.readline())
-        layers = [Layer(name='Incoming media')]
-        for i in range(nlayers1):
-            l = Layer()
-            l.thickness = float(paramfile.readline())
-            nsld_tmp = [float(value) for value in paramfile.readline().split()]
-            l.nsld = complex(nsld_tmp[0], nsld_tmp[1])
-            msld_xyz = np.array([float(value) for value in paramfile.readline().split()])
-            l.msld.rho = np.sqrt(msld_xyz.dot(msld_xyz))
-            l.msld.phi= np.degrees(np.arctan2(msld_xyz[1],msld_xyz[0]))
-            l.msld.theta=0
-            if l.msld.rho.value!=0:
-                l.msld.theta=np.degrees(np.arccos(np.nan_to_num(msld_xyz[2]/l.msld.rho.value)))
-            l.NC = float(paramfile.readline())
-            layers.append(l)
-
-        paramfile.close()
-
-        q, dq = np.loadtxt(os.path.join(os.path.dirname(__file__),'data/refl_q_dq.dat'),unpack=True)
-        inc_moment = q / 2.0
-
-        pol_eff = np.ones(len(q), dtype=np.complex128)
-        an_eff = np.ones(len(q), dtype=np.complex128)
-        layers.append(substrate)
+        layers, q, dq, inc_moment, pol_eff, an_eff, pol_vecs, an_vecs, n_of_outputs, norm_factor, background = read_refl_par()
         R = reflection.reflection(inc_moment, layers)
         for k in range(n_of_outputs):
             RR = reflection.spin_av(R, pol_vecs[k], an_vecs[k], pol_eff, an_eff)
             RR = np.real(RR)
-            for res_mode in range(1,3):
+            for res_mode in range(1,4):
                 RRr = reflection.resolut(RR, q, dq, res_mode)
                 RRr = RRr * norm_factor[k] + background
                 reference_values = np.loadtxt(os.path.join(os.path.dirname(__file__),'data/res_mode'+str(res_mode)+'refl'+str(k+1)+'.dat'), unpack=True)
                 assert_array_almost_equal(reference_values, RRr)
 
+class TestSublayerMatrix(unittest.TestCase):
+    def test_matches_matrix_exponential(self):
+        from scipy.linalg import expm
+        inc_moment = np.linspace(0.001, 0.05, 7)
+        inc_moment2 = np.square(inc_moment)
+        A = 4.0 * np.pi * complex(3.5e-6, -3e-8)
+        B1, B2, B3 = 4.0 * np.pi * np.array([1.2e-6, -0.4e-6, 0.7e-6])
+        th = 37.5
+        M = np.empty((4, 4, len(inc_moment)), dtype=np.complex128)
+        reflection.sublayer_matrix(A, B1, B2, B3, th, inc_moment2, M)
+        V = A * np.eye(2) + np.array([[B3, complex(B1, -B2)], [complex(B1, B2), -B3]])
+        for i, k2 in enumerate(inc_moment2):
+            generator = np.zeros((4, 4), dtype=np.complex128)
+            generator[:2, 2:] = np.eye(2)
+            generator[2:, :2] = V - k2 * np.eye(2)
+            assert_array_almost_equal(M[:, :, i], expm(th * generator), 10)
+
+class TestCollinearFastPath(unittest.TestCase):
+    def setUp(self):
+        from licorne.layer import RoughnessModel
+        from licorne.generateSublayers import generateSublayers
+        self.q = np.linspace(0.002, 0.2, 300)
+        incoming = Layer(thickness=np.inf)
+        oxide = Layer(thickness=18., nsld_real=2.0e-6, roughness=3.,
+                      roughness_model=RoughnessModel.ERFC, sublayers=10)
+        film = Layer(thickness=120., nsld_real=4.5e-6, nsld_imaginary=-2e-8,
+                     roughness=5., roughness_model=RoughnessModel.TANH, sublayers=10)
+        substrate = Layer(thickness=np.inf, nsld_real=2.07e-6, roughness=3.,
+                          roughness_model=RoughnessModel.ERFC, sublayers=8)
+        self.layers = [incoming, film, oxide, substrate]
+        self.generate = generateSublayers
+
+    def compare_paths(self):
+        sublayers = self.generate(self.layers)[0]
+        fast = reflection.reflection(self.q / 2., sublayers)
+        full = reflection.reflection(self.q / 2., sublayers, fast_path=False)
+        np.testing.assert_allclose(fast.data, full.data, rtol=1e-9, atol=1e-14)
+        eff = np.ones(len(self.q))
+        for n in ([1, 0, 0], [0, 0, 1], [0, 0, -1]):
+            np.testing.assert_allclose(reflection.spin_av(fast, n, n, eff, eff),
+                                       reflection.spin_av(full, n, n, eff, eff), rtol=1e-9)
+
+    def test_non_magnetic(self):
+        self.compare_paths()
+
+    def test_collinear(self):
+        self.layers[1].msld.rho = 1.5e-6
+        self.layers[2].msld.rho = 0.5e-6
+        self.layers[2].msld.theta = 180.
+        self.compare_paths()
+
+    def test_non_collinear_uses_full_path(self):
+        self.layers[1].msld.rho = 1.5e-6
+        self.layers[1].msld.theta = 90.
+        A, B1, B2, B3, _ = reflection.sublayer_potentials(self.generate(self.layers)[0])
+        self.assertFalse(reflection.is_collinear(B1, B2, B3))
+
+class TestTreeProduct(unittest.TestCase):
+    def test_tree_matches_sequential(self):
+        layers = random_sublayers(37, seed=42)
+        for l in layers[1:-1:3]:
+            l.msld.rho = 0.
+        inc_moment = np.linspace(0.001, 0.1, 211)
+        sequential = reflection.reflection(inc_moment, layers)
+        tree = reflection.reflection(inc_moment, layers, product='tree')
+        assert_array_almost_equal(sequential.data, tree.data, 12)
+        # small memory budget: evaluated in several Q chunks
+        budget = reflection.TREE_MEMORY
+        reflection.TREE_MEMORY = 100000
+        try:
+            chunked = reflection.reflection(inc_moment, layers, product='tree')
+        finally:
+            reflection.TREE_MEMORY = budget
+        assert_array_almost_equal(sequential.data, chunked.data, 12)
+        # non-magnetic stack goes through the scalar kernel
+        for l in layers:
+            l.msld.rho = 0.
+        assert_array_almost_equal(reflection.reflection(inc_moment, layers).data,
+                                  reflection.reflection(inc_moment, layers, product='tree').data, 12)
+
+class TestProductCache(unittest.TestCase):
+    def test_incremental_update(self):
+        layers = random_sublayers(64, seed=7)
+        inc_moment = np.linspace(0.001, 0.1, 97)
+        for magnetic in (True, False):
+            if not magnetic:
+                for l in layers:
+                    l.msld.rho = 0.
+            cache = reflection.ProductCache()
+            assert_array_almost_equal(reflection.reflection(inc_moment, layers).data,
+                                      reflection.reflection(inc_moment, layers, cache=cache).data, 12)
+            self.assertEqual(cache.products, 2 * 64 - 1)
+            # one changed sublayer: one leaf and the log2(64) nodes above it
+            layers[20].nsld_real.value *= 1.05
+            cache.products = 0
+            assert_array_almost_equal(reflection.reflection(inc_moment, layers).data,
+                                      reflection.reflection(inc_moment, layers, cache=cache).data, 12)
+            self.assertEqual(cache.products, 1 + 6)
+            # a new Q array clears the cache
+            cache.products = 0
+            reflection.reflection(inc_moment[:-1], layers, cache=cache)
+            self.assertEqual(cache.products, 2 * 64 - 1)
+
+    def test_bounded(self):
+        layers = [Layer(name='Incoming media')]
+        for i in range(50):
+            layers.append(Layer(thickness=10. + i, nsld_real=1e-6, msld_rho=1e-6, msld_theta=90.))
+        layers.append(Layer(nsld_real=2.07e-6))
+        inc_moment = np.linspace(0.001, 0.1, 100)
+        cache = reflection.ProductCache(max_memory=20 * 4 * 4 * 100 * 16)
+        R = reflection.reflection(inc_moment, layers, cache=cache)
+        self.assertLessEqual(cache.memory, cache.max_memory)
+        assert_array_almost_equal(reflection.reflection(inc_moment, layers).data, R.data, 12)
+        assert_array_almost_equal(reflection.reflection(inc_moment, layers, cache=cache).data, R.data, 12)
+
+class TestReflectionWorkspace(unittest.TestCase):
+    def test_matches_reflection(self):
+        layers = random_sublayers(30, seed=3)
+        inc_moment = np.linspace(0.001, 0.1, 120)
+        workspace = reflection.ReflectionWorkspace(len(inc_moment))
+        rhos = [l.msld.rho.value for l in layers[1:-1]]
+        # non-collinear, collinear with two channels, and non-magnetic
+        for theta, scale in ((90., 1.), (0., 1.), (0., 0.)):
+            for l, rho in zip(layers[1:-1], rhos):
+                l.msld.theta = theta
+                l.msld.rho = rho * scale
+            for fast_path in (True, False):
+                expected = reflection.reflection(inc_moment, layers, fast_path=fast_path, backend='numpy')
+                for cache in (None, reflection.ProductCache()):
+                    R = reflection.reflection(inc_moment, layers, fast_path=fast_path, cache=cache,
+                                              workspace=workspace)
+                    self.assertIs(R, workspace.R)
+                    assert_array_almost_equal(R.data, expected.data, 12)
+                    if cache is None:
+                        # the sequential product does the same operations
+                        self.assertTrue(np.array_equal(R.data, expected.data))
+        self.assertRaises(ValueError, reflection.reflection, inc_moment[:-1], layers, workspace=workspace)
+
+class TestBornApproximation(unittest.TestCase):
+    def test_high_q_tail(self):
+        layers = read_refl_par()[0]
+        inc_moment = np.linspace(0.002, 0.15, 300)
+        critical = np.sqrt(4 * np.pi * max(l.nsld.real for l in layers))
+        tail = inc_moment > 8 * critical
+        for magnetic in (True, False):
+            if not magnetic:
+                layers = copy.deepcopy(layers)
+                for l in layers:
+                    l.msld.rho = 0.
+            exact = reflection.reflection(inc_moment, layers, backend='numpy').data[:, :, tail]
+            born = reflection.born(inc_moment, layers).data[:, :, tail]
+            self.assertLess(np.abs(born - exact).max(), 1e-4 * np.abs(exact).max())
+
+    def test_hybrid(self):
+        layers = read_refl_par()[0]
+        inc_moment = np.linspace(0.002, 0.15, 300)
+        exact = reflection.reflection(inc_moment, layers, backend='numpy').data
+        born = reflection.born(inc_moment, layers).data
+        R = reflection.reflection(inc_moment, layers, backend='numpy', born_threshold=0.06).data
+        low = inc_moment <= 0.06
+        self.assertTrue(np.array_equal(R[:, :, low], exact[:, :, low]))
+        self.assertTrue(np.array_equal(R[:, :, ~low], born[:, :, ~low]))
+        # below the critical edge the continuity check fails, and all points are exact
+        R = reflection.reflection(inc_moment, layers, backend='numpy', born_threshold=0.001).data
+        self.assertTrue(np.array_equal(R, exact))
+
+class TestWavelengthDependentNsld(unittest.TestCase):
+    def test_matches_constant_nsld_per_point(self):
+        layers, q = read_refl_par()[:2]
+        inc_moment = np.linspace(q.min(), q.max(), 40) / 2.
+        wavelength = np.linspace(2., 10., 40)
+        layers[3].nsld_table = ([1., 5., 12.], [2e-6 - 1e-7j, 2.2e-6 - 5e-7j, 2.5e-6 - 2e-6j])
+        layers[-1].nsld_table = ([1., 12.], [2e-6, 4e-6])
+        for theta in (None, 0.):
+            if theta is not None:
+                for l in layers:
+                    l.msld.theta = theta
+            expected = np.empty((2, 2, len(inc_moment)), dtype=np.complex128)
+            for i in range(len(inc_moment)):
+                point = copy.deepcopy(layers)
+                for l in point:
+                    if l.nsld_table is not None:
+                        l.nsld = l.nsld_at(wavelength[i])
+                        l.nsld_table = None
+                expected[:, :, i] = reflection.reflection(inc_moment[i:i + 1], point, backend='numpy').data[:, :, 0]
+            for options in (dict(backend='numpy'), dict(backend='numba'), dict(backend='numpy', product='tree'),
+                            dict(backend='numpy', fast_path=False), dict(formalism='parratt'),
+                            dict(workspace=reflection.ReflectionWorkspace(len(inc_moment)))):
+                if options.get('backend') == 'numba' and reflection.numba_kernels is None:
+                    continue
+                R = reflection.reflection(inc_moment, layers, wavelength=wavelength, **options)
+                assert_array_almost_equal(R.data / np.abs(expected).max(), expected / np.abs(expected).max(), 12)
+        self.assertRaises(ValueError, reflection.reflection, inc_moment, layers, wavelength=wavelength[1:])
+        self.assertRaises(ValueError, reflection.reflection, inc_moment, layers, wavelength=wavelength,
+                          born_threshold=0.)
+
+    def test_states_and_warning(self):
+        layers, q = read_refl_par()[:2]
+        inc_moment = np.linspace(q.min(), q.max(), 40) / 2.
+        wavelength = np.linspace(2., 10., 40)
+        layers[3].nsld_table = ([1., 12.], [2e-6 - 1e-7j, 2.5e-6 - 2e-6j])
+        other = copy.deepcopy(layers)
+        other[4].msld.phi = 120.
+        R = reflection.reflection_domains(inc_moment, [layers, other], wavelength=wavelength)
+        for k, state in enumerate((layers, other)):
+            assert_array_almost_equal(R.data[:, :, k], reflection.reflection(inc_moment, state,
+                                                                             wavelength=wavelength).data, 12)
+        # the tables need the wavelength
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            R = reflection.reflection(inc_moment, layers)
+        self.assertEqual(len([w for w in caught if 'nsld_table' in str(w.message)]), 1)
+        layers[3].nsld_table = None
+        self.assertTrue(np.array_equal(R.data, reflection.reflection(inc_moment, layers).data))
+
+    def test_ignored_without_tables(self):
+        layers, q = read_refl_par()[:2]
+        inc_moment = q / 2.
+        wavelength = np.linspace(2., 10., len(q))
+        R = reflection.reflection(inc_moment, layers, backend='numpy')
+        self.assertTrue(np.array_equal(reflection.reflection(inc_moment, layers, backend='numpy',
+                                                             wavelength=wavelength).data, R.data))
+
+class TestGradedSublayers(unittest.TestCase):
+    def test_graded_matrices(self):
+        inc_moment2 = np.square(np.linspace(0.001, 0.1, 50))
+        V_top, V_bottom, th = 4 * np.pi * (1e-6 - 1e-8j), 4 * np.pi * 6e-6, 20.
+        # a fine stack of constant sublayers, and a few graded ones
+        fine = reflection._identity(2, 50)
+        for z in (np.arange(4000) + 0.5) / 4000:
+            M = reflection.scalar_matrices(np.array([[V_top + (V_bottom - V_top) * z]]), np.array([th / 4000]),
+                                           inc_moment2)[:, :, 0, 0]
+            fine = reflection._matmul(M, fine, np.empty_like(fine))
+        graded = reflection._identity(2, 50)
+        for z in np.arange(5) / 5.:
+            M = reflection.graded_matrices(V_top + (V_bottom - V_top) * z, V_top + (V_bottom - V_top) * (z + 0.2),
+                                           th / 5, inc_moment2)
+            graded = reflection._matmul(M, graded, np.empty_like(graded))
+        self.assertLess(np.abs(graded - fine).max(), 1e-6)
+        # constant potential: same as the constant sublayer
+        assert_array_almost_equal(reflection.graded_matrices(V_top, V_top, th, inc_moment2),
+                                  reflection.scalar_matrices(np.array([[V_top]]), np.array([th]),
+                                                             inc_moment2)[:, :, 0, 0], 12)
+
+    def test_converges_with_fewer_sublayers(self):
+        from licorne.generateSublayers import generateSublayers
+        from test_generate_sublayers import layer_data_for_testing
+        inc_moment = np.linspace(0.005, 0.3, 200) / 2.
+        norm = lambda X: np.sqrt(np.sum(np.abs(X) ** 2, axis=(0, 1)))
+        for theta in (None, 0.):
+            layers = layer_data_for_testing()
+
+            def stack(n, graded):
+                for l in layers:
+                    if theta is not None:
+                        l.msld.theta = theta
+                    if l.roughness.value > 0:
+                        l.sublayers = n
+                return generateSublayers(layers, graded)[0]
+            exact = reflection.reflection(inc_moment, stack(200, False), backend='numpy').data
+            error = lambda R: np.max(norm(R.data - exact) / norm(exact))
+            graded = stack(10, True)
+            R = reflection.reflection(inc_moment, graded)
+            self.assertLess(error(R), error(reflection.reflection(inc_moment, stack(30, False))))
+            assert_array_almost_equal(reflection.reflection(inc_moment, graded, fast_path=False).data, R.data, 12)
+
+class TestReflectionBatch(unittest.TestCase):
+    def test_batch_matches_single(self):
+        rng = np.random.RandomState(3)
+        inc_moment = np.linspace(0.001, 0.1, 83)
+        for magnetic, collinear in ((True, False), (True, True), (False, True)):
+            stacks = []
+            for n in (6, 1, 23, 11):
+                layers = random_sublayers(n, magnetic, rng.randint(1000), collinear)
+                layers[0].nsld_real = rng.uniform(0, 1e-6)
+                layers[-1].nsld_real = rng.uniform(1e-6, 3e-6)
+                stacks.append(layers)
+            array = reflection.stack_array(stacks)
+            self.assertEqual(array.shape, (4, 25))
+            self.assertTrue(np.all(array['thickness'][1, 2:-1] == 0.))
+            for product, backend in (('sequential', None), ('sequential', 'numpy'), ('tree', None)):
+                R = reflection.reflection_batch(inc_moment, array, product=product, backend=backend)
+                self.assertEqual(R.data.shape, (2, 2, 4, 83))
+                for k, layers in enumerate(stacks):
+                    assert_array_almost_equal(reflection.reflection(inc_moment, layers).data, R.data[:, :, k], 12)
+        # chunks of a few models, and of one model (evaluated one after the other), give the same result
+        points = reflection.BATCH_POINTS
+        try:
+            for reflection.BATCH_POINTS in (200, 100):
+                assert_array_almost_equal(reflection.reflection_batch(inc_moment, stacks, backend='numpy').data,
+                                          R.data, 12)
+        finally:
+            reflection.BATCH_POINTS = points
+
+class TestReflectionDomains(unittest.TestCase):
+    def test_matches_each_state(self):
+        layers, q = read_refl_par()[:2]
+        inc_moment = np.linspace(q.min(), q.max(), 200) / 2.
+        for theta in (90., 0.):
+            states = []
+            for phi in (0., 180., 60.):
+                state = copy.deepcopy(layers)
+                if theta == 0.:
+                    # collinear: every magnetization along the polarization axis
+                    for l in state:
+                        l.msld.theta = 0.
+                for l in state[3:6]:
+                    l.msld.rho = 5e-7
+                    l.msld.theta = theta
+                    l.msld.phi = phi
+                states.append(state)
+            for product in ('sequential', 'tree'):
+                R = reflection.reflection_domains(inc_moment, states, product=product)
+                self.assertEqual(R.data.shape, (2, 2, 3, 200))
+                for k, state in enumerate(states):
+                    expected = reflection.reflection(inc_moment, state, backend='numpy').data
+                    assert_array_almost_equal(R.data[:, :, k], expected, 12)
+        # states that differ in most sublayers are evaluated one after the other
+        for state in states:
+            state[1].thickness.value += 1.
+            state[-2].nsld_real.value *= 1.1
+        states[1][1].thickness.value += 2.
+        states[2][-2].nsld_real.value *= 1.1
+        for backend in (None, 'numpy'):
+            R = reflection.reflection_domains(inc_moment, states, backend=backend)
+            for k, state in enumerate(states):
+                assert_array_almost_equal(R.data[:, :, k], reflection.reflection(inc_moment, state).data, 12)
+        # incoherent average of the spin averaged reflectivities
+        n1, n2 = [[0, 0, 1], [0, 0, -1]], [[0, 0, 1], [0, 0, 1]]
+        eff = np.ones(len(inc_moment), dtype=np.complex128)
+        average = reflection.spin_av_domains(R, [1., 2., 1.], n1, n2, eff, eff)
+        expected = sum(w * reflection.spin_av_multi(reflection.reflection(inc_moment, state), n1, n2, eff, eff)
+                       for w, state in zip([1., 2., 1.], states)) / 4.
+        assert_array_almost_equal(average / np.abs(expected).max(), expected / np.abs(expected).max(), 12)
+
+class TestReflectivityGradient(unittest.TestCase):
+    def test_gradient_matches_finite_differences(self):
+        layers = random_sublayers(5, seed=5)
+        layers[0].nsld_real = 1e-7
+        layers[3].msld.rho = 0.
+        layers[-1].nsld_imaginary = -1e-9
+        inc_moment = np.linspace(0.001, 0.06, 41)
+        eff = np.ones(41, dtype=np.complex128)
+        n1, n2 = [0., 0., 1.], [1., 0., 0.]
+        spin_av = lambda l: np.real(reflection.spin_av(reflection.reflection(inc_moment, l), n1, n2, eff, eff))
+        rr, gradient, sub_gradient = reflection.reflectivity_gradient(inc_moment, layers, n1, n2, eff, eff)
+        assert_array_almost_equal(rr, spin_av(layers), 14)
+        self.assertEqual(gradient.shape, (5, 6, 41))
+        # chunks of Q that fit in a small memory budget give the same result
+        memory = reflection.GRADIENT_MEMORY
+        reflection.GRADIENT_MEMORY = 256 * 6 * 10
+        try:
+            chunked = reflection.reflectivity_gradient(inc_moment, layers, n1, n2, eff, eff)
+        finally:
+            reflection.GRADIENT_MEMORY = memory
+        for x, y in zip(chunked, (rr, gradient, sub_gradient)):
+            np.testing.assert_allclose(x, y, rtol=1e-12, atol=1e-12 * np.abs(y).max())
+
+        def check(layer, attribute, h, expected):
+            plus, minus = copy.deepcopy(layers), copy.deepcopy(layers)
+            attribute(plus[layer]).value += h
+            attribute(minus[layer]).value -= h
+            fd = (spin_av(plus) - spin_av(minus)) / (2 * h)
+            self.assertLess(np.abs(fd - expected).max(), 1e-7 * np.abs(fd).max())
+        for j in (0, 2, 4):
+            phi = np.deg2rad(layers[j + 1].msld.phi.value)
+            check(j + 1, lambda l: l.nsld_real, 1e-11, 4 * np.pi * gradient[j, 0])
+            check(j + 1, lambda l: l.nsld_imaginary, 1e-11, 4 * np.pi * gradient[j, 1])
+            check(j + 1, lambda l: l.msld.rho, 1e-11, 4 * np.pi * (gradient[j, 2] * np.cos(phi) + gradient[j, 3] * np.sin(phi)))
+            check(j + 1, lambda l: l.thickness, 1e-4, gradient[j, 5])
+        check(-1, lambda l: l.nsld_real, 1e-11, sub_gradient[0])
+        check(-1, lambda l: l.nsld_imaginary, 1e-11, sub_gradient[1])
+
+class TestThreadedReflection(unittest.TestCase):
+    def test_identical_to_serial(self):
+        layers = random_sublayers(40, seed=11)
+        inc_moment = np.linspace(0.001, 0.1, 1000)
+        budget = reflection.TREE_MEMORY
+        reflection.TREE_MEMORY = 500000
+        try:
+            for magnetic in (True, False):
+                if not magnetic:
+                    for l in layers:
+                        l.msld.rho = 0.
+                for product in ('sequential', 'tree'):
+                    serial = reflection.reflection(inc_moment, layers, product=product, backend='numpy')
+                    for threads in (True, 3):
+                        threaded = reflection.reflection(inc_moment, layers, product=product, threads=threads,
+                                                         backend='numpy')
+                        self.assertTrue(np.array_equal(serial.data, threaded.data))
+        finally:
+            reflection.TREE_MEMORY = budget
+
+    def test_threads_with_default_backend(self):
+        layers = random_sublayers(20, seed=12)
+        inc_moment = np.linspace(0.001, 0.1, 500)
+        chunks = []
+        thread_pool = reflection._thread_pool
+
+        def counting_pool(threads):
+            pool = thread_pool(threads)
+
+            class Pool(object):
+                def map(self, function, parts):
+                    parts = list(parts)
+                    chunks.extend(parts)
+                    return pool.map(function, parts)
+            return Pool()
+        reflection._thread_pool = counting_pool
+        try:
+            threaded = reflection.reflection(inc_moment, layers, threads=2)
+        finally:
+            reflection._thread_pool = thread_pool
+        self.assertEqual(len(chunks), 2)
+        self.assertTrue(np.array_equal(threaded.data, reflection.reflection(inc_moment, layers, backend='numpy').data))
+
+class TestSpinAvMulti(unittest.TestCase):
+    def test_matches_spin_av(self):
+        layers, q, dq, inc_moment, pol_eff, an_eff, pol_vecs, an_vecs, n_of_outputs, norm_factor, background = read_refl_par()
+        R = reflection.reflection(inc_moment, layers)
+        rng = np.random.RandomState(2)
+        pol_eff = rng.uniform(0.8, 1., len(q)) + 0j
+        an_eff = rng.uniform(0.8, 1., len(q)) + 0j
+        n1 = np.concatenate((pol_vecs, rng.uniform(-1., 1., (4, 3))))
+        n2 = np.concatenate((an_vecs, rng.uniform(-1., 1., (4, 3))))
+        RR = reflection.spin_av_multi(R, n1, n2, pol_eff, an_eff)
+        self.assertEqual(RR.shape, (10, len(q)))
+        for c in range(10):
+            expected = reflection.spin_av(R, n1[c], n2[c], pol_eff, an_eff, backend='numpy')
+            assert_array_almost_equal(RR[c] / np.abs(expected).max(), expected / np.abs(expected).max(), 14)
+
+class TestRepeatedBlocks(unittest.TestCase):
+    def test_repeat_matches_expanded_stack(self):
+        from licorne.layer import RoughnessModel
+        from licorne.generateSublayers import generateSublayers, generateSublayerStack, expand_repeats
+        layers = [Layer(thickness=np.inf),
+                  Layer(thickness=30., nsld_real=2e-6, roughness=3., roughness_model=RoughnessModel.TANH, sublayers=4),
+                  Layer(thickness=25., nsld_real=6e-6, msld_rho=1e-6, msld_theta=90., msld_phi=30.,
+                        roughness=4., roughness_model=RoughnessModel.TANH, sublayers=4),
+                  Layer(thickness=15., nsld_real=3e-6, msld_rho=2e-6, msld_theta=90., msld_phi=-60.,
+                        roughness=2., roughness_model=RoughnessModel.ERFC, sublayers=4),
+                  Layer(thickness=np.inf, nsld_real=2.07e-6, roughness=3.,
+                        roughness_model=RoughnessModel.TANH, sublayers=4)]
+        inc_moment = np.linspace(0.001, 0.1, 150)
+        for repeats in ([(2, 3, 20)], [(1, 1, 5), (2, 3, 7)]):
+            expanded = generateSublayers(expand_repeats(layers, repeats)[0])[0]
+            stack = generateSublayerStack(layers, repeats)
+            self.assertLess(len(stack), len(expanded))
+            for product in ('sequential', 'tree'):
+                assert_array_almost_equal(reflection.reflection(inc_moment, expanded).data,
+                                          reflection.reflection(inc_moment, stack, product=product).data, 10)
+        # non-magnetic periods use the scalar kernel
+        for l in layers:
+            l.msld.rho = 0.
+        expanded = generateSublayers(expand_repeats(layers, [(2, 3, 20)])[0])[0]
+        stack = generateSublayerStack(layers, [(2, 3, 20)])
+        assert_array_almost_equal(reflection.reflection(inc_moment, expanded).data,
+                                  reflection.reflection(inc_moment, stack).data, 10)
+
 def res_chi3_137(Q):
     Theta1 = 0.0068
     Theta2 = 0.01
@@ -256,6 +738,141 @@ class Testhelix100(unittest.TestCase):
         fig.savefig('helix100_'+str(k+1)+'.pdf')
         plt.close()
 
+class TestResolution(unittest.TestCase):
+    def test_matches_full_kernel(self):
+        rng = np.random.RandomState(0)
+        q = np.sort(np.exp(rng.uniform(np.log(0.005), np.log(0.2), 1000)))
+        dq = 0.03 * q + 1e-4
+        RR = np.sinc(300 * q) ** 2 / (1 + (q / 0.01) ** 4) + 1e-8
+        # every point spread over the whole Q range
+        weights = reflection.gaussian(q[:, np.newaxis], q, dq)
+        expected = weights.dot(RR) / weights.sum(axis=1)
+        self.assertTrue(np.abs(reflection.gaussian_resolution(RR, q, dq) - expected).max() < 1e-10)
+        # the order of the points does not matter
+        order = rng.permutation(len(q))
+        assert_array_almost_equal(reflection.gaussian_resolution(RR[order], q[order], dq[order]), expected[order], 14)
+
+    def test_resolution_operator(self):
+        q = np.linspace(0.005, 0.2, 500)
+        RR = np.array([np.sinc(300 * q) ** 2, np.exp(-100 * q)])
+        cache = reflection.ResolutionCache()
+        for width, dense in ((0.001, False), (0.1, True)):
+            dq = width * q + 1e-4
+            op = cache.operator(q, dq)
+            self.assertEqual(isinstance(op.matrix, np.ndarray), dense)
+            for rr, resolved in zip(RR, op(RR)):
+                assert_array_almost_equal(resolved, reflection.resolut(rr, q, dq, 4), 14)
+            # built once for each Q grid and resolution
+            self.assertIs(cache.operator(q.copy(), dq.copy()), op)
+        self.assertIsNot(cache.operator(q, 0.01 * q), op)
+
+    def test_resolut1(self):
+        q = np.sort(np.random.RandomState(2).uniform(0.005, 0.2, 300))
+        dq = 0.1 * q
+        dq[:5] = 0.
+        RR = np.exp(-200 * q)
+        expected = np.array([RR[np.abs(q - qi) <= dqi / 2.].mean() for qi, dqi in zip(q, dq)])
+        # the small values at high Q keep their precision
+        np.testing.assert_allclose(reflection.resolut1(RR, q, dq), expected, rtol=1e-13)
+        # as in the original loops, the windows of descending q points never end
+        np.testing.assert_allclose(reflection.resolut1(RR[::-1], q[::-1], dq[::-1]), np.full(len(q), RR.mean()),
+                                   rtol=1e-13)
+
+    def test_gauss_hermite_resolution(self):
+        layers = [Layer(), Layer(thickness=1000., nsld_real=4e-6), Layer(nsld_real=2e-6)]
+        ones = lambda q: np.ones(len(q))
+        reflectivity = lambda q: np.real(reflection.spin_av(reflection.reflection(q / 2., layers), [0, 0, 0], [0, 0, 0],
+                                                            ones(q), ones(q)))
+        # data points too far apart for the fringes of the film
+        Q = np.linspace(0.01, 0.12, 56)
+        dQ = 0.01 * Q + 2e-4
+        fine = np.linspace(0., 0.14, 20001)
+        gauss = np.exp(-np.square(fine - Q[:, np.newaxis]) / (2 * np.square(dQ[:, np.newaxis])))
+        expected = gauss.dot(reflectivity(fine)) / gauss.sum(axis=1)
+        self.assertGreater(np.abs(reflection.resolut(reflectivity(Q), Q, dQ, 4) / expected - 1).max(), 0.1)
+        for merge in (0., 0.1):
+            op = reflection.GaussHermiteResolution(Q, dQ, 7, merge)
+            self.assertLess(np.abs(op(reflectivity(op.q)) / expected - 1).max(), 1e-3)
+        # nodes are shared between points with overlapping resolution
+        Q = np.linspace(0.01, 0.12, 551)
+        self.assertEqual(len(reflection.GaussHermiteResolution(Q, 0.01 * Q + 2e-4, 7).q), 7 * 551)
+        self.assertLess(len(reflection.GaussHermiteResolution(Q, 0.01 * Q + 2e-4, 7, 0.25).q), 7 * 551 / 4)
+
+    def test_resolut2_resolut3(self):
+        q = np.sort(np.random.RandomState(1).uniform(0.005, 0.1, 60))
+        dq = 0.04 * q
+        dq[10:20] = 1e-5
+        RR = np.exp(-50 * q)
+        for res_mode in (2, 3):
+            expected = reflection.resolut(RR, q, dq, res_mode)
+            # narrow resolution leaves the points as they are
+            assert_array_almost_equal(expected[11:19], RR[11:19], 15)
+            assert_array_almost_equal(reflection.ResolutionOperator(q, dq, res_mode)(RR), expected, 15)
+        # resolut2 is symmetric, so q can also be in descending order
+        assert_array_almost_equal(reflection.resolut2(RR[::-1], q[::-1], dq[::-1]), reflection.resolut2(RR, q, dq)[::-1], 15)
+
+class TestParrattFormalism(unittest.TestCase):
+    def test_reference_cases(self):
+        layers, q = read_refl_par()[:2]
+        cases = [(q / 2., layers)] + [(case.inc_moment, case.layers) for case in (Testchi3_137, Testr2_6_508, Testhelix100)]
+        for inc_moment, layers in cases:
+            for fast_path in (True, False):
+                transfer = reflection.reflection(inc_moment, layers, fast_path=fast_path, backend='numpy').data
+                parratt = reflection.reflection(inc_moment, layers, fast_path=fast_path, formalism='parratt').data
+                assert_array_almost_equal(parratt / np.abs(transfer).max(), transfer / np.abs(transfer).max(), 11)
+
+    def test_thick_absorbing_layer(self):
+        inc_moment = np.linspace(0.001, 0.15, 300)
+        nsld = complex(4e-6, -1e-6)
+        for rho in (0., 1e-6):
+            layers = [Layer(thickness=np.inf),
+                      Layer(thickness=1e6, nsld_real=nsld.real, nsld_imaginary=nsld.imag, msld_rho=rho, msld_theta=0.),
+                      Layer(nsld_real=2.07e-6)]
+            with np.errstate(all='ignore'):
+                transfer = reflection.reflection(inc_moment, layers, backend='numpy').data
+            self.assertFalse(np.isfinite(transfer).all())
+            # the wave does not reach the substrate: Fresnel amplitudes of the top interface
+            for fast_path in (True, False):
+                R = reflection.reflection(inc_moment, layers, fast_path=fast_path, formalism='parratt')
+                for r, sign in ((R.oneone, 1.), (R.twotwo, -1.)):
+                    k = np.sqrt(inc_moment ** 2 - 4 * np.pi * (nsld + sign * rho))
+                    assert_array_almost_equal(r, (inc_moment - k) / (inc_moment + k), 14)
+                assert_array_almost_equal(R.onetwo, 0., 14)
+
+    def test_bare_substrate(self):
+        inc_moment = np.linspace(0.001, 0.05, 200)
+        layers = [Layer(thickness=np.inf), Layer(nsld_real=2.07e-6)]
+        for fast_path in (True, False):
+            transfer = reflection.reflection(inc_moment, layers, fast_path=fast_path, backend='numpy').data
+            parratt = reflection.reflection(inc_moment, layers, fast_path=fast_path, formalism='parratt').data
+            assert_array_almost_equal(parratt, transfer, 12)
+
+@unittest.skipIf(reflection.numba_kernels is None, 'numba is not installed')
+class TestNumbaBackend(unittest.TestCase):
+    def test_backends_agree_on_reference_data(self):
+        layers, q, dq, inc_moment, pol_eff, an_eff, pol_vecs, an_vecs, n_of_outputs, norm_factor, background = read_refl_par()
+        cases = [(layers, q, dq, pol_vecs[:n_of_outputs], an_vecs[:n_of_outputs])]
+        for case in (Testchi3_137, Testr2_6_508, Testhelix100):
+            q = case.Q if hasattr(case, 'Q') else case.q
+            cases.append((case.layers, q, case.sigma, case.pol_vecs[:case.n_of_outputs], case.an_vecs[:case.n_of_outputs]))
+        for layers, q, sigma, pol_vecs, an_vecs in cases:
+            eff = np.ones(len(q), dtype=np.complex128)
+            for fast_path in (True, False):
+                R = reflection.reflection(q / 2.0, layers, fast_path=fast_path, backend='numpy')
+                R_numba = reflection.reflection(q / 2.0, layers, fast_path=fast_path, backend='numba')
+                assert_array_almost_equal(R.data / np.abs(R.data).max(), R_numba.data / np.abs(R.data).max(), 12)
+            for pol, an in zip(pol_vecs, an_vecs):
+                RR = np.real(reflection.spin_av(R, pol, an, eff, eff, backend='numpy'))
+                RR_numba = np.real(reflection.spin_av(R, pol, an, eff, eff, backend='numba'))
+                assert_array_almost_equal(RR, RR_numba, 14)
+        # collinear stack, on the scalar kernel
+        layers = copy.deepcopy(layers)
+        for l in layers:
+            l.msld.theta = 0.
+        assert_array_almost_equal(reflection.reflection(q / 2.0, layers, backend='numpy').data,
+                                  reflection.reflection(q / 2.0, layers, backend='numba').data, 12)
+
+
 if __name__ == '__main__':
     unittest.main()
 